@@ -0,0 +1,9 @@
+from django.test import override_settings
+
+# settings put the cache and channel layer on Redis and the AI assistant on
+# the Claude API; tests use in-process ones
+local_services = override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    CHANNEL_LAYERS={'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}},
+    AI_BACKEND='fake',
+)
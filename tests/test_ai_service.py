@@ -0,0 +1,247 @@
+import asyncio
+from unittest import mock
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, override_settings
+from whats_app import ai_admission, ai_service
+from whats_app.ai_admission import AdmissionController, GuardedBackend, Overloaded, TransientError
+from whats_app.ai_cache import ResponseCache
+
+
+class ScriptedBackend:
+    """Streams `reply` word by word, counting requests; fails first if told to"""
+
+    def __init__(self, reply='one two three', delay=0.02, failures=()):
+        self.reply = reply
+        self.delay = delay
+        self.failures = list(failures)
+        self.calls = 0
+
+    async def stream(self, messages, system, max_tokens=None):
+        self.calls += 1
+        if self.failures:
+            raise self.failures.pop(0)
+        for word in self.reply.split():
+            await asyncio.sleep(self.delay)
+            yield word + ' '
+
+
+def prompt(text, history=()):
+    return [*history, {'role': 'user', 'content': text}]
+
+
+async def collect(stream):
+    return ''.join([text async for text in stream])
+
+
+class BackendSettingTests(SimpleTestCase):
+    def setUp(self):
+        patch = mock.patch.object(ai_service, '_backend', None)
+        patch.start()
+        self.addCleanup(patch.stop)
+
+    @override_settings(AI_BACKEND='anthropic', ANTHROPIC_API_KEY=None)
+    def test_anthropic_without_a_key_is_refused(self):
+        with self.assertRaises(ImproperlyConfigured):
+            ai_service.get_backend()
+
+    @override_settings(AI_BACKEND='fake', ANTHROPIC_API_KEY=None)
+    def test_fake_is_chosen_explicitly(self):
+        self.assertIsInstance(ai_service.get_backend(), ai_service.FakeBackend)
+
+    @override_settings(AI_BACKEND='anthropic', ANTHROPIC_API_KEY=None)
+    def test_misconfiguration_is_not_answered_with_the_fallback(self):
+        with self.assertRaises(ImproperlyConfigured):
+            ai_service.ClaudeAIService().generate_reply(prompt('hi'))
+
+
+class ResponseCacheTests(SimpleTestCase):
+    async def test_identical_prompts_in_flight_share_one_request(self):
+        cache, backend = ResponseCache(), ScriptedBackend()
+        replies = await asyncio.gather(
+            collect(cache.stream(backend, prompt('Tell me a joke!'), 'system')),
+            collect(cache.stream(backend, prompt('tell me a  joke'), 'system')),
+        )
+        self.assertEqual(replies, ['one two three '] * 2)
+        self.assertEqual(backend.calls, 1)
+        self.assertEqual(cache.stats()['coalesced'], 1)
+
+    async def test_finished_reply_is_replayed(self):
+        cache, backend = ResponseCache(), ScriptedBackend()
+        await collect(cache.stream(backend, prompt('hi'), 'system'))
+        self.assertEqual(await collect(cache.stream(backend, prompt('HI'), 'system')), 'one two three ')
+        self.assertEqual(backend.calls, 1)
+        self.assertEqual(cache.stats()['hits'], 1)
+
+    async def test_context_is_part_of_the_key(self):
+        cache, backend = ResponseCache(), ScriptedBackend()
+        await collect(cache.stream(backend, prompt('hi'), 'system'))
+        await collect(cache.stream(backend, prompt('hi'), 'system with a summary'))
+        await collect(cache.stream(backend, prompt('hi', [{'role': 'user', 'content': 'earlier'}]), 'system'))
+        self.assertEqual(backend.calls, 3)
+
+    async def test_follower_keeps_the_reply_when_the_first_caller_leaves(self):
+        cache, backend = ResponseCache(), ScriptedBackend()
+        first = cache.stream(backend, prompt('hi'), 'system')
+        await first.__anext__()
+        follower = asyncio.ensure_future(collect(cache.stream(backend, prompt('hi'), 'system')))
+        await asyncio.sleep(0)
+        await first.aclose()
+
+        self.assertEqual(await follower, 'one two three ')
+        self.assertEqual(cache.stats()['entries'], 1)
+
+    async def test_reply_nobody_follows_is_abandoned_and_not_cached(self):
+        cache, backend = ResponseCache(), ScriptedBackend()
+        stream = cache.stream(backend, prompt('hi'), 'system')
+        await stream.__anext__()
+        await stream.aclose()
+        await asyncio.sleep(0.05)
+
+        self.assertEqual(cache.stats()['in_flight'], 0)
+        self.assertEqual(cache.stats()['entries'], 0)
+
+    async def test_failures_reach_every_caller_and_are_not_cached(self):
+        cache, backend = ResponseCache(), ScriptedBackend(failures=[RuntimeError('down')])
+        results = await asyncio.gather(
+            collect(cache.stream(backend, prompt('hi'), 'system')),
+            collect(cache.stream(backend, prompt('hi'), 'system')),
+            return_exceptions=True,
+        )
+        self.assertTrue(all(isinstance(result, RuntimeError) for result in results))
+        self.assertEqual(await collect(cache.stream(backend, prompt('hi'), 'system')), 'one two three ')
+        self.assertEqual(backend.calls, 2)
+
+    async def test_least_recently_used_reply_is_evicted(self):
+        cache, backend = ResponseCache(size=2), ScriptedBackend(delay=0)
+        for text in ('a', 'b', 'a', 'c'):
+            await collect(cache.stream(backend, prompt(text), 'system'))
+        await collect(cache.stream(backend, prompt('a'), 'system'))
+        await collect(cache.stream(backend, prompt('b'), 'system'))
+
+        # a was used after b, so b went when c arrived
+        self.assertEqual(backend.calls, 4)
+        self.assertEqual(cache.stats()['evictions'], 2)
+
+    async def test_expired_reply_is_generated_again(self):
+        cache, backend = ResponseCache(ttl=0.01), ScriptedBackend(delay=0)
+        await collect(cache.stream(backend, prompt('hi'), 'system'))
+        await asyncio.sleep(0.02)
+        await collect(cache.stream(backend, prompt('hi'), 'system'))
+        self.assertEqual(backend.calls, 2)
+
+    async def test_long_prompts_bypass_the_cache(self):
+        cache, backend = ResponseCache(max_prompt=10), ScriptedBackend(delay=0)
+        for _ in range(2):
+            await collect(cache.stream(backend, prompt('x' * 11), 'system'))
+        self.assertEqual(backend.calls, 2)
+        self.assertEqual(cache.stats()['uncacheable'], 2)
+
+
+class AdmissionControllerTests(SimpleTestCase):
+    async def test_full_queue_fails_fast(self):
+        controller = AdmissionController(limit=1, per_user=5, queue_limit=1, queue_timeout=5)
+        await controller.acquire(1)
+        waiting = asyncio.ensure_future(controller.acquire(2))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(Overloaded) as refused:
+            await controller.acquire(3)
+        self.assertEqual(refused.exception.reason, 'queue_full')
+        self.assertGreaterEqual(refused.exception.retry_after, 1)
+
+        controller.release(1)
+        await waiting
+        self.assertEqual(controller.stats()['running'], 1)
+
+    async def test_per_user_limit_counts_running_and_waiting(self):
+        controller = AdmissionController(limit=1, per_user=2, queue_limit=10, queue_timeout=5)
+        await controller.acquire(1)
+        waiting = asyncio.ensure_future(controller.acquire(1))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(Overloaded) as refused:
+            await controller.acquire(1)
+        self.assertEqual(refused.exception.reason, 'user_limit')
+        waiting.cancel()
+
+    async def test_wait_is_bounded(self):
+        controller = AdmissionController(limit=1, per_user=5, queue_limit=10, queue_timeout=0.02)
+        await controller.acquire(1)
+        with self.assertRaises(Overloaded) as refused:
+            await controller.acquire(2)
+        self.assertEqual(refused.exception.reason, 'queue_timeout')
+        self.assertEqual(controller.stats()['queued'], 0)
+
+    async def test_interactive_requests_go_first(self):
+        controller = AdmissionController(limit=1, per_user=5, queue_limit=10, queue_timeout=5)
+        await controller.acquire(1)
+        background = asyncio.ensure_future(controller.acquire(None, ai_admission.BACKGROUND))
+        await asyncio.sleep(0)
+        interactive = asyncio.ensure_future(controller.acquire(2))
+        await asyncio.sleep(0)
+
+        controller.release(1)
+        await interactive
+        self.assertFalse(background.done())
+        controller.release(2)
+        await background
+
+    async def test_transient_failures_are_retried_with_jitter(self):
+        controller = AdmissionController(limit=1)
+        backend = ScriptedBackend(delay=0, failures=[TransientError('busy'), TransientError('busy')])
+        guarded = GuardedBackend(backend, user_pk=1, controller=controller)
+        with mock.patch.object(ai_admission, 'AI_RETRY_BASE_DELAY', 0.01), \
+                mock.patch.object(ai_admission.random, 'uniform', wraps=ai_admission.random.uniform) as jitter:
+            reply = await collect(guarded.stream(prompt('hi'), 'system'))
+
+        self.assertEqual(reply, 'one two three ')
+        self.assertEqual(backend.calls, 3)
+        self.assertEqual(controller.stats()['retries'], 2)
+        # Full jitter: anywhere from zero up to the doubling backoff
+        self.assertEqual([call.args for call in jitter.call_args_list], [(0, 0.01), (0, 0.02)])
+        self.assertEqual(controller.stats()['running'], 0)
+
+    async def test_gives_up_after_the_retry_budget(self):
+        backend = ScriptedBackend(failures=[TransientError('busy')] * 5)
+        guarded = GuardedBackend(backend, controller=AdmissionController())
+        with mock.patch.object(ai_admission, 'AI_RETRY_BASE_DELAY', 0.001):
+            with self.assertRaises(TransientError):
+                await collect(guarded.stream(prompt('hi'), 'system'))
+        self.assertEqual(backend.calls, ai_admission.AI_RETRIES + 1)
+
+    async def test_other_errors_are_not_retried(self):
+        backend = ScriptedBackend(failures=[ValueError('bad request')])
+        guarded = GuardedBackend(backend, controller=AdmissionController())
+        with self.assertRaises(ValueError):
+            await collect(guarded.stream(prompt('hi'), 'system'))
+        self.assertEqual(backend.calls, 1)
+
+    async def test_no_retry_once_text_was_sent(self):
+        class BreaksMidway(ScriptedBackend):
+            async def stream(self, messages, system, max_tokens=None):
+                self.calls += 1
+                yield 'partial '
+                raise TransientError('connection reset')
+
+        backend = BreaksMidway()
+        guarded = GuardedBackend(backend, controller=AdmissionController())
+        with self.assertRaises(TransientError):
+            await collect(guarded.stream(prompt('hi'), 'system'))
+        self.assertEqual(backend.calls, 1)
+
+    async def test_first_token_timeout_counts_as_transient(self):
+        backend = ScriptedBackend(delay=0.05)
+        guarded = GuardedBackend(backend, controller=AdmissionController())
+        with mock.patch.object(ai_admission, 'AI_FIRST_TOKEN_TIMEOUT', 0.01), \
+                mock.patch.object(ai_admission, 'AI_RETRY_BASE_DELAY', 0.001):
+            with self.assertRaises(asyncio.TimeoutError):
+                await collect(guarded.stream(prompt('hi'), 'system'))
+        self.assertEqual(backend.calls, ai_admission.AI_RETRIES + 1)
+
+    async def test_fake_backend_injects_transient_failures(self):
+        controller = AdmissionController()
+        backend = ai_service.FakeBackend(first_token_delay=0, token_delay=0, failure_rate=1.0)
+        with mock.patch.object(ai_admission, 'AI_RETRY_BASE_DELAY', 0.001):
+            with self.assertRaises(TransientError):
+                await collect(GuardedBackend(backend, controller=controller).stream(prompt('hi'), 'system'))
+        self.assertEqual(controller.stats()['retries'], ai_admission.AI_RETRIES)
@@ -0,0 +1,680 @@
+import asyncio
+import json
+import threading
+import time
+from unittest import mock
+import msgpack
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.db import connection, connections
+from django.db.backends.signals import connection_created
+from django.test import SimpleTestCase, TransactionTestCase
+from whats_app import ai_service, db_executor, messaging, metrics, presence, rate_limits, receipts, wire
+from whats_app.ai_cache import ResponseCache
+from whats_app.db_executor import MeteredExecutor, PooledDatabaseSyncToAsync, database_sync_to_async
+from whats_app.access import load_chat_access
+from whats_app.metrics import ConnectionMetrics
+from whats_app.models import AIAssistant, AIConversation, AIMessage, ChatParticipant, Group, User
+from whats_app.presence import LocalPresenceBackend, PresenceService, presence_group_name
+from whats_app.rate_limits import RateLimiter, TokenBucket
+from whats_app.routing import websocket_urlpatterns
+from whats_app.send_queue import SendQueue
+from whats_app.typing_indicators import TypingTracker
+from . import local_services
+from .test_models import make_chat, make_user
+
+application = URLRouter(websocket_urlpatterns)
+
+
+class DatabaseExecutorTests(TransactionTestCase):
+    def executor(self, workers):
+        executor = MeteredExecutor(workers)
+        self.addCleanup(executor.shutdown)
+        return executor
+
+    def test_stats_track_the_queue(self):
+        executor = self.executor(1)
+        gate = threading.Event()
+        futures = [executor.submit(gate.wait)] + [executor.submit(time.sleep, 0) for _ in range(2)]
+        time.sleep(0.05)
+        stats = executor.stats()
+        self.assertEqual((stats['running'], stats['queued']), (1, 2))
+
+        gate.set()
+        for future in futures:
+            future.result()
+        stats = executor.stats()
+        self.assertEqual((stats['running'], stats['queued'], stats['calls']), (0, 0, 3))
+        # The two queued calls waited behind the blocked one
+        self.assertGreaterEqual(stats['wait_max_ms'], 50)
+        self.assertGreaterEqual(stats['wait_p99_ms'], 50)
+        self.assertLess(stats['wait_p50_ms'], stats['wait_max_ms'] + 1)
+
+    def test_no_more_than_workers_run_at_once(self):
+        executor = self.executor(2)
+        lock, running, peak = threading.Lock(), [0], [0]
+
+        def work():
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+
+        for future in [executor.submit(work) for _ in range(8)]:
+            future.result()
+        self.assertEqual(peak[0], 2)
+
+    async def test_each_thread_reuses_its_connection(self):
+        executor = self.executor(1)
+        opened = []
+
+        def on_connect(sender, connection, **kwargs):
+            opened.append(connection)
+
+        def query():
+            User.objects.count()
+            return connection.connection, connection.settings_dict['CONN_MAX_AGE']
+
+        call = PooledDatabaseSyncToAsync(query, executor=executor)
+        connection_created.connect(on_connect)
+        try:
+            first, max_age = await call()
+            second, _ = await call()
+        finally:
+            connection_created.disconnect(on_connect)
+            executor.submit(connections.close_all).result()
+
+        self.assertIs(first, second)
+        self.assertEqual(len(opened), 1)
+        self.assertEqual(max_age, db_executor.DB_EXECUTOR_CONN_MAX_AGE)
+        # Other threads keep the project-wide setting
+        self.assertEqual(connection.settings_dict['CONN_MAX_AGE'], 0)
+
+    async def test_idle_connection_is_tested(self):
+        executor = self.executor(1)
+        wrapper = type(connections['default'])
+        call = PooledDatabaseSyncToAsync(User.objects.count, executor=executor)
+        try:
+            await call()
+            with mock.patch.object(wrapper, 'is_usable', return_value=False) as is_usable, \
+                    mock.patch.object(wrapper, 'close', autospec=True) as close:
+                # Used a moment ago: trusted
+                await call()
+                self.assertFalse(is_usable.called)
+                # Idle too long: tested, and dropped as broken
+                with mock.patch.object(db_executor, 'DB_HEALTH_CHECK_IDLE', 0):
+                    await call()
+                self.assertTrue(is_usable.called)
+                self.assertTrue(close.called)
+        finally:
+            executor.submit(connections.close_all).result()
+
+
+class RateLimiterTests(SimpleTestCase):
+    def setUp(self):
+        patch = mock.patch.object(rate_limits.time, 'monotonic', return_value=1000.0)
+        self.clock = patch.start()
+        self.addCleanup(patch.stop)
+
+    def limiter(self, user_pk):
+        limiter = RateLimiter(user_pk, limits={'message': (1, 2), 'typing': (1, 2)},
+                              user_limits={'message': (1, 3), 'typing': (1, 3)})
+        self.addCleanup(limiter.close)
+        return limiter
+
+    def test_bucket_refills_at_its_rate_up_to_the_burst(self):
+        bucket = TokenBucket(rate=2, burst=4)
+        bucket.tokens = 0
+        bucket.refill(bucket.updated + 0.25)
+        self.assertEqual(bucket.tokens, 0.5)
+        self.assertEqual(bucket.wait(), 0.25)
+        bucket.refill(bucket.updated + 10)
+        self.assertEqual(bucket.tokens, 4)
+        self.assertEqual(bucket.wait(), 0)
+
+    def test_socket_and_user_buckets_per_frame_class(self):
+        phone, laptop, other = self.limiter(1), self.limiter(1), self.limiter(2)
+        self.assertEqual([phone.check('message') for _ in range(2)], [0, 0])
+        # The phone's own bucket is empty; other frame classes are not affected
+        self.assertEqual(phone.check('message'), 1)
+        self.assertEqual(phone.check('typing'), 0)
+        # The laptop has its own bucket but shares the user's, which has one left
+        self.assertEqual(laptop.check('message'), 0)
+        self.assertEqual(laptop.check('message'), 1)
+        # Another user is untouched
+        self.assertEqual(other.check('message'), 0)
+
+        self.clock.return_value += 1
+        self.assertEqual(laptop.check('message'), 0)
+
+    def test_user_buckets_go_with_the_last_socket(self):
+        first, second = self.limiter(1), self.limiter(1)
+        first.close()
+        self.assertIn(1, rate_limits._user_buckets)
+        second.close()
+        self.assertNotIn(1, rate_limits._user_buckets)
+
+
+class SendQueueTests(SimpleTestCase):
+    async def queue(self, **limits):
+        """A queue whose client takes frames only once `gate` is set"""
+        self.sent, self.gate, self.overflowed = [], asyncio.Event(), []
+
+        async def send(text_data):
+            await self.gate.wait()
+            self.sent.append(text_data)
+
+        async def overflow():
+            self.overflowed.append(True)
+
+        return SendQueue(send, overflow, ConnectionMetrics('test'), **limits)
+
+    async def test_low_priority_frames_coalesce_or_drop_and_messages_are_kept(self):
+        before = metrics.stats()
+        queue = await self.queue(limit=10, pressure=3)
+        queue.put({'text_data': 'm1'})
+        queue.put({'text_data': 'bob typing'}, key=('typing', 'chat', 'bob'))
+        queue.put({'text_data': 'bob stopped'}, key=('typing', 'chat', 'bob'))
+        queue.put({'text_data': 'm2'})
+        queue.put({'text_data': 'carol online'}, key=('presence', 'carol'))
+        queue.put({'text_data': 'm3'})
+        self.gate.set()
+        await queue.join()
+
+        self.assertEqual(self.sent, ['m1', 'bob stopped', 'm2', 'm3'])
+        self.assertEqual(queue.metrics.drops, {('coalesced', 'typing'): 1, ('dropped', 'presence'): 1})
+        after = metrics.stats()
+        self.assertEqual(after['coalesced'] - before['coalesced'], 1)
+        self.assertEqual(after['dropped'] - before['dropped'], 1)
+
+    async def test_overflow_closes_instead_of_dropping_messages(self):
+        queue = await self.queue(limit=2, pressure=1)
+        with self.assertLogs('whats_app.send_queue', 'WARNING'):
+            for n in range(3):
+                queue.put({'text_data': f'm{n}'})
+        await asyncio.sleep(0)
+
+        self.assertTrue(queue.closed)
+        self.assertEqual(self.overflowed, [True])
+        self.assertEqual(queue.metrics.drops, {('overflow', 'queue'): 1})
+        self.assertEqual(len(queue), 0)
+
+
+class TypingTrackerTests(SimpleTestCase):
+    def tracker(self, throttle=0.1, timeout=0.2):
+        self.broadcasts = []
+
+        async def broadcast(chat_id, is_typing):
+            self.broadcasts.append((chat_id, is_typing))
+        return TypingTracker(broadcast, throttle=throttle, timeout=timeout)
+
+    async def test_keystrokes_are_throttled(self):
+        tracker = self.tracker()
+        for _ in range(5):
+            await tracker.typing('c1', True)
+        self.assertEqual(self.broadcasts, [('c1', True)])
+
+        # Still typing after the throttle window: receivers are refreshed once
+        await asyncio.sleep(0.12)
+        await tracker.typing('c1', True)
+        await tracker.typing('c1', True)
+        self.assertEqual(self.broadcasts, [('c1', True)] * 2)
+        await tracker.stop_all()
+
+    async def test_stop_is_broadcast_once(self):
+        tracker = self.tracker()
+        await tracker.typing('c1', True)
+        await tracker.typing('c1', False)
+        await tracker.typing('c1', False)
+        self.assertEqual(self.broadcasts, [('c1', True), ('c1', False)])
+
+    async def test_silence_expires_the_indicator(self):
+        tracker = self.tracker()
+        await tracker.typing('c1', True)
+        await asyncio.sleep(0.3)
+        self.assertEqual(self.broadcasts, [('c1', True), ('c1', False)])
+
+    async def test_typing_again_pushes_the_expiry_back(self):
+        tracker = self.tracker(throttle=1, timeout=0.2)
+        await tracker.typing('c1', True)
+        for _ in range(3):
+            await asyncio.sleep(0.1)
+            await tracker.typing('c1', True)
+        # 0.3s in, but typed 0.1s ago
+        self.assertEqual(self.broadcasts, [('c1', True)])
+        await asyncio.sleep(0.25)
+        self.assertEqual(self.broadcasts, [('c1', True), ('c1', False)])
+
+    async def test_chats_are_tracked_separately(self):
+        tracker = self.tracker()
+        await tracker.typing('c1', True)
+        await tracker.typing('c2', True)
+        await tracker.typing('c1', False)
+        await tracker.stop_all()
+        self.assertEqual(self.broadcasts, [('c1', True), ('c2', True), ('c1', False), ('c2', False)])
+
+
+class ReadReceiptBatcherTests(SimpleTestCase):
+    def batcher(self, window=0.05):
+        self.flushes = []
+
+        async def flush(pending):
+            self.flushes.append(pending)
+        return receipts.ReadReceiptBatcher(flush, window=window)
+
+    async def test_burst_reduces_to_one_watermark_per_chat(self):
+        batcher = self.batcher()
+        for seq in (3, 1, 5, 4):
+            batcher.add('c1', seq)
+        batcher.add('c1', message_id='m1')
+        batcher.add('c2', 2)
+        await asyncio.sleep(0.1)
+        self.assertEqual(self.flushes, [{'c1': [5, {'m1'}], 'c2': [2, set()]}])
+
+    async def test_close_flushes_at_once(self):
+        batcher = self.batcher(window=10)
+        batcher.add('c1', 7)
+        await batcher.close()
+        self.assertEqual(self.flushes, [{'c1': [7, set()]}])
+
+
+class WireTests(SimpleTestCase):
+    frame = {
+        'type': 'chat_message',
+        'chat_id': 'c1',
+        'message': {'id': 'm1', 'seq': 7, 'sender': '+15550000001', 'content': 'héllo', 'reply_to': None,
+                    'is_edited': False, 'unlisted': [1, {'seq': 2}]},
+    }
+
+    def round_trip(self, codec, frame):
+        return codec.decode(**codec.encode(frame))
+
+    def test_every_codec_round_trips(self):
+        for codec in (wire.JSONCodec(), wire.CompactJSONCodec(), wire.MsgpackCodec()):
+            with self.subTest(codec=type(codec).__name__):
+                self.assertEqual(self.round_trip(codec, self.frame), self.frame)
+
+    def test_every_wire_field_round_trips(self):
+        self.assertEqual(len(wire.SHORT_FIELDS), len(wire.FIELDS), 'two fields share a short name')
+        frame = {name: n for n, name in enumerate(wire.FIELDS)}
+        for codec in (wire.CompactJSONCodec(), wire.MsgpackCodec()):
+            self.assertEqual(self.round_trip(codec, frame), frame)
+
+    def test_compact_encodings_use_short_names(self):
+        text = wire.CompactJSONCodec().encode(self.frame)['text_data']
+        self.assertEqual(json.loads(text)['m']['q'], 7)
+        self.assertIn('bytes_data', wire.MsgpackCodec().encode(self.frame))
+        # A msgpack client may still send text frames
+        self.assertEqual(wire.MsgpackCodec().decode(text_data=text), self.frame)
+
+    def test_negotiation_takes_the_first_supported_protocol(self):
+        cases = [
+            (None, wire.JSONCodec),
+            ([], wire.JSONCodec),
+            (['whatsapp.v9'], wire.JSONCodec),
+            (['whatsapp.v9', 'whatsapp.compact.msgpack', 'whatsapp.compact.json'], wire.MsgpackCodec),
+            (['whatsapp.compact.json', 'whatsapp.compact.msgpack'], wire.CompactJSONCodec),
+        ]
+        for subprotocols, codec in cases:
+            with self.subTest(subprotocols=subprotocols):
+                self.assertIs(type(wire.negotiate(subprotocols)), codec)
+        # Codecs remember what their connection was sent, so none are shared
+        self.assertIsNot(wire.negotiate(['whatsapp.compact.json']), wire.negotiate(['whatsapp.compact.json']))
+
+    def test_sender_profile_goes_once_per_connection(self):
+        codec = wire.CompactJSONCodec()
+        sender = {'user': '+15550000001', 'name': 'Alice', 'photo': None}
+        self.assertEqual(codec.sender_frames(sender), [{'type': 'sender', **sender}])
+        self.assertEqual(codec.sender_frames(sender), [])
+        self.assertEqual(len(codec.sender_frames({**sender, 'name': 'Alice B'})), 1)
+        self.assertEqual(wire.JSONCodec().sender_frames(sender), [])
+
+
+class LocalPresenceBackendTests(SimpleTestCase):
+    def setUp(self):
+        patch = mock.patch.object(presence.time, 'monotonic', return_value=1000.0)
+        self.clock = patch.start()
+        self.addCleanup(patch.stop)
+        self.backend = LocalPresenceBackend(ttl=10)
+
+    async def test_heartbeats_keep_a_connection_alive(self):
+        self.assertTrue(await self.backend.connect(1, 'phone'))
+        self.assertFalse(await self.backend.connect(1, 'laptop'))
+        self.clock.return_value += 8
+        await self.backend.heartbeat(1, 'phone')
+
+        self.clock.return_value += 5
+        # The laptop's connection expired, the phone's did not
+        self.assertEqual(await self.backend.expire(), [])
+        self.assertEqual(await self.backend.online_users([1]), {1})
+        self.clock.return_value += 5
+        self.assertEqual(await self.backend.expire(), [1])
+        self.assertEqual(await self.backend.online_users([1]), set())
+
+    async def test_sweep_stops_at_the_first_live_entry(self):
+        for user_pk in range(100):
+            await self.backend.connect(user_pk, 'phone')
+        self.clock.return_value += 5
+        await self.backend.connect(100, 'phone')
+        self.clock.return_value += 6
+
+        self.assertEqual(sorted(await self.backend.expire()), list(range(100)))
+        # The live connection's entry was not reached
+        self.assertEqual(self.backend._expiries, [(1005.0 + 10, 100, 'phone')])
+        self.assertEqual(await self.backend.online_users([0, 100]), {100})
+
+    async def test_disconnect_and_reconnect_leave_no_stale_expiry(self):
+        await self.backend.connect(1, 'phone')
+        self.assertTrue(await self.backend.disconnect(1, 'phone'))
+        self.clock.return_value += 5
+        await self.backend.connect(1, 'phone')
+        # The first connection's expiry comes due but no longer applies
+        self.clock.return_value += 6
+        self.assertEqual(await self.backend.expire(), [])
+        self.assertEqual(await self.backend.online_users([1]), {1})
+
+
+@local_services
+class PresenceServiceTests(TransactionTestCase):
+    # Presence writes land on the DB executor's threads, outside a test transaction
+
+    def setUp(self):
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        self.service = PresenceService(LocalPresenceBackend(ttl=60), flush_interval=0.01)
+
+    async def updates(self, user_pk):
+        """Presence events sent to a user's contacts, collected from their group"""
+        layer = get_channel_layer()
+        channel = await layer.new_channel()
+        await layer.group_add(presence_group_name(user_pk), channel)
+        return layer, channel
+
+    async def test_online_while_any_connection_is_live(self):
+        layer, channel = await self.updates(self.alice.pk)
+        await self.service.connect(self.alice.pk, 'phone')
+        await self.service.connect(self.alice.pk, 'laptop')
+        await self.service.disconnect(self.alice.pk, 'phone')
+        self.assertEqual(await self.service.online_users([self.alice.pk]), {self.alice.pk})
+
+        await self.service.disconnect(self.alice.pk, 'laptop')
+        self.assertEqual(await self.service.online_users([self.alice.pk]), set())
+
+        # Only the two transitions are announced
+        events = [await layer.receive(channel), await layer.receive(channel)]
+        self.assertEqual([event['is_online'] for event in events], [True, False])
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(layer.receive(channel), 0.05)
+
+    async def test_transitions_are_written_in_a_batch(self):
+        await self.service.connect(self.alice.pk, 'phone')
+        await self.service.flush()
+        alice = await User.objects.aget(pk=self.alice.pk)
+        self.assertTrue(alice.is_online)
+
+        await self.service.disconnect(self.alice.pk, 'phone')
+        await self.service.flush()
+        alice = await User.objects.aget(pk=self.alice.pk)
+        self.assertFalse(alice.is_online)
+
+    async def test_missed_heartbeats_go_offline(self):
+        self.service.backend.ttl = 0.05
+        await self.service.connect(self.alice.pk, 'phone')
+        await self.service.connect(self.bob.pk, 'phone')
+        await asyncio.sleep(0.1)
+
+        self.service.backend.ttl = 60
+        # Any heartbeat sweeps connections that stopped sending them
+        await self.service.heartbeat(self.bob.pk, 'phone')
+        self.assertEqual(await self.service.online_users([self.alice.pk, self.bob.pk]), {self.bob.pk})
+
+
+def decode(output):
+    """A frame sent to a WebsocketCommunicator, in any encoding, with full field names"""
+    if output.get('bytes') is not None:
+        return wire.expand(msgpack.unpackb(output['bytes']))
+    return wire.expand(json.loads(output['text']))
+
+
+@local_services
+class SocketTestCase(TransactionTestCase):
+    """Chat sockets, with presence kept in the process instead of Redis"""
+
+    def setUp(self):
+        for patch in (
+            mock.patch('whats_app.consumers.presence',
+                       PresenceService(LocalPresenceBackend(ttl=60), flush_interval=0.05)),
+            # Every closing socket logs its query counts
+            mock.patch.object(metrics.logger, 'disabled', True),
+        ):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def connect(self, path, user, subprotocols=None):
+        socket = WebsocketCommunicator(application, path, subprotocols=subprotocols)
+        socket.scope['user'] = user
+        connected, protocol = await socket.connect()
+        self.assertTrue(connected)
+        return socket, protocol
+
+    async def send(self, chat, sender, content='hello'):
+        """Send a message as the HTTP view would; the outbox drains on commit"""
+        def send():
+            return messaging.send_message(load_chat_access(chat.chat_id), sender, content)[0]
+        return await database_sync_to_async(send)()
+
+    async def frame(self, socket, frame_type):
+        """The next frame of `frame_type`, skipping others"""
+        while True:
+            frame = decode(await socket.receive_output(timeout=2))
+            if frame['type'] == frame_type:
+                return frame
+
+
+class BroadcastTests(SocketTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        self.chat = make_chat([self.alice, self.bob])
+
+    async def test_message_is_encoded_once_for_every_subprotocol(self):
+        sockets = []
+        for subprotocols, expected in ((None, None), (['whatsapp.v9'], None),
+                                       (['whatsapp.compact.json'], 'whatsapp.compact.json'),
+                                       (['whatsapp.compact.msgpack'], 'whatsapp.compact.msgpack')):
+            socket, protocol = await self.connect(f'/ws/chat/{self.chat.chat_id}/', self.bob, subprotocols)
+            self.assertEqual(protocol, expected)
+            sockets.append((socket, protocol or 'json'))
+
+        events = []
+
+        def broadcast_event(*args, **kwargs):
+            events.append(real_broadcast_event(*args, **kwargs))
+            return events[-1]
+
+        real_broadcast_event = wire.broadcast_event
+        encoders = [mock.patch.object(encoder, 'encode', wraps=encoder.encode) for encoder in wire._ENCODERS]
+        with mock.patch.object(wire, 'broadcast_event', broadcast_event):
+            spies = [patch.start() for patch in encoders]
+            try:
+                await self.send(self.chat, self.alice)
+            finally:
+                for patch in encoders:
+                    patch.stop()
+
+        event, = events
+        # One encoding per codec for the whole chat, however many sockets
+        self.assertEqual([spy.call_count for spy in spies], [1, 1, 1])
+        for socket, key in sockets:
+            received = await socket.receive_output(timeout=2)
+            if key != 'json':
+                # The compact codecs introduce the sender first
+                self.assertEqual(decode(received)['type'], 'sender')
+                received = await socket.receive_output(timeout=2)
+            frame = event['frames'][key]
+            self.assertEqual(received.get('text'), frame.get('text_data'))
+            self.assertEqual(received.get('bytes'), frame.get('bytes_data'))
+            await socket.disconnect()
+
+
+class ReadReceiptTests(SocketTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob = make_user('alice'), make_user('bob')
+        self.chat = make_chat([self.alice, self.bob])
+
+    async def read_seq(self):
+        participant = await ChatParticipant.objects.aget(chat=self.chat, user=self.bob)
+        return participant.read_seq
+
+    async def test_burst_is_one_watermark_update_that_never_goes_back(self):
+        for n in range(5):
+            await self.send(self.chat, self.alice, f'm{n}')
+        socket, _ = await self.connect(f'/ws/chat/{self.chat.chat_id}/', self.bob)
+
+        with mock.patch.object(messaging, 'mark_read', wraps=messaging.mark_read) as mark_read:
+            for seq in (1, 2, 3, 5, 4):
+                await socket.send_to(text_data=json.dumps({'type': 'read_receipt', 'read_up_to': seq}))
+            await asyncio.sleep(receipts.READ_RECEIPT_BATCH_WINDOW + 0.2)
+            self.assertEqual([call.args[3] for call in mark_read.call_args_list], [5])
+            self.assertEqual(await self.read_seq(), 5)
+
+            # A late receipt for an older message does not move it back
+            await socket.send_to(text_data=json.dumps({'type': 'read_receipt', 'read_up_to': 2}))
+            await socket.disconnect()
+        self.assertEqual(mark_read.call_count, 2)
+        self.assertEqual(await self.read_seq(), 5)
+
+
+class UserConsumerTests(SocketTestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice, self.bob, self.carol = (make_user(name) for name in ('alice', 'bob', 'carol'))
+        self.private = make_chat([self.alice, self.bob])
+        self.team = make_chat([self.alice, self.bob, self.carol], name='Team')
+
+    async def chat_message(self, socket, chat, content):
+        await socket.send_to(text_data=json.dumps({
+            'type': 'chat_message', 'chat_id': str(chat.chat_id), 'content': content, 'client_id': content,
+        }))
+
+    async def test_every_chat_is_followed(self):
+        socket, _ = await self.connect('/ws/user/', self.bob)
+        await self.send(self.private, self.alice, 'to bob')
+        await self.send(self.team, self.carol, 'to the team')
+        received = [await self.frame(socket, 'chat_message') for _ in range(2)]
+        self.assertEqual({(frame['chat_id'], frame['message']['content']) for frame in received},
+                         {(str(self.private.chat_id), 'to bob'), (str(self.team.chat_id), 'to the team')})
+        await socket.disconnect()
+
+    async def test_membership_changes_move_the_socket(self):
+        socket, _ = await self.connect('/ws/user/', self.bob)
+        chat = await database_sync_to_async(make_chat)([self.carol])
+        chat_id = str(chat.chat_id)
+
+        await database_sync_to_async(ChatParticipant.objects.create)(chat=chat, user=self.bob)
+        self.assertEqual((await self.frame(socket, 'subscribed'))['chat_id'], chat_id)
+        await self.send(chat, self.carol, 'welcome')
+        self.assertEqual((await self.frame(socket, 'chat_message'))['message']['content'], 'welcome')
+
+        await database_sync_to_async(ChatParticipant.objects.filter(chat=chat, user=self.bob).delete)()
+        self.assertEqual((await self.frame(socket, 'unsubscribed'))['chat_id'], chat_id)
+        await self.send(chat, self.carol, 'bob has gone')
+        self.assertTrue(await socket.receive_nothing(0.2))
+
+        await self.chat_message(socket, chat, 'let me back')
+        self.assertEqual((await self.frame(socket, 'error'))['error'], 'Not subscribed to this chat')
+        await socket.disconnect()
+
+    async def test_access_is_checked_again_when_it_changes(self):
+        socket, _ = await self.connect('/ws/user/', self.bob)
+        await self.chat_message(socket, self.team, 'first')
+        self.assertEqual((await self.frame(socket, 'message_ack'))['client_id'], 'first')
+
+        group = await Group.objects.aget(chat=self.team)
+        group.only_admins_can_send = True
+        await database_sync_to_async(group.save)()  # announces chat.access_changed
+        await asyncio.sleep(0.1)
+
+        await self.chat_message(socket, self.team, 'second')
+        self.assertEqual((await self.frame(socket, 'error'))['error'], 'Only admins can send messages')
+        await socket.disconnect()
+
+
+@local_services
+class AIConsumerTests(TransactionTestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.conversation = AIConversation.objects.create(user=self.alice, assistant=AIAssistant.objects.create())
+        backend = ai_service.FakeBackend(first_token_delay=0.05, token_delay=0.05, seed=1)
+        for patch in (mock.patch.object(ai_service, '_backend', backend),
+                      mock.patch.object(ai_service, 'cache', ResponseCache())):
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    async def connect(self, user=None):
+        socket = WebsocketCommunicator(application, f'/ws/ai/{self.conversation.conversation_id}/')
+        socket.scope['user'] = user or self.alice
+        connected, _ = await socket.connect()
+        return socket, connected
+
+    async def ask(self, socket, content):
+        await socket.send_to(text_data=json.dumps({'type': 'ai_message', 'content': content}))
+
+    async def frame(self, socket):
+        return json.loads(await socket.receive_from(timeout=2))
+
+    async def saved(self):
+        return [(message.is_user, message.content) async for message in
+                AIMessage.objects.filter(conversation=self.conversation).order_by('pk')]
+
+    async def test_reply_streams_then_arrives_whole(self):
+        socket, _ = await self.connect()
+        await self.ask(socket, 'hello')
+        deltas = []
+        while (frame := await self.frame(socket))['type'] == 'ai_delta':
+            deltas.append(frame['content'])
+        await socket.disconnect()
+
+        self.assertEqual(frame['type'], 'ai_message')
+        self.assertGreater(len(deltas), 1)
+        self.assertEqual(''.join(deltas), frame['content'])
+        self.assertEqual(await self.saved(), [(True, 'hello'), (False, frame['content'])])
+
+    async def test_one_reply_at_a_time(self):
+        socket, _ = await self.connect()
+        await self.ask(socket, 'hello')
+        await self.ask(socket, 'are you there?')
+        self.assertEqual((await self.frame(socket))['type'], 'error')
+        await socket.disconnect()
+
+    async def test_cancel_keeps_what_was_sent(self):
+        socket, _ = await self.connect()
+        await self.ask(socket, 'hello')
+        first = await self.frame(socket)
+        await socket.send_to(text_data=json.dumps({'type': 'ai_cancel'}))
+        # Deltas already in flight may still arrive, but no final message
+        sent = [first['content']]
+        while not await socket.receive_nothing(0.3):
+            frame = await self.frame(socket)
+            self.assertEqual(frame['type'], 'ai_delta')
+            sent.append(frame['content'])
+        await socket.disconnect()
+
+        self.assertEqual(await self.saved(), [(True, 'hello'), (False, ''.join(sent))])
+
+    async def test_disconnect_cancels_and_keeps_what_was_sent(self):
+        socket, _ = await self.connect()
+        await self.ask(socket, 'hello')
+        first = await self.frame(socket)
+        await socket.disconnect()
+
+        _, reply = await self.saved()
+        self.assertTrue(reply[1].startswith(first['content']))
+
+    async def test_other_users_conversation_is_refused(self):
+        mallory = await asyncio.to_thread(make_user, 'mallory')
+        socket, connected = await self.connect(mallory)
+        self.assertFalse(connected)
@@ -0,0 +1,390 @@
+from io import StringIO
+from unittest import mock
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase
+from whats_app import history, inbox, messaging, outbox, receipts, search
+from whats_app.access import load_chat_access
+from whats_app.models import Chat, ChatParticipant, Group, InboxEntry, Message, OutboxEvent, User
+from . import local_services
+
+
+def make_user(name):
+    return User.objects.create(username=name, phone_number=f'+1555{User.objects.count():07d}')
+
+
+def make_chat(users, name=None):
+    """A group chat when named, otherwise a private one"""
+    chat = Chat.objects.create(chat_type='group' if name else 'private')
+    if name:
+        Group.objects.create(chat=chat, name=name, created_by=users[0])
+    for user in users:
+        ChatParticipant.objects.create(chat=chat, user=user)
+    return chat
+
+
+@local_services
+class MessagingTestCase(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice, self.bob, self.carol = (make_user(name) for name in ('alice', 'bob', 'carol'))
+
+    def send(self, chat, sender, content='hello', **kwargs):
+        message, _ = messaging.send_message(load_chat_access(chat.chat_id), sender, content, **kwargs)
+        return message
+
+
+class InboxTests(MessagingTestCase):
+    def test_participants_get_an_entry(self):
+        chat = make_chat([self.alice, self.bob], name='Team')
+        entries = InboxEntry.objects.filter(chat=chat)
+        self.assertEqual({entry.user_id for entry in entries}, {self.alice.pk, self.bob.pk})
+        self.assertEqual({entry.name for entry in entries}, {'Team'})
+
+    def test_new_message_moves_chat_to_the_top(self):
+        older = make_chat([self.alice, self.bob])
+        newer = make_chat([self.alice, self.carol])
+        self.send(newer, self.carol)
+        self.send(older, self.bob, 'latest')
+
+        chat_list = list(InboxEntry.objects.filter(user=self.alice).order_by('-last_activity_at'))
+        self.assertEqual([entry.chat_id for entry in chat_list], [older.pk, newer.pk])
+        self.assertEqual(chat_list[0].last_message_preview, 'latest')
+        self.assertEqual(chat_list[0].last_message_sender_id, self.bob.pk)
+
+    def test_leaving_removes_the_entry(self):
+        chat = make_chat([self.alice, self.bob, self.carol], name='Team')
+        ChatParticipant.objects.get(chat=chat, user=self.carol).delete()
+        self.assertFalse(InboxEntry.objects.filter(chat=chat, user=self.carol).exists())
+
+
+class UnreadCounterTests(MessagingTestCase):
+    def assertUnread(self, user, chat, count, messages, chats):
+        user.refresh_from_db()
+        self.assertEqual(InboxEntry.objects.get(user=user, chat=chat).unread_count, count)
+        self.assertEqual((user.unread_messages, user.unread_chats), (messages, chats))
+
+    def read(self, chat, user, seq):
+        messaging.mark_read(chat.pk, chat.chat_id, user, seq)
+
+    def test_counters_follow_sends_and_reads(self):
+        group = make_chat([self.alice, self.bob, self.carol], name='Team')
+        private = make_chat([self.carol, self.bob])
+        for _ in range(3):
+            last = self.send(group, self.alice)
+        self.send(private, self.carol)
+
+        self.assertUnread(self.bob, group, 3, messages=4, chats=2)
+        self.assertUnread(self.alice, group, 0, messages=0, chats=0)
+
+        self.read(group, self.bob, last.seq - 1)
+        self.assertUnread(self.bob, group, 1, messages=2, chats=2)
+        self.read(group, self.bob, last.seq)
+        self.assertUnread(self.bob, group, 0, messages=1, chats=1)
+
+    def test_counters_match_a_recount(self):
+        group = make_chat([self.alice, self.bob, self.carol], name='Team')
+        for sender in (self.alice, self.bob, self.carol, self.alice):
+            message = self.send(group, sender)
+        self.read(group, self.carol, message.seq - 1)
+
+        for user in (self.alice, self.bob, self.carol):
+            self.assertEqual(inbox.reconcile_unread(user.pk), (0, False))
+
+    def test_reconcile_repairs_drift(self):
+        group = make_chat([self.alice, self.bob], name='Team')
+        self.send(group, self.alice)
+        InboxEntry.objects.filter(user=self.bob).update(unread_count=7)
+        User.objects.filter(pk=self.bob.pk).update(unread_messages=0)
+
+        self.assertEqual(inbox.reconcile_unread(self.bob.pk), (1, True))
+        self.assertUnread(self.bob, group, 1, messages=1, chats=1)
+
+
+class ClientIdTests(MessagingTestCase):
+    def send_with_id(self, chat, client_id='retry-1'):
+        # The id is cached on commit
+        with self.captureOnCommitCallbacks(execute=True):
+            return messaging.send_message(load_chat_access(chat.chat_id), self.alice, 'hi', client_id=client_id)
+
+    def test_retry_returns_the_original(self):
+        chat = make_chat([self.alice, self.bob])
+        original, created = self.send_with_id(chat)
+        again, created_again = self.send_with_id(chat)
+
+        self.assertEqual((created, created_again), (True, False))
+        self.assertEqual(again.message_id, original.message_id)
+        self.assertEqual(Message.objects.filter(chat=chat).count(), 1)
+
+    def test_retry_after_the_cache_expired(self):
+        chat = make_chat([self.alice, self.bob])
+        original, _ = self.send_with_id(chat)
+        cache.clear()
+
+        again, created = self.send_with_id(chat)
+        self.assertFalse(created)
+        self.assertEqual(again.pk, original.pk)
+
+    def test_reused_in_another_chat_is_rejected(self):
+        first = make_chat([self.alice, self.bob])
+        second = make_chat([self.alice, self.carol])
+        self.send_with_id(first)
+
+        for clear in (False, True):
+            if clear:
+                cache.clear()
+            with self.assertRaises(messaging.MessageRejected):
+                self.send_with_id(second)
+        self.assertFalse(Message.objects.filter(chat=second).exists())
+
+    def test_retry_is_authorized(self):
+        chat = make_chat([self.alice, self.bob, self.carol], name='Team')
+        self.send_with_id(chat)
+        ChatParticipant.objects.get(chat=chat, user=self.alice).delete()
+
+        with self.assertRaisesMessage(messaging.MessageRejected, 'not a participant'):
+            self.send_with_id(chat)
+
+
+class SequenceTests(MessagingTestCase):
+    def test_seq_counts_up_per_chat(self):
+        first = make_chat([self.alice, self.bob])
+        second = make_chat([self.alice, self.carol])
+        seqs = [self.send(first, self.alice).seq, self.send(second, self.alice).seq,
+                self.send(first, self.bob).seq, self.send(first, self.alice).seq]
+        self.assertEqual(seqs, [1, 1, 2, 3])
+
+    def test_gap_fill_returns_what_was_missed_in_order(self):
+        chat = make_chat([self.alice, self.bob])
+        for i in range(5):
+            self.send(chat, self.alice, f'm{i}')
+
+        messages, has_more = history.fetch_after_seq(chat.pk, 2, limit=2)
+        self.assertEqual([message.content for message in messages], ['m2', 'm3'])
+        self.assertTrue(has_more)
+        messages, has_more = history.fetch_after_seq(chat.pk, 4)
+        self.assertEqual([message.seq for message in messages], [5])
+        self.assertFalse(has_more)
+
+
+@local_services
+class OutboxTests(TestCase):
+    def listen(self, group):
+        """A channel in `group`, and a function returning what it received"""
+        layer = get_channel_layer()
+        channel = async_to_sync(layer.new_channel)()
+        async_to_sync(layer.group_add)(group, channel)
+
+        def received(count):
+            return [async_to_sync(layer.receive)(channel) for _ in range(count)]
+        return received
+
+    def event(self, n):
+        return {'type': 'chat.message', 'n': n}
+
+    def test_event_is_written_with_the_change(self):
+        with transaction.atomic():
+            outbox.enqueue('chat_a', self.event(1))
+        with self.assertRaises(RuntimeError):
+            with transaction.atomic():
+                outbox.enqueue('chat_a', self.event(2))
+                self.assertEqual(OutboxEvent.objects.count(), 2)
+                raise RuntimeError
+        # The rolled back write took its event with it
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+    def test_drain_runs_once_after_commit(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            for n in range(3):
+                outbox.enqueue('chat_a', self.event(n))
+        self.assertEqual(callbacks, [outbox.drain])
+
+    def test_relay_keeps_each_chats_order(self):
+        a, b = self.listen('chat_a'), self.listen('chat_b')
+        for group, n in (('chat_a', 1), ('chat_b', 2), ('chat_a', 3), ('chat_a', 4), ('chat_b', 5)):
+            outbox.enqueue(group, self.event(n))
+
+        self.assertEqual(outbox.relay_batch(), 5)
+        first, batch = a(2)
+        self.assertEqual(first, self.event(1))
+        self.assertEqual(batch, {'type': 'outbox.batch', 'events': [self.event(3), self.event(4)]})
+        self.assertEqual(b(2), [self.event(2), self.event(5)])
+        self.assertFalse(OutboxEvent.objects.exists())
+
+    def test_failed_send_keeps_the_events(self):
+        outbox.enqueue('chat_a', self.event(1))
+        layer = get_channel_layer()
+        with mock.patch.object(layer, 'group_send', side_effect=ConnectionError):
+            with self.assertRaises(ConnectionError):
+                outbox.relay_batch()
+            # A drain after commit logs the failure instead of raising
+            with self.assertLogs('whats_app.outbox', 'ERROR'):
+                self.assertEqual(outbox.drain(), 0)
+        self.assertEqual(OutboxEvent.objects.count(), 1)
+
+        received = self.listen('chat_a')
+        self.assertEqual(outbox.drain(), 1)
+        self.assertEqual(received(1), [self.event(1)])
+
+    def test_coalesce_merges_only_consecutive_events(self):
+        sends = outbox.coalesce([
+            ('a', self.event(1)), ('a', self.event(2)), ('b', self.event(3)),
+            ('a', self.event(4)), ('a', self.event(5)), ('a', self.event(6)),
+        ])
+        self.assertEqual(sends, [
+            ('a', {'type': 'outbox.batch', 'events': [self.event(1), self.event(2)]}),
+            ('b', self.event(3)),
+            ('a', {'type': 'outbox.batch', 'events': [self.event(4), self.event(5), self.event(6)]}),
+        ])
+
+    def test_relay_command_delivers_what_was_left_behind(self):
+        # Written by a process that died before its after-commit drain
+        for n in range(3):
+            outbox.enqueue('chat_a', self.event(n))
+        received = self.listen('chat_a')
+
+        call_command('outbox_relay', '--once', '--batch-size', '2')
+        self.assertFalse(OutboxEvent.objects.exists())
+        first, second = received(2)
+        self.assertEqual(first, {'type': 'outbox.batch', 'events': [self.event(0), self.event(1)]})
+        self.assertEqual(second, self.event(2))
+
+
+class SearchTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.chat = make_chat([self.alice, self.bob])
+
+    def found(self, user, query):
+        return [result['snippet'] for result in search.search_messages(user, query)]
+
+    def test_index_follows_edits_and_deletes(self):
+        message = self.send(self.chat, self.alice, 'lunch at noon')
+        self.assertEqual(self.found(self.bob, 'lunch'), ['<mark>lunch</mark> at noon'])
+
+        messaging.edit_message(message, 'dinner at eight')
+        self.assertEqual(self.found(self.bob, 'lunch'), [])
+        self.assertEqual(self.found(self.bob, 'dinner'), ['<mark>dinner</mark> at eight'])
+
+        messaging.delete_message(message, self.alice)
+        self.assertEqual(self.found(self.bob, 'dinner'), [])
+
+    def test_only_the_users_chats_are_searched(self):
+        self.send(self.chat, self.alice, 'secret plan')
+        self.send(make_chat([self.carol, self.bob]), self.carol, 'another secret')
+        self.assertEqual(len(self.found(self.bob, 'secret')), 2)
+        self.assertEqual(self.found(self.alice, 'secret'), ['<mark>secret</mark> plan'])
+        self.assertEqual(self.found(self.carol, 'plan'), [])
+
+    def test_snippet_is_escaped(self):
+        self.send(self.chat, self.alice, '<img src=x onerror=alert(1)> hello')
+        snippet, = self.found(self.bob, 'hello')
+        self.assertNotIn('<img', snippet)
+        self.assertIn('&lt;img', snippet)
+        self.assertIn('<mark>hello</mark>', snippet)
+
+    def test_last_word_is_a_prefix(self):
+        self.send(self.chat, self.alice, 'see you tomorrow')
+        self.assertEqual(len(self.found(self.bob, 'see tom')), 1)
+        # A single trailing letter is ignored rather than matching everything
+        self.assertEqual(len(self.found(self.bob, 'see t')), 1)
+
+    def test_empty_and_too_short_queries_find_nothing(self):
+        self.send(self.chat, self.alice, 'a b c')
+        for query in ('', '   ', '?!', 'a'):
+            self.assertEqual(self.found(self.bob, query), [])
+
+
+class ReceiptTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.chat = make_chat([self.alice, self.bob, self.carol], name='Team')
+
+    def watermarks(self, user):
+        return ChatParticipant.objects.values_list('delivered_seq', 'read_seq').get(chat=self.chat, user=user)
+
+    def test_watermarks_only_move_forward(self):
+        for _ in range(5):
+            self.send(self.chat, self.alice)
+        self.assertTrue(receipts.mark_read(self.chat.pk, self.bob.pk, 4))
+        self.assertEqual(self.watermarks(self.bob), (4, 4))
+
+        self.assertFalse(receipts.mark_read(self.chat.pk, self.bob.pk, 2))
+        self.assertFalse(receipts.mark_delivered(self.chat.pk, self.bob.pk, 3))
+        self.assertEqual(self.watermarks(self.bob), (4, 4))
+
+        self.assertTrue(receipts.mark_delivered(self.chat.pk, self.bob.pk, 5))
+        self.assertEqual(self.watermarks(self.bob), (5, 4))
+
+    def test_message_status_comes_from_the_watermarks(self):
+        first, second = self.send(self.chat, self.alice), self.send(self.chat, self.alice)
+
+        def status(message):
+            return receipts.status_for_seq(self.chat.pk, self.alice.pk, message.seq)
+
+        def who(message):
+            return {state: sorted(user.username for user in users)
+                    for state, users in receipts.receipts_for(message).items()}
+
+        self.assertEqual((status(first), status(second)), ('sent', 'sent'))
+        receipts.mark_delivered_to_chat(self.chat.pk, self.alice.pk, second.seq)
+        self.assertEqual((status(first), status(second)), ('delivered', 'delivered'))
+
+        receipts.mark_read(self.chat.pk, self.bob.pk, second.seq)
+        receipts.mark_read(self.chat.pk, self.carol.pk, first.seq)
+        # 'read' only once every recipient has read it
+        self.assertEqual((status(first), status(second)), ('read', 'delivered'))
+        self.assertEqual(who(first), {'read': ['bob', 'carol'], 'delivered': [], 'sent': []})
+        self.assertEqual(who(second), {'read': ['bob'], 'delivered': ['carol'], 'sent': []})
+
+    def test_chat_without_recipients_is_sent(self):
+        alone = make_chat([self.alice])
+        message = self.send(alone, self.alice)
+        self.assertEqual(receipts.status_for_seq(alone.pk, self.alice.pk, message.seq), 'sent')
+
+
+class HistoryTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.chat = make_chat([self.alice, self.bob])
+        self.sent = [self.send(self.chat, self.alice, f'm{n}') for n in range(7)]
+
+    def walk_back(self, limit):
+        """Every page from the newest back, as lists of contents"""
+        pages = []
+        before = None
+        while True:
+            messages, has_more = history.fetch_page(self.chat, before=before, limit=limit)
+            pages.append([message.content for message in messages])
+            if not has_more:
+                return pages
+            before = history.resolve_cursor(self.chat, messages[0].message_id)
+
+    def test_pages_walk_back_without_gaps_or_repeats(self):
+        self.assertEqual(self.walk_back(3), [['m4', 'm5', 'm6'], ['m1', 'm2', 'm3'], ['m0']])
+
+    def test_messages_sent_in_the_same_instant_are_ordered_by_id(self):
+        # created_at ties are broken by id, so a page boundary inside a tie loses nothing
+        Message.objects.filter(chat=self.chat).update(created_at=self.sent[0].created_at)
+        self.assertEqual(self.walk_back(2), [['m5', 'm6'], ['m3', 'm4'], ['m1', 'm2'], ['m0']])
+
+    def test_after_cursor_reads_forward(self):
+        after = history.resolve_cursor(self.chat, self.sent[2].message_id)
+        messages, has_more = history.fetch_page(self.chat, after=after, limit=3)
+        self.assertEqual([message.content for message in messages], ['m3', 'm4', 'm5'])
+        self.assertTrue(has_more)
+
+    def test_cursor_from_another_chat_is_unknown(self):
+        other = make_chat([self.alice, self.carol])
+        self.assertIsNone(history.resolve_cursor(other, self.sent[0].message_id))
+
+
+class QueryPlanTests(TestCase):
+    def test_hot_queries_use_their_indexes(self):
+        # check_query_plans raises CommandError when a plan misses its index
+        out = StringIO()
+        call_command('check_query_plans', stdout=out)
+        self.assertNotIn('FAIL', out.getvalue())
@@ -0,0 +1,97 @@
+import json
+import uuid
+from django.core.cache import cache
+from django.test import TestCase
+from whats_app import receipts
+from whats_app.models import ChatParticipant
+from . import local_services
+from .test_models import MessagingTestCase, make_chat, make_user
+
+
+@local_services
+class SendMessageViewTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.alice, self.bob, self.carol = (make_user(name) for name in ('alice', 'bob', 'carol'))
+        self.chat = make_chat([self.alice, self.bob, self.carol], name='Team')
+        self.client.force_login(self.carol)
+
+    def post(self, chat_id):
+        return self.client.post('/api/send-message/', json.dumps({'chat_id': chat_id, 'content': 'hi'}),
+                                content_type='application/json')
+
+    def test_removed_member_is_refused_however_the_id_is_spelled(self):
+        chat_id = str(self.chat.chat_id)
+        for spelling in (chat_id, chat_id.upper()):
+            self.assertTrue(self.post(spelling).json()['success'])
+
+        ChatParticipant.objects.get(chat=self.chat, user=self.carol).delete()
+        for spelling in (chat_id, chat_id.upper(), chat_id.replace('-', '')):
+            self.assertFalse(self.post(spelling).json()['success'])
+
+    def test_unknown_chat(self):
+        self.assertEqual(self.post('not-a-uuid').status_code, 404)
+
+
+@local_services
+class SearchViewTests(TestCase):
+    def setUp(self):
+        self.alice = make_user('alice')
+        self.client.force_login(self.alice)
+
+    def test_empty_query(self):
+        response = self.client.get('/api/search/messages/', {'q': ' '})
+        self.assertEqual(response.json(), {'success': True, 'results': []})
+
+    def test_invalid_limit(self):
+        response = self.client.get('/api/search/messages/', {'q': 'hello', 'limit': 'many'})
+        self.assertEqual(response.status_code, 400)
+
+
+class MessageHistoryViewTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        self.chat = make_chat([self.alice, self.bob])
+        self.sent = [self.send(self.chat, self.alice, f'm{n}') for n in range(5)]
+        self.client.force_login(self.bob)
+
+    def get(self, **params):
+        return self.client.get(f'/api/chat/{self.chat.chat_id}/messages/', params)
+
+    def test_pages_back_from_the_newest(self):
+        page = self.get(limit=3).json()
+        self.assertEqual([message['content'] for message in page['messages']], ['m2', 'm3', 'm4'])
+        self.assertTrue(page['has_more'])
+
+        page = self.get(limit=3, before=page['messages'][0]['id']).json()
+        self.assertEqual([message['content'] for message in page['messages']], ['m0', 'm1'])
+        self.assertFalse(page['has_more'])
+
+    def test_bad_cursors(self):
+        self.assertEqual(self.get(before='nonsense').status_code, 400)
+        self.assertEqual(self.get(after=str(uuid.uuid4())).status_code, 400)
+
+    def test_outsiders_get_nothing(self):
+        self.client.force_login(self.carol)
+        self.assertEqual(self.get().status_code, 404)
+
+
+class MessageReceiptsViewTests(MessagingTestCase):
+    def setUp(self):
+        super().setUp()
+        chat = make_chat([self.alice, self.bob, self.carol], name='Team')
+        self.message = self.send(chat, self.alice)
+        receipts.mark_read(chat.pk, self.bob.pk, self.message.seq)
+
+    def get(self):
+        return self.client.get(f'/api/message-receipts/{self.message.message_id}/')
+
+    def test_sender_sees_who_read_it(self):
+        self.client.force_login(self.alice)
+        self.assertEqual(self.get().json()['receipts'], {
+            'read': [self.bob.phone_number], 'delivered': [], 'sent': [self.carol.phone_number],
+        })
+
+    def test_only_the_sender_may_ask(self):
+        self.client.force_login(self.bob)
+        self.assertEqual(self.get().status_code, 404)
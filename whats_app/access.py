@@ -0,0 +1,98 @@
+# access.py - Cached chat membership and send permissions
+#
+# Authorizing a message needs the chat's pk and type, who participates, who
+# administers it and whether only admins may send. ChatAccess snapshots all
+# of that so the check itself runs no queries. Snapshots live in the Django
+# cache for views and on each socket for consumers; signals delete the
+# cached copy and tell subscribed sockets to drop theirs whenever
+# participants, admins or group settings change.
+import uuid
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from .models import Chat, ChatParticipant, GroupAdmin
+from . import outbox, realtime
+
+CHAT_ACCESS_TTL = getattr(settings, 'CHAT_ACCESS_TTL', 300)
+
+
+class ChatAccess:
+    """Membership and permission snapshot of one chat"""
+
+    def __init__(self, chat_pk, chat_id, chat_type, participants, admins, only_admins_can_send):
+        self.chat_pk = chat_pk
+        self.chat_id = chat_id
+        self.chat_type = chat_type
+        self.participants = participants
+        self.admins = admins
+        self.only_admins_can_send = only_admins_can_send
+
+    def is_member(self, user_pk):
+        return user_pk in self.participants
+
+    def send_error(self, user_pk):
+        """Why user_pk may not send here, or None if they may"""
+        if not self.is_member(user_pk):
+            return 'You are not a participant of this chat'
+        if self.only_admins_can_send and user_pk not in self.admins:
+            return 'Only admins can send messages'
+        return None
+
+
+def _cache_key(chat_id):
+    return f'chat_access:{chat_id}'
+
+
+def load_chat_access(chat_id):
+    """Build a ChatAccess from the database, or None for an unknown chat"""
+    try:
+        chat = Chat.objects.filter(chat_id=chat_id).values(
+            'pk', 'chat_id', 'chat_type', 'group__pk', 'group__only_admins_can_send'
+        ).first()
+    except ValidationError:
+        return None
+    if chat is None:
+        return None
+
+    admins = set()
+    if chat['group__pk'] is not None:
+        admins = set(GroupAdmin.objects.filter(group_id=chat['group__pk']).values_list('user_id', flat=True))
+
+    return ChatAccess(
+        chat_pk=chat['pk'],
+        chat_id=str(chat['chat_id']),
+        chat_type=chat['chat_type'],
+        participants=set(ChatParticipant.objects.filter(chat_id=chat['pk']).values_list('user_id', flat=True)),
+        admins=admins,
+        only_admins_can_send=bool(chat['group__only_admins_can_send']),
+    )
+
+
+def get_chat_access(chat_id):
+    """Cached ChatAccess for a chat UUID, or None for an unknown chat"""
+    # One key per chat however the client spelled the UUID, so
+    # invalidate_chat_access() reaches every cached copy
+    try:
+        chat_id = str(uuid.UUID(str(chat_id)))
+    except ValueError:
+        return None
+    key = _cache_key(chat_id)
+    access = cache.get(key)
+    if access is None:
+        access = load_chat_access(chat_id)
+        if access is not None:
+            cache.set(key, access, CHAT_ACCESS_TTL)
+    return access
+
+
+def invalidate_chat_access(chat_id):
+    """Drop every cached snapshot of a chat once the change commits"""
+    chat_id = str(chat_id)
+    # Again on commit, in case a reader cached the old state meanwhile
+    cache.delete(_cache_key(chat_id))
+    transaction.on_commit(lambda: cache.delete(_cache_key(chat_id)))
+    outbox.enqueue(realtime.chat_group_name(chat_id), {
+        'type': 'chat.access_changed',
+        'chat_id': chat_id,
+    })
@@ -0,0 +1,259 @@
+# ai_admission.py - How many AI requests a process lets through at once
+#
+# Every backend request passes the AdmissionController first. At most
+# AI_MAX_CONCURRENT run at a time, and a user holds at most
+# AI_MAX_CONCURRENT_PER_USER running or waiting. Over the first limit,
+# requests wait in a priority queue (interactive replies ahead of background
+# work such as summaries). That queue is bounded: when it holds
+# AI_QUEUE_LIMIT requests, or a user is at their limit, or a request has
+# waited AI_QUEUE_TIMEOUT seconds, the request fails at once with Overloaded
+# and a retry_after hint instead of tying up a worker.
+#
+# An admitted request has AI_REQUEST_TIMEOUT seconds in total (queueing
+# included) and AI_FIRST_TOKEN_TIMEOUT seconds to start answering. Transient
+# failures before the first token (rate limits, connection errors, 5xx,
+# first-token timeouts) are retried up to AI_RETRIES times with full-jitter
+# exponential backoff while the deadline allows; once text has been sent a
+# failure is final, since a retry would repeat it.
+#
+# The controller is thread safe, because the blocking HTTP fallback runs
+# requests on other threads' event loops.
+import asyncio
+import collections
+import contextlib
+import heapq
+import itertools
+import random
+import threading
+import time
+from django.conf import settings
+
+AI_MAX_CONCURRENT = getattr(settings, 'AI_MAX_CONCURRENT', 8)
+AI_MAX_CONCURRENT_PER_USER = getattr(settings, 'AI_MAX_CONCURRENT_PER_USER', 2)
+AI_QUEUE_LIMIT = getattr(settings, 'AI_QUEUE_LIMIT', 32)
+AI_QUEUE_TIMEOUT = getattr(settings, 'AI_QUEUE_TIMEOUT', 10)
+AI_REQUEST_TIMEOUT = getattr(settings, 'AI_REQUEST_TIMEOUT', 60)
+AI_FIRST_TOKEN_TIMEOUT = getattr(settings, 'AI_FIRST_TOKEN_TIMEOUT', 20)
+AI_RETRIES = getattr(settings, 'AI_RETRIES', 2)
+AI_RETRY_BASE_DELAY = getattr(settings, 'AI_RETRY_BASE_DELAY', 0.5)
+AI_RETRY_MAX_DELAY = getattr(settings, 'AI_RETRY_MAX_DELAY', 4)
+
+# Queue priorities, lowest first
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class Overloaded(Exception):
+    """Refused without calling the backend; try again after retry_after seconds"""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f'AI assistant overloaded ({reason})')
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TransientError(Exception):
+    """A backend failure worth retrying"""
+
+
+class _Waiter:
+    def __init__(self, user_pk):
+        self.user_pk = user_pk
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.state = 'waiting'  # 'granted' or 'abandoned' once decided
+
+
+def _grant(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class AdmissionController:
+    """Global and per-user concurrency caps with a bounded priority wait queue"""
+
+    def __init__(self, limit=AI_MAX_CONCURRENT, per_user=AI_MAX_CONCURRENT_PER_USER,
+                 queue_limit=AI_QUEUE_LIMIT, queue_timeout=AI_QUEUE_TIMEOUT):
+        self.limit = limit
+        self.per_user = per_user
+        self.queue_limit = queue_limit
+        self.queue_timeout = queue_timeout
+        self._lock = threading.Lock()
+        self._queue = []  # heap of (priority, arrival, _Waiter); abandoned waiters are skipped
+        self._arrivals = itertools.count()
+        self._load = collections.Counter()  # user pk -> requests running or waiting
+        self.running = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = collections.Counter()  # reason -> count
+        self.retries = 0
+        self.failures = 0
+        self.duration = 5.0  # moving average of seconds a slot is held
+        self.wait_max = 0.0
+
+    def retry_after(self):
+        """Rough seconds until the queue ahead of a new request has drained"""
+        return max(1, round(self.duration * (self.queued + 1) / self.limit))
+
+    def _reject(self, reason):
+        self.rejected[reason] += 1
+        return Overloaded(reason, self.retry_after())
+
+    async def acquire(self, user_pk, priority=INTERACTIVE, deadline=None):
+        """Wait for a slot; raises Overloaded if refused or not granted in time"""
+        with self._lock:
+            if user_pk is not None and self._load[user_pk] >= self.per_user:
+                raise self._reject('user_limit')
+            if self.running < self.limit and not self.queued:
+                self._start(user_pk)
+                return
+            if self.queued >= self.queue_limit:
+                raise self._reject('queue_full')
+            waiter = _Waiter(user_pk)
+            heapq.heappush(self._queue, (priority, next(self._arrivals), waiter))
+            self.queued += 1
+            if user_pk is not None:
+                self._load[user_pk] += 1
+
+        timeout = self.queue_timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline - time.monotonic())
+        waited = time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), max(timeout, 0))
+        except BaseException as error:
+            with self._lock:
+                if waiter.state == 'waiting':
+                    waiter.state = 'abandoned'
+                    self.queued -= 1
+                    self._unload(user_pk)
+                    granted = False
+                else:
+                    granted = True
+            if granted:
+                # The slot came through as we gave up on it
+                self.release(user_pk)
+            if isinstance(error, asyncio.TimeoutError):
+                with self._lock:
+                    raise self._reject('queue_timeout') from None
+            raise
+        self.wait_max = max(self.wait_max, time.monotonic() - waited)
+
+    def release(self, user_pk, held=None):
+        with self._lock:
+            self.running -= 1
+            self._unload(user_pk)
+            if held is not None:
+                self.duration += (held - self.duration) * 0.1
+            while self._queue and self.running < self.limit:
+                _, _, waiter = heapq.heappop(self._queue)
+                if waiter.state != 'waiting':
+                    continue
+                waiter.state = 'granted'
+                self.queued -= 1
+                self.running += 1
+                self.admitted += 1
+                waiter.loop.call_soon_threadsafe(_grant, waiter.future)
+
+    def _start(self, user_pk):
+        self.running += 1
+        self.admitted += 1
+        if user_pk is not None:
+            self._load[user_pk] += 1
+
+    def _unload(self, user_pk):
+        if user_pk is None:
+            return
+        self._load[user_pk] -= 1
+        if not self._load[user_pk]:
+            del self._load[user_pk]
+
+    @contextlib.asynccontextmanager
+    async def slot(self, user_pk, priority=INTERACTIVE, deadline=None):
+        await self.acquire(user_pk, priority, deadline)
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.release(user_pk, time.monotonic() - started)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limit': self.limit,
+                'per_user': self.per_user,
+                'running': self.running,
+                'queued': self.queued,
+                'queue_limit': self.queue_limit,
+                'admitted': self.admitted,
+                'rejected': dict(self.rejected),
+                'retries': self.retries,
+                'failures': self.failures,
+                'mean_seconds': round(self.duration, 3),
+                'wait_max_seconds': round(self.wait_max, 3),
+            }
+
+
+controller = AdmissionController()
+
+
+def is_transient(error, backend):
+    return isinstance(error, (TransientError, asyncio.TimeoutError, *getattr(backend, 'transient_errors', ())))
+
+
+async def _within(stream, deadline, first_token_timeout):
+    """`stream` cut off at the deadline, or if the first text takes too long"""
+    first = True
+    try:
+        while True:
+            timeout = deadline - time.monotonic()
+            if first:
+                timeout = min(timeout, first_token_timeout)
+            if timeout <= 0:
+                raise asyncio.TimeoutError
+            try:
+                text = await asyncio.wait_for(stream.__anext__(), timeout)
+            except StopAsyncIteration:
+                return
+            first = False
+            yield text
+    finally:
+        await stream.aclose()
+
+
+class GuardedBackend:
+    """A backend whose requests go through the admission controller and retry policy"""
+
+    def __init__(self, backend, user_pk=None, priority=INTERACTIVE, controller=controller):
+        self.backend = backend
+        self.user_pk = user_pk
+        self.priority = priority
+        self.controller = controller
+
+    async def stream(self, messages, system, max_tokens=None):
+        deadline = time.monotonic() + AI_REQUEST_TIMEOUT
+        async with self.controller.slot(self.user_pk, self.priority, deadline):
+            for attempt in itertools.count():
+                started = False
+                try:
+                    async for text in _within(self.backend.stream(messages, system, max_tokens=max_tokens),
+                                              deadline, AI_FIRST_TOKEN_TIMEOUT):
+                        started = True
+                        yield text
+                    return
+                except Exception as error:
+                    delay = random.uniform(0, min(AI_RETRY_MAX_DELAY, AI_RETRY_BASE_DELAY * 2 ** attempt))
+                    if (started or attempt >= AI_RETRIES or not is_transient(error, self.backend)
+                            or time.monotonic() + delay >= deadline):
+                        self.controller.failures += 1
+                        raise
+                self.controller.retries += 1
+                await asyncio.sleep(delay)
+
+
+def guard(backend, user_pk=None, priority=INTERACTIVE):
+    return GuardedBackend(backend, user_pk, priority)
+
+
+def stats():
+    return controller.stats()
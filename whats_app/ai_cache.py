@@ -0,0 +1,213 @@
+# ai_cache.py - Shared AI replies for identical prompts
+#
+# Many prompts repeat across users: greetings, "tell me a joke", the first
+# message after a boredom suggestion. ResponseCache keys a prompt on the
+# normalized text being answered plus a fingerprint of everything else the
+# model sees (system prompt with any summary, earlier messages), so a reply
+# is only reused where the model would have been asked the same thing.
+#
+#   cached    a finished reply younger than AI_CACHE_TTL is replayed at once;
+#             the AI_CACHE_SIZE most recently used replies are kept
+#   in flight a prompt already being generated in this process is not sent
+#             again: the new caller follows the same stream from its start
+#
+# Generation runs in its own task and every caller, the first included,
+# follows it, so one caller cancelling (ai_cancel, socket closed) does not
+# cut the reply short for the others; it is abandoned only when nobody is
+# left following. Failed or abandoned replies are never cached. Prompts
+# longer than AI_CACHE_MAX_PROMPT characters are unlikely to repeat and go
+# straight to the backend.
+#
+# The cache lives in process memory rather than the Django cache: coalescing
+# needs the in-flight stream itself, and a hit costs no round trip.
+import asyncio
+import collections
+import hashlib
+import json
+import re
+import threading
+import time
+from django.conf import settings
+
+AI_CACHE_SIZE = getattr(settings, 'AI_CACHE_SIZE', 1000)
+AI_CACHE_TTL = getattr(settings, 'AI_CACHE_TTL', 600)
+AI_CACHE_MAX_PROMPT = getattr(settings, 'AI_CACHE_MAX_PROMPT', 200)
+
+_PUNCTUATION = re.compile(r'[^\w\s]')
+
+
+def normalize(text):
+    """Case, punctuation and spacing folded away: 'Tell me a joke!' == 'tell me a  joke'"""
+    return ' '.join(_PUNCTUATION.sub(' ', text.lower()).split())
+
+
+class _Flight:
+    """A reply being generated, with the text streamed so far"""
+
+    def __init__(self):
+        self.chunks = []
+        self.finished = False
+        self.error = None
+        self.followers = 0
+        self.started = time.monotonic()
+        self.loop = asyncio.get_running_loop()
+        self.task = None
+        self._changed = asyncio.Event()
+
+    def push(self, text):
+        self.chunks.append(text)
+        self._notify()
+
+    def finish(self, error=None):
+        self.finished = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def follow(self):
+        sent = 0
+        while True:
+            changed = self._changed
+            while sent < len(self.chunks):
+                yield self.chunks[sent]
+                sent += 1
+            if self.finished:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class ResponseCache:
+    """LRU cache of finished replies plus the replies in flight, keyed by prompt"""
+
+    def __init__(self, size=AI_CACHE_SIZE, ttl=AI_CACHE_TTL, max_prompt=AI_CACHE_MAX_PROMPT):
+        self.size = size
+        self.ttl = ttl
+        self.max_prompt = max_prompt
+        self._lock = threading.Lock()  # the HTTP views reach the cache from worker threads
+        self._entries = collections.OrderedDict()  # key -> (expires_at, text, seconds it took)
+        self._flights = {}  # key -> _Flight
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.uncacheable = 0
+        self.evictions = 0
+        self.seconds_saved = 0.0
+
+    def key(self, messages, system):
+        """Cache key for a prompt, or None if it should not be cached"""
+        if not messages or len(messages[-1]['content']) > self.max_prompt:
+            return None
+        context = json.dumps([system, messages[:-1]], sort_keys=True)
+        fingerprint = hashlib.sha256(context.encode()).hexdigest()
+        return f'{fingerprint}:{normalize(messages[-1]["content"])}'
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            self.seconds_saved += entry[2]
+            return entry[1]
+
+    def put(self, key, text, seconds):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, text, seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    async def stream(self, backend, messages, system):
+        """The backend's reply to a prompt, from the cache or a shared generation when possible"""
+        key = self.key(messages, system)
+        if key is None:
+            with self._lock:
+                self.uncacheable += 1
+            async for text in backend.stream(messages, system):
+                yield text
+            return
+
+        text = self.get(key)
+        if text is not None:
+            yield text
+            return
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            flight = self._flights.get(key)
+            if flight is not None and flight.loop is loop:
+                self.coalesced += 1
+                self.seconds_saved += time.monotonic() - flight.started
+            else:
+                # A flight on another thread's loop cannot be followed from here
+                self.misses += 1
+                flight = _Flight()
+                if key not in self._flights:
+                    self._flights[key] = flight
+            flight.followers += 1
+        if flight.task is None:
+            flight.task = asyncio.ensure_future(self._generate(key, flight, backend, messages, system))
+
+        try:
+            async for text in flight.follow():
+                yield text
+        finally:
+            flight.followers -= 1
+            if not flight.followers and not flight.finished:
+                # Nobody is waiting for the rest
+                self._forget(key, flight)
+                flight.task.cancel()
+
+    async def _generate(self, key, flight, backend, messages, system):
+        try:
+            async for text in backend.stream(messages, system):
+                flight.push(text)
+        except asyncio.CancelledError:
+            flight.finish(RuntimeError('AI reply abandoned'))
+            raise
+        except Exception as error:
+            flight.finish(error)
+        else:
+            self.put(key, ''.join(flight.chunks), time.monotonic() - flight.started)
+            flight.finish()
+        finally:
+            self._forget(key, flight)
+
+    def _forget(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                'entries': len(self._entries),
+                'in_flight': len(self._flights),
+                'hits': self.hits,
+                'coalesced': self.coalesced,
+                'misses': self.misses,
+                'uncacheable': self.uncacheable,
+                'evictions': self.evictions,
+                'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0,
+                'backend_calls_saved': self.hits + self.coalesced,
+                'seconds_saved': round(self.seconds_saved, 3),
+            }
+
+
+cache = ResponseCache()
+
+
+def stats():
+    return cache.stats()
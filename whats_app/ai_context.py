@@ -0,0 +1,170 @@
+# ai_context.py - What the AI model sees of a conversation
+#
+# Each turn sends the model the conversation's rolling summary (in the
+# system prompt) followed by as many of the newest messages as fit in
+# AI_CONTEXT_TOKENS. Earlier messages longer than AI_CONTEXT_MESSAGE_TOKENS
+# are cut down; the message being answered is always sent whole. Tokens are
+# estimated from character counts, which is close enough for budgeting.
+#
+# Messages are folded into the summary incrementally by refresh_summary(),
+# after a reply has gone out. It does nothing until the unsummarized
+# messages outgrow AI_CONTEXT_TOKENS, then summarizes the oldest of them
+# into AIConversation.summary, keeping roughly half the budget of recent
+# messages verbatim. So folding happens once every few turns, each fold
+# reads a bounded amount of text, and the prompt stays about the same size
+# however long the conversation runs. Sockets run it as a task on their
+# event loop; the HTTP views hand it to a background thread with
+# refresh_summary_later(), so no response waits for a summary.
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from . import ai_admission, ai_service
+from .db_executor import database_sync_to_async
+from .models import AIConversation, AIMessage
+
+logger = logging.getLogger(__name__)
+
+AI_CONTEXT_TOKENS = getattr(settings, 'AI_CONTEXT_TOKENS', 2000)
+AI_CONTEXT_MESSAGE_TOKENS = getattr(settings, 'AI_CONTEXT_MESSAGE_TOKENS', 500)
+AI_SUMMARY_TOKENS = getattr(settings, 'AI_SUMMARY_TOKENS', 300)
+
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD = 4  # role and framing tokens per message
+FETCH_LIMIT = 100  # rows read per turn or fold, however far the summary lags
+
+SUMMARY_PROMPT = (
+    "You maintain a running summary of a chat between a user and an AI assistant. "
+    "Merge the new messages into the existing summary. Keep facts about the user, "
+    "their requests, decisions made and open questions; drop small talk. "
+    "Write plain prose, no more than {words} words."
+)
+
+_summarizing = set()  # conversation pks with a fold running in this process
+_background = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ai-summary')
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate(text, tokens):
+    """`text` cut to about `tokens` tokens"""
+    limit = tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    return text[:limit].rstrip() + ' [...]'
+
+
+def _message_tokens(message):
+    return estimate_tokens(message.content[:AI_CONTEXT_MESSAGE_TOKENS * CHARS_PER_TOKEN]) + MESSAGE_OVERHEAD
+
+
+def _unsummarized(conversation):
+    """The newest unsummarized messages, newest first"""
+    return list(
+        AIMessage.objects.filter(conversation=conversation, pk__gt=conversation.summary_through)
+        .only('pk', 'is_user', 'content').order_by('-pk')[:FETCH_LIMIT]
+    )
+
+
+def _window(messages, budget):
+    """How many of `messages` (newest first) fit in `budget` tokens"""
+    used = 0
+    for count, message in enumerate(messages):
+        used += _message_tokens(message)
+        if used > budget:
+            return count
+    return len(messages)
+
+
+def system_prompt(conversation):
+    if not conversation.summary:
+        return ai_service.SYSTEM_PROMPT
+    return f"{ai_service.SYSTEM_PROMPT}\n\nSummary of the conversation so far:\n{conversation.summary}"
+
+
+def build_prompt(conversation):
+    """(system, messages) for answering the conversation's latest message"""
+    latest, *earlier = _unsummarized(conversation)
+    earlier = earlier[:_window(earlier, AI_CONTEXT_TOKENS)]
+    # The API wants the user to speak first; the summary covers the rest
+    while earlier and not earlier[-1].is_user:
+        earlier.pop()
+    messages = [
+        {
+            "role": "user" if message.is_user else "assistant",
+            "content": truncate(message.content, AI_CONTEXT_MESSAGE_TOKENS),
+        }
+        for message in reversed(earlier)
+    ]
+    messages.append({"role": "user", "content": latest.content})
+    return system_prompt(conversation), messages
+
+
+def _fold_candidates(conversation_pk):
+    """(conversation, oldest messages to fold) or None when the window still fits"""
+    conversation = AIConversation.objects.filter(pk=conversation_pk).first()
+    if conversation is None:
+        return None
+    newest = _unsummarized(conversation)
+    if len(newest) < FETCH_LIMIT and _window(newest, AI_CONTEXT_TOKENS) == len(newest):
+        return None
+    keep = newest[:max(1, _window(newest, AI_CONTEXT_TOKENS // 2))]
+    candidates = AIMessage.objects.filter(
+        conversation_id=conversation_pk, pk__gt=conversation.summary_through, pk__lt=keep[-1].pk
+    ).only('pk', 'is_user', 'content').order_by('pk')[:FETCH_LIMIT]
+    fold, used = [], 0
+    for message in candidates:
+        used += _message_tokens(message)
+        if fold and used > AI_CONTEXT_TOKENS:
+            break
+        fold.append(message)
+    return (conversation, fold) if fold else None
+
+
+def _save_summary(conversation, summary, through):
+    """Store the new summary unless another fold got there first"""
+    return AIConversation.objects.filter(
+        pk=conversation.pk, summary_through=conversation.summary_through
+    ).update(summary=summary, summary_through=through)
+
+
+async def refresh_summary(conversation_pk, backend=None):
+    """Fold the oldest unsummarized messages into the summary if they no longer fit"""
+    if conversation_pk in _summarizing:
+        return
+    _summarizing.add(conversation_pk)
+    try:
+        found = await database_sync_to_async(_fold_candidates)(conversation_pk)
+        if found is None:
+            return
+        conversation, fold = found
+        transcript = '\n'.join(
+            f"{'User' if message.is_user else 'Assistant'}: {truncate(message.content, AI_CONTEXT_MESSAGE_TOKENS)}"
+            for message in fold
+        )
+        request = [{
+            "role": "user",
+            "content": f"Summary so far:\n{conversation.summary or '(none)'}\n\nNew messages:\n{transcript}",
+        }]
+        system = SUMMARY_PROMPT.format(words=AI_SUMMARY_TOKENS * 3 // 4)
+        chunks = []
+        # Behind interactive replies in the admission queue, and never cached
+        guarded = ai_admission.guard(backend or ai_service.get_backend(), priority=ai_admission.BACKGROUND)
+        async for text in guarded.stream(request, system, max_tokens=AI_SUMMARY_TOKENS):
+            chunks.append(text)
+        summary = truncate(''.join(chunks).strip(), AI_SUMMARY_TOKENS)
+        await database_sync_to_async(_save_summary)(conversation, summary, fold[-1].pk)
+    except ai_admission.Overloaded as error:
+        logger.info("AI summary refresh for conversation %s deferred: %s", conversation_pk, error)
+    except Exception:
+        # The window stays bounded without the summary; the next turn retries
+        logger.exception("AI summary refresh failed for conversation %s", conversation_pk)
+    finally:
+        _summarizing.discard(conversation_pk)
+
+
+def refresh_summary_later(conversation_pk):
+    """refresh_summary() on a background thread, for callers without an event loop"""
+    _background.submit(lambda: asyncio.run(refresh_summary(conversation_pk)))
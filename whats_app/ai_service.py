@@ -1,69 +1,177 @@
 # ai_service.py - Claude AI Integration
+#
+# Responses come from an async backend that yields text as it is generated:
+#   AnthropicBackend  the Claude API, streamed
+#   FakeBackend       canned replies with simulated latency, for development
+#                     and tests
+# settings.AI_BACKEND picks one; 'anthropic' without ANTHROPIC_API_KEY is a
+# configuration error rather than a reason to fall back. AIConsumer streams a backend straight to the
+# socket on the event loop, so a generation holds neither a worker nor a DB
+# executor thread, and closing the socket cancels it. ClaudeAIService is the
+# blocking wrapper the HTTP views use. What history goes into a prompt is
+# up to whats_app.ai_context; replies go through whats_app.ai_cache, so
+# identical prompts share one generation, and each backend request through
+# whats_app.ai_admission, which caps concurrency and retries transient
+# failures. FakeBackend can inject those failures to exercise it offline.
+import asyncio
+import logging
+import random
 import anthropic
-import os
+from asgiref.sync import async_to_sync
 from django.conf import settings
-import json
+from django.core.exceptions import ImproperlyConfigured
+from .ai_admission import INTERACTIVE, Overloaded, TransientError, guard
+from .ai_cache import cache
+
+logger = logging.getLogger(__name__)
+
+MODEL = "claude-sonnet-4-20250514"
+MAX_TOKENS = 1000
+SYSTEM_PROMPT = "You are a helpful AI assistant integrated into WhatsApp. You're friendly, conversational, and help users with anything they need - from answering questions to having casual conversations. Keep responses concise and natural, like texting a friend."
+FALLBACK_RESPONSE = "Sorry, I'm having trouble responding right now. Please try again later."
+
+
+def conversation_messages(user_message, conversation_history=None):
+    """API messages for a reply to `user_message` after the AIMessage history"""
+    messages = []
+
+    # Add conversation history if provided
+    if conversation_history:
+        for msg in conversation_history:
+            messages.append({
+                "role": "user" if msg.is_user else "assistant",
+                "content": msg.content
+            })
+
+    # Add current message
+    messages.append({
+        "role": "user",
+        "content": user_message
+    })
+    return messages
+
+
+class AnthropicBackend:
+    """Streams replies from the Claude API"""
+    transient_errors = (anthropic.RateLimitError, anthropic.APIConnectionError, anthropic.InternalServerError)
+
+    def __init__(self, api_key=None, model=MODEL, max_tokens=MAX_TOKENS):
+        api_key = api_key or settings.ANTHROPIC_API_KEY
+        if not api_key:
+            raise ImproperlyConfigured(
+                "AI_BACKEND is 'anthropic' but ANTHROPIC_API_KEY is not set "
+                "(use AI_BACKEND=fake for development and tests)"
+            )
+        # Retries are ai_admission's job, within its deadline
+        self.client = anthropic.AsyncAnthropic(api_key=api_key, max_retries=0)
+        self.model = model
+        self.max_tokens = max_tokens
+
+    async def stream(self, messages, system=SYSTEM_PROMPT, max_tokens=None):
+        """Yield the reply's text as it arrives; closing the generator aborts the request"""
+        async with self.client.messages.stream(
+            model=self.model,
+            max_tokens=max_tokens or self.max_tokens,
+            system=system,
+            messages=messages
+        ) as response:
+            async for text in response.text_stream:
+                yield text
+
+
+class FakeBackend:
+    """Canned replies streamed word by word with model-like delays"""
+    responses = [
+        "That's interesting! Tell me more.",
+        "I understand. How does that make you feel?",
+        "I'm here to chat! What else is on your mind?",
+        "That's a great question! Let me think about that...",
+    ]
+
+    def __init__(self, first_token_delay=0.4, token_delay=0.03, seed=None, failure_rate=0.0):
+        self.first_token_delay = first_token_delay
+        self.token_delay = token_delay
+        self.random = random.Random(seed)
+        self.failure_rate = failure_rate
+
+    async def stream(self, messages, system=SYSTEM_PROMPT, max_tokens=None):
+        await asyncio.sleep(self.first_token_delay)
+        if self.random.random() < self.failure_rate:
+            raise TransientError('simulated overload')
+        words = self.random.choice(self.responses).split(' ')
+        for index, word in enumerate(words):
+            if index:
+                await asyncio.sleep(self.token_delay)
+            yield word if index == 0 else ' ' + word
+
+
+BACKENDS = {
+    'anthropic': AnthropicBackend,
+    'fake': FakeBackend,
+}
+
+_backend = None
+
+
+def get_backend():
+    """The configured backend, created on first use"""
+    global _backend
+    if _backend is None:
+        name = getattr(settings, 'AI_BACKEND', 'anthropic')
+        if name not in BACKENDS:
+            raise ImproperlyConfigured(f"Unknown AI_BACKEND {name!r}, expected one of {', '.join(BACKENDS)}")
+        _backend = BACKENDS[name]()
+    return _backend
+
+
+def stream_reply(messages, system=SYSTEM_PROMPT, user_pk=None, priority=INTERACTIVE, backend=None):
+    """
+    Async iterator over a reply's text, served from the response cache when
+    possible. Raises ai_admission.Overloaded if the request is not admitted.
+    """
+    return cache.stream(guard(backend or get_backend(), user_pk, priority), messages, system)
+
+
+async def complete(messages, system=SYSTEM_PROMPT, user_pk=None, backend=None):
+    """The whole reply as one string, or FALLBACK_RESPONSE if the backend fails"""
+    try:
+        return ''.join([text async for text in stream_reply(messages, system, user_pk, backend=backend)])
+    except (Overloaded, ImproperlyConfigured):
+        raise
+    except Exception:
+        logger.exception("AI backend failed")
+        return FALLBACK_RESPONSE
+
 
 class ClaudeAIService:
-    def __init__(self):
-        self.client = anthropic.Anthropic(
-            api_key=settings.ANTHROPIC_API_KEY
-        )
-        self.model = "claude-sonnet-4-20250514"
-    
+    def generate_reply(self, messages, system=SYSTEM_PROMPT, user_pk=None):
+        """Generate a reply to prepared API messages (see ai_context.build_prompt)"""
+        return async_to_sync(complete)(messages, system, user_pk)
+
     def generate_text_response(self, user_message, conversation_history=None):
         """Generate text response from Claude AI"""
-        messages = []
-        
-        # Add conversation history if provided
-        if conversation_history:
-            for msg in conversation_history:
-                messages.append({
-                    "role": "user" if msg.is_user else "assistant",
-                    "content": msg.content
-                })
-        
-        # Add current message
-        messages.append({
-            "role": "user",
-            "content": user_message
-        })
-        
-        try:
-            response = self.client.messages.create(
-                model=self.model,
-                max_tokens=1000,
-                system="You are a helpful AI assistant integrated into WhatsApp. You're friendly, conversational, and help users with anything they need - from answering questions to having casual conversations. Keep responses concise and natural, like texting a friend.",
-                messages=messages
-            )
-            
-            return response.content[0].text
-        
-        except Exception as e:
-            print(f"Claude AI Error: {e}")
-            return "Sorry, I'm having trouble responding right now. Please try again later."
-    
-    def generate_voice_response(self, user_message, conversation_history=None):
+        return self.generate_reply(conversation_messages(user_message, conversation_history))
+
+    def generate_voice_response(self, messages, system=SYSTEM_PROMPT, user_pk=None):
         """Generate voice response - first get text, then convert to speech"""
-        text_response = self.generate_text_response(user_message, conversation_history)
-        
+        text_response = self.generate_reply(messages, system, user_pk)
+
         # Here you would integrate with a text-to-speech service
         # For example, using Google Cloud Text-to-Speech, Amazon Polly, etc.
-        
+
         return {
             'text': text_response,
             'audio_url': None  # Would be the URL to the generated audio file
         }
-    
+
     def handle_boredom_detection(self, message):
         """Detect if user is bored and offer to chat"""
         boredom_keywords = ['bored', 'boring', 'nothing to do', 'tired', 'lonely']
-        
+
         message_lower = message.lower()
         is_bored = any(keyword in message_lower for keyword in boredom_keywords)
-        
+
         if is_bored:
             return True, "I noticed you might be feeling bored! Would you like to chat with me? I can answer questions, tell jokes, discuss interesting topics, or just have a friendly conversation. What sounds good to you?"
-        
-        return False, None
 
+        return False, None
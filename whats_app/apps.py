@@ -7,3 +7,4 @@ class WhatsAppConfig(AppConfig):
     
     def ready(self):
         import whats_app.signals
+        import whats_app.metrics
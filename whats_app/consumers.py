@@ -1,323 +1,404 @@
+import asyncio
 import json
+import logging
+import uuid
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
 from django.utils import timezone
 from .models import *
-
-
-class ChatConsumer(AsyncWebsocketConsumer):
-    async def connect(self):
-        self.chat_id = self.scope['url_route']['kwargs']['chat_id']
-        self.room_group_name = f'chat_{self.chat_id}'
-        self.user = self.scope['user']
-
-        # Join room group
-        await self.channel_layer.group_add(
-            self.room_group_name,
-            self.channel_name
-        )
-
-        await self.accept()
-        
-        # Set user as online
-        await self.set_user_online(True)
-
-    async def disconnect(self, close_code):
-        # Leave room group
-        await self.channel_layer.group_discard(
-            self.room_group_name,
-            self.channel_name
-        )
-        
-        # Set user as offline
-        await self.set_user_online(False)
-        
-        # Stop typing indicator
-        await self.update_typing_status(False)
-
-    async def receive(self, text_data):
-        data = json.loads(text_data)
+from . import ai_context, ai_service, history, messaging, receipts
+from .access import get_chat_access
+from .db_executor import database_sync_to_async
+from .metrics import ConnectionMetrics
+from .realtime import chat_group_name, user_group_name
+from .presence import presence, presence_group_name
+from .rate_limits import RateLimiter, frame_class
+from .send_queue import SendQueue
+from .typing_indicators import TypingTracker
+from . import wire
+
+logger = logging.getLogger(__name__)
+
+# Close code for a socket whose client stopped reading (Try Again Later)
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class ChatEventsMixin:
+    """
+    Frame and group event handlers shared by ChatConsumer (one chat per
+    socket) and UserConsumer (all of a user's chats on one socket).
+    Handlers take the chat they apply to and every frame carries chat_id.
+    Frames are encoded with the codec negotiated at connect (whats_app.wire),
+    rate limited on the way in (whats_app.rate_limits) and queued on the way
+    out (whats_app.send_queue).
+    """
+
+    def negotiate_codec(self):
+        """Pick the frame encoding from the client's subprotocols; returns the one to accept"""
+        self.codec = wire.negotiate(self.scope.get('subprotocols'))
+        return self.codec.protocol
+
+    def start_flow_control(self):
+        """Set up this socket's rate limits and send queue; needs self.user and self.metrics"""
+        self.rate_limiter = RateLimiter(self.user.pk)
+        self.outgoing = SendQueue(self.send, self.close_slow_consumer, self.metrics)
+
+    def stop_flow_control(self):
+        self.rate_limiter.close()
+        self.outgoing.close()
+
+    async def close_slow_consumer(self):
+        await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+
+    async def send_frame(self, frame, key=None):
+        """Queue a frame for the client; `key` makes it low priority (see whats_app.send_queue)"""
+        self.outgoing.put(self.codec.encode(frame), key)
+
+    async def dispatch_frame(self, chat_id, data):
         message_type = data.get('type')
+        if not await self.admit_frame(chat_id, message_type, data):
+            return
+
+        access = await self.get_chat_access(chat_id)
+        if access is None or not access.is_member(self.user.pk):
+            await self.send_frame({
+                'type': 'error',
+                'chat_id': chat_id,
+                'error': 'You are not a participant of this chat'
+            })
+            return
 
         if message_type == 'chat_message':
-            await self.handle_chat_message(data)
+            await self.handle_chat_message(chat_id, data)
         elif message_type == 'typing':
-            await self.handle_typing(data)
+            await self.handle_typing(chat_id, data)
         elif message_type == 'read_receipt':
-            await self.handle_read_receipt(data)
+            await self.handle_read_receipt(chat_id, data)
         elif message_type == 'voice_call':
-            await self.handle_voice_call(data)
+            await self.handle_call(chat_id, 'voice', data)
         elif message_type == 'video_call':
-            await self.handle_video_call(data)
-
-    async def handle_chat_message(self, data):
+            await self.handle_call(chat_id, 'video', data)
+        elif message_type == 'sync':
+            await self.handle_sync(chat_id, data)
+
+    async def admit_frame(self, chat_id, message_type, data):
+        """Take a rate limit token for the frame; tells the client when a send is refused"""
+        name = frame_class(message_type)
+        if name == 'typing' and not data.get('is_typing'):
+            # Stopping only clears state, and must not be lost
+            return True
+        retry_after = self.rate_limiter.check(name)
+        if not retry_after:
+            return True
+
+        self.metrics.drop('rate_limited', message_type)
+        # Typing and receipts are superseded by the client's next frame
+        if name not in ('typing', 'receipt'):
+            client_id = data.get('client_id')
+            # A refused send the client will retry is reported individually
+            key = None if client_id else ('rate_limited', chat_id, name)
+            await self.send_frame({
+                'type': 'error',
+                'chat_id': chat_id,
+                'error': 'Rate limited',
+                'action': message_type,
+                'client_id': client_id,
+                'retry_after': round(retry_after, 2)
+            }, key)
+        return False
+
+    async def handle_chat_message(self, chat_id, data):
         content = data['content']
         message_type = data.get('message_type', 'text')
         reply_to_id = data.get('reply_to')
+        client_id = data.get('client_id')
         
-        # Save message to database
-        message = await self.save_message(content, message_type, reply_to_id)
+        # Save message to database; it is broadcast to the room group on commit
+        try:
+            message, created = await self.save_message(
+                self.chat_access[chat_id], content, message_type, reply_to_id, client_id
+            )
+        except messaging.MessageRejected as e:
+            await self.send_frame({
+                'type': 'error',
+                'chat_id': chat_id,
+                'error': str(e)
+            })
+            return
         
-        # Send message to room group
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'chat_message',
-                'message': {
-                    'id': str(message.message_id),
-                    'sender': self.user.phone_number,
-                    'sender_name': self.user.username,
-                    'sender_photo': self.user.profile_picture.url if self.user.profile_picture else None,
-                    'content': message.content,
-                    'message_type': message.message_type,
-                    'timestamp': message.created_at.isoformat(),
-                    'is_edited': message.is_edited,
-                    'reply_to': str(message.reply_to.message_id) if message.reply_to else None,
-                }
-            }
-        )
+        if client_id is not None:
+            # Lets a retrying client settle its pending message even when
+            # the original broadcast was lost with the old connection
+            await self.send_frame({
+                'type': 'message_ack',
+                'chat_id': chat_id,
+                'client_id': client_id,
+                'message_id': str(message.message_id),
+                'seq': message.seq,
+                'timestamp': message.created_at.isoformat(),
+                'duplicate': not created
+            })
+        if not created:
+            return
         
-        # Update message status to delivered
-        await self.update_message_status(message, 'delivered')
+        # Receivers drop the sender's typing indicator when the message arrives
+        self.typing.clear(chat_id)
 
-    async def handle_typing(self, data):
-        is_typing = data.get('is_typing', False)
-        
-        await self.update_typing_status(is_typing)
-        
-        # Broadcast typing status
+    async def handle_typing(self, chat_id, data):
+        # Coalesced and auto-stopped in memory; see whats_app.typing_indicators
+        await self.typing.typing(chat_id, bool(data.get('is_typing', False)))
+
+    async def broadcast_typing(self, chat_id, is_typing):
         await self.channel_layer.group_send(
-            self.room_group_name,
+            chat_group_name(chat_id),
             {
                 'type': 'typing_indicator',
+                'chat_id': chat_id,
                 'user': self.user.phone_number,
-                'is_typing': is_typing
+                'is_typing': is_typing,
+                'expires_in': self.typing.timeout
             }
         )
 
-    async def handle_read_receipt(self, data):
-        message_id = data.get('message_id')
+    async def start_presence(self):
+        """Register this socket with the presence service and keep it alive"""
+        await presence.connect(self.user.pk, self.channel_name)
+        self.heartbeat_task = asyncio.ensure_future(self.heartbeat_loop())
+
+    async def heartbeat_loop(self):
+        interval = presence.backend.ttl / 3
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await presence.heartbeat(self.user.pk, self.channel_name)
+            except Exception:
+                logger.exception("Presence heartbeat failed")
+
+    async def stop_presence(self):
+        self.heartbeat_task.cancel()
+        await presence.disconnect(self.user.pk, self.channel_name)
+
+    async def stop_typing(self):
+        """Clear typing state left behind by this socket"""
+        await self.typing.stop_all()
+
+    async def handle_read_receipt(self, chat_id, data):
+        # read_up_to covers every message up to a seq; message_id is the
+        # older one-receipt-per-message form. Both are coalesced per socket.
+        try:
+            read_up_to = int(data['read_up_to']) if 'read_up_to' in data else None
+            message_id = str(uuid.UUID(data['message_id'])) if 'message_id' in data else None
+        except (TypeError, ValueError):
+            return
+        self.read_receipts.add(chat_id, read_up_to, message_id)
+
+    async def flush_read_receipts(self, pending):
+        # One watermark update and one outbox broadcast per chat per batch
+        await self.save_read_receipts(pending)
+
+    async def handle_sync(self, chat_id, data):
+        """Replay everything after the client's last seen seq, in batches"""
+        try:
+            last_seq = max(int(data.get('last_seq', 0)), 0)
+        except (TypeError, ValueError):
+            return
         
-        # Update message status to read
-        await self.mark_message_read(message_id)
-        
-        # Broadcast read receipt
-        await self.channel_layer.group_send(
-            self.room_group_name,
-            {
-                'type': 'read_receipt',
-                'message_id': message_id,
-                'user': self.user.phone_number
-            }
-        )
+        while True:
+            batch, has_more = await self.get_messages_after(self.chat_access[chat_id].chat_pk, last_seq)
+            if batch['messages']:
+                last_seq = batch['messages'][-1]['seq']
+            
+            await self.send_frame({
+                'type': 'sync',
+                'chat_id': chat_id,
+                'senders': self.codec.unseen_senders(batch['senders']),
+                'messages': batch['messages'],
+                'last_seq': last_seq,
+                'has_more': has_more,
+            })
+            
+            if not has_more:
+                break
+            # Read the next batch only as fast as the client takes them
+            await self.outgoing.join()
 
-    async def handle_voice_call(self, data):
+    async def handle_call(self, chat_id, call_type, data):
         action = data.get('action')  # 'start', 'answer', 'end'
+        event = {'type': f'{call_type}_call', 'chat_id': chat_id}
+        access = self.chat_access[chat_id]
         
         if action == 'start':
-            call = await self.start_call('voice')
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'voice_call',
-                    'action': 'incoming',
-                    'call_id': str(call.call_id),
-                    'caller': self.user.phone_number
-                }
-            )
-        elif action == 'answer':
-            call_id = data.get('call_id')
-            await self.answer_call(call_id)
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'voice_call',
-                    'action': 'answered',
-                    'call_id': call_id
-                }
-            )
-        elif action == 'end':
-            call_id = data.get('call_id')
-            await self.end_call(call_id)
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'voice_call',
-                    'action': 'ended',
-                    'call_id': call_id
-                }
-            )
-
-    async def handle_video_call(self, data):
-        action = data.get('action')  # 'start', 'answer', 'end'
+            call = await self.start_call(access, call_type)
+            event.update({
+                'action': 'incoming',
+                'call_id': str(call.call_id),
+                'caller': self.user.phone_number
+            })
+        elif action in ('answer', 'end'):
+            try:
+                call_id = str(uuid.UUID(str(data.get('call_id'))))
+            except ValueError:
+                return
+            if action == 'answer':
+                found = await self.answer_call(access.chat_pk, call_id)
+                event.update({'action': 'answered', 'call_id': call_id})
+            else:
+                found = await self.end_call(access.chat_pk, call_id)
+                event.update({'action': 'ended', 'call_id': call_id})
+            if not found:
+                return
+        else:
+            return
         
-        if action == 'start':
-            call = await self.start_call('video')
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'video_call',
-                    'action': 'incoming',
-                    'call_id': str(call.call_id),
-                    'caller': self.user.phone_number
-                }
-            )
-        elif action == 'answer':
-            call_id = data.get('call_id')
-            await self.answer_call(call_id)
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'video_call',
-                    'action': 'answered',
-                    'call_id': call_id
-                }
-            )
-        elif action == 'end':
-            call_id = data.get('call_id')
-            await self.end_call(call_id)
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    'type': 'video_call',
-                    'action': 'ended',
-                    'call_id': call_id
-                }
-            )
+        await self.channel_layer.group_send(chat_group_name(chat_id), event)
 
     # Receive message from room group
+    async def outbox_batch(self, event):
+        # Consecutive events for this group relayed together by whats_app.outbox
+        for inner in event['events']:
+            await self.dispatch(inner)
+
+    async def chat_access_changed(self, event):
+        # Membership or permissions changed; reload on the next frame
+        self.chat_access.pop(event['chat_id'], None)
+
     async def chat_message(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'chat_message',
-            'message': event['message']
-        }))
+        for frame in self.codec.sender_frames(event['sender']):
+            await self.send_frame(frame)
+        # Encoded once for the whole group by wire.broadcast_event
+        self.outgoing.put(event['frames'][self.codec.key])
 
     async def typing_indicator(self, event):
         # Don't send typing indicator to the user who is typing
         if event['user'] != self.user.phone_number:
-            await self.send(text_data=json.dumps({
+            await self.send_frame({
                 'type': 'typing',
+                'chat_id': event['chat_id'],
                 'user': event['user'],
-                'is_typing': event['is_typing']
-            }))
+                'is_typing': event['is_typing'],
+                'expires_in': event['expires_in']
+            }, key=('typing', event['chat_id'], event['user']))
 
     async def read_receipt(self, event):
-        await self.send(text_data=json.dumps({
+        await self.send_frame({
             'type': 'read_receipt',
-            'message_id': event['message_id'],
+            'chat_id': event['chat_id'],
+            'read_up_to': event['read_up_to'],
             'user': event['user']
-        }))
+        })
 
     async def voice_call(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'voice_call',
-            'action': event['action'],
-            'call_id': event.get('call_id'),
-            'caller': event.get('caller')
-        }))
+        await self.send_call_event(event)
 
     async def video_call(self, event):
-        await self.send(text_data=json.dumps({
-            'type': 'video_call',
+        await self.send_call_event(event)
+
+    async def send_call_event(self, event):
+        await self.send_frame({
+            'type': event['type'],
+            'chat_id': event['chat_id'],
             'action': event['action'],
             'call_id': event.get('call_id'),
             'caller': event.get('caller')
-        }))
+        })
 
     # Database operations
-    @database_sync_to_async
-    def save_message(self, content, message_type, reply_to_id):
-        chat = Chat.objects.get(chat_id=self.chat_id)
-        
-        reply_to = None
-        if reply_to_id:
-            reply_to = Message.objects.get(message_id=reply_to_id)
-        
-        message = Message.objects.create(
-            chat=chat,
-            sender=self.user,
-            content=content,
-            message_type=message_type,
-            reply_to=reply_to
-        )
-        
-        # Create status for all participants except sender
-        participants = chat.participants.exclude(user=self.user)
-        for participant in participants:
-            MessageStatus.objects.create(
-                message=message,
-                user=participant.user,
-                status='sent'
-            )
-        
-        return message
+    async def get_chat_access(self, chat_id):
+        """This socket's ChatAccess for a chat, loaded on first use"""
+        access = self.chat_access.get(chat_id)
+        if access is None:
+            access = await database_sync_to_async(get_chat_access)(chat_id)
+            if access is not None:
+                self.chat_access[chat_id] = access
+        return access
 
     @database_sync_to_async
-    def update_message_status(self, message, status):
-        MessageStatus.objects.filter(
-            message=message
-        ).exclude(user=self.user).update(status=status, timestamp=timezone.now())
-
-    @database_sync_to_async
-    def mark_message_read(self, message_id):
-        message = Message.objects.get(message_id=message_id)
-        MessageStatus.objects.filter(
-            message=message,
-            user=self.user
-        ).update(status='read', timestamp=timezone.now())
+    def save_message(self, access, content, message_type, reply_to_id, client_id):
+        """Store and broadcast a message and mark it delivered, in one executor call"""
+        message, created = messaging.send_message(
+            access, self.user, content, message_type, reply_to_id, client_id
+        )
+        if created:
+            # Broadcast on commit inside send_message, so it reached the room group
+            messaging.mark_delivered(message)
+        return message, created
 
     @database_sync_to_async
-    def update_typing_status(self, is_typing):
-        chat = Chat.objects.get(chat_id=self.chat_id)
-        TypingStatus.objects.update_or_create(
-            chat=chat,
-            user=self.user,
-            defaults={'is_typing': is_typing}
-        )
+    def get_messages_after(self, chat_pk, seq):
+        messages, has_more = history.fetch_after_seq(chat_pk, seq)
+        return history.serialize_sync_batch(messages), has_more
 
     @database_sync_to_async
-    def set_user_online(self, is_online):
-        self.user.is_online = is_online
-        if not is_online:
-            self.user.last_seen = timezone.now()
-        self.user.save()
+    def save_read_receipts(self, pending):
+        """
+        Apply a batch of read receipts: one watermark UPDATE per chat, with
+        message_id receipts resolved in a single query. Returns {chat_id: seq}
+        for the chats whose watermark moved.
+        """
+        chats = {
+            str(chat_id): (chat_pk, last_seq)
+            for chat_id, chat_pk, last_seq in Chat.objects.filter(
+                chat_id__in=list(pending)
+            ).values_list('chat_id', 'pk', 'last_seq')
+        }
+        
+        message_ids = set().union(*(ids for _, ids in pending.values()))
+        seqs = {}
+        if message_ids:
+            for chat_pk, seq in Message.objects.filter(
+                message_id__in=message_ids,
+                chat_id__in=[chat_pk for chat_pk, _ in chats.values()]
+            ).values_list('chat_id', 'seq'):
+                seqs[chat_pk] = max(seqs.get(chat_pk, 0), seq)
+        
+        applied = {}
+        for chat_id, (seq, _) in pending.items():
+            if chat_id not in chats:
+                continue
+            chat_pk, last_seq = chats[chat_id]
+            # Never past the newest message, whatever the client claims
+            seq = min(max(seq, seqs.get(chat_pk, 0)), last_seq)
+            if seq and messaging.mark_read(chat_pk, chat_id, self.user, seq):
+                applied[chat_id] = seq
+        return applied
 
     @database_sync_to_async
-    def start_call(self, call_type):
-        chat = Chat.objects.get(chat_id=self.chat_id)
+    def start_call(self, access, call_type):
         call = Call.objects.create(
-            chat=chat,
+            chat_id=access.chat_pk,
             caller=self.user,
             call_type=call_type,
             status='initiated'
         )
         
         # Add all participants
-        participants = chat.participants.all()
-        for participant in participants:
-            CallParticipant.objects.create(
-                call=call,
-                user=participant.user
-            )
+        CallParticipant.objects.bulk_create([
+            CallParticipant(call=call, user_id=user_pk)
+            for user_pk in access.participants
+        ])
         
         return call
 
     @database_sync_to_async
-    def answer_call(self, call_id):
-        call = Call.objects.get(call_id=call_id)
+    def answer_call(self, chat_pk, call_id):
+        call = Call.objects.filter(call_id=call_id, chat_id=chat_pk).first()
+        if call is None:
+            return False
         call.status = 'answered'
         call.answered_at = timezone.now()
-        call.save()
+        call.save(update_fields=['status', 'answered_at'])
         
         # Update participant
         CallParticipant.objects.filter(
             call=call,
             user=self.user
         ).update(joined_at=timezone.now())
+        return True
 
     @database_sync_to_async
-    def end_call(self, call_id):
-        call = Call.objects.get(call_id=call_id)
+    def end_call(self, chat_pk, call_id):
+        call = Call.objects.filter(call_id=call_id, chat_id=chat_pk).first()
+        if call is None:
+            return False
         call.status = 'ended'
         call.ended_at = timezone.now()
         
@@ -325,22 +406,227 @@ class ChatConsumer(AsyncWebsocketConsumer):
             duration = (call.ended_at - call.answered_at).seconds
             call.duration = duration
         
-        call.save()
+        call.save(update_fields=['status', 'ended_at', 'duration'])
         
         # Update participant
         CallParticipant.objects.filter(
             call=call,
             user=self.user
         ).update(left_at=timezone.now())
+        return True
+
+
+class ChatConsumer(ChatEventsMixin, AsyncWebsocketConsumer):
+    """One socket per chat: ws/chat/<chat_id>/"""
+
+    async def connect(self):
+        self.chat_id = self.scope['url_route']['kwargs']['chat_id']
+        try:
+            # One spelling per chat, matching group names and cache keys
+            self.chat_id = str(uuid.UUID(self.chat_id))
+        except ValueError:
+            pass  # get_chat_access() finds no such chat and the socket closes
+        self.room_group_name = chat_group_name(self.chat_id)
+        self.user = self.scope['user']
+        self.metrics = ConnectionMetrics(f'ChatConsumer user={self.user.pk} chat={self.chat_id}')
+        self.metrics.activate()
+        self.chat_access = {}
+        self.typing = TypingTracker(self.broadcast_typing)
+        self.read_receipts = receipts.ReadReceiptBatcher(self.flush_read_receipts)
+
+        # Resolve the chat and check membership once; frames reuse the snapshot
+        access = await self.get_chat_access(self.chat_id)
+        self.is_member = access is not None and access.is_member(self.user.pk)
+        if not self.is_member:
+            await self.close()
+            return
+
+        # Join room group
+        await self.channel_layer.group_add(
+            self.room_group_name,
+            self.channel_name
+        )
+
+        await self.accept(self.negotiate_codec())
+        self.start_flow_control()
+        
+        # Set user as online
+        await self.start_presence()
+
+    async def disconnect(self, close_code):
+        if not self.is_member:
+            return
+
+        # Leave room group
+        await self.channel_layer.group_discard(
+            self.room_group_name,
+            self.channel_name
+        )
+        
+        # Set user as offline
+        await self.stop_presence()
+        
+        # Stop typing indicator
+        await self.stop_typing()
+        await self.read_receipts.close()
+        self.stop_flow_control()
+        self.metrics.log_summary()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.codec.decode(text_data, bytes_data)
+        with self.metrics.frame(data.get('type')):
+            await self.dispatch_frame(self.chat_id, data)
+
+
+class UserConsumer(ChatEventsMixin, AsyncWebsocketConsumer):
+    """
+    One socket per user: ws/user/
+
+    Subscribes to every chat the user participates in. Client frames name
+    the chat they target with a chat_id field, and membership changes are
+    pushed to the user's group as chat.subscribe/chat.unsubscribe events.
+    """
+
+    async def connect(self):
+        self.user = self.scope['user']
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        self.metrics = ConnectionMetrics(f'UserConsumer user={self.user.pk}')
+        self.metrics.activate()
+
+        self.user_group_name = user_group_name(self.user.pk)
+        self.chat_ids = set(await self.get_chat_ids())
+        self.peers = await self.get_peers()
+        self.chat_access = {}
+        self.typing = TypingTracker(self.broadcast_typing)
+        self.read_receipts = receipts.ReadReceiptBatcher(self.flush_read_receipts)
+
+        await self.channel_layer.group_add(self.user_group_name, self.channel_name)
+        for chat_id in self.chat_ids:
+            await self.channel_layer.group_add(chat_group_name(chat_id), self.channel_name)
+        for peer_pk in self.peers:
+            await self.channel_layer.group_add(presence_group_name(peer_pk), self.channel_name)
+
+        await self.accept(self.negotiate_codec())
+        self.start_flow_control()
+        await self.start_presence()
+
+    async def disconnect(self, close_code):
+        if not self.user.is_authenticated:
+            return
+
+        await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+        for chat_id in self.chat_ids:
+            await self.channel_layer.group_discard(chat_group_name(chat_id), self.channel_name)
+        for peer_pk in self.peers:
+            await self.channel_layer.group_discard(presence_group_name(peer_pk), self.channel_name)
+
+        await self.stop_presence()
+        await self.stop_typing()
+        await self.read_receipts.close()
+        self.stop_flow_control()
+        self.metrics.log_summary()
+
+    async def receive(self, text_data=None, bytes_data=None):
+        data = self.codec.decode(text_data, bytes_data)
+        with self.metrics.frame(data.get('type')):
+            await self.receive_frame(data)
+
+    async def receive_frame(self, data):
+        try:
+            chat_id = str(uuid.UUID(str(data.get('chat_id'))))
+        except ValueError:
+            chat_id = None
+
+        if chat_id not in self.chat_ids:
+            await self.send_frame({
+                'type': 'error',
+                'chat_id': data.get('chat_id'),
+                'error': 'Not subscribed to this chat'
+            })
+            return
+
+        await self.dispatch_frame(chat_id, data)
+
+    # Membership changes pushed from whats_app.signals
+    async def chat_subscribe(self, event):
+        chat_id = event['chat_id']
+        if chat_id in self.chat_ids:
+            return
+        self.chat_ids.add(chat_id)
+        await self.channel_layer.group_add(chat_group_name(chat_id), self.channel_name)
+        
+        # A new private chat brings a new peer whose presence we follow
+        peers = await self.get_peers()
+        for peer_pk in peers.keys() - self.peers.keys():
+            await self.channel_layer.group_add(presence_group_name(peer_pk), self.channel_name)
+        self.peers.update(peers)
+        
+        await self.send_frame({'type': 'subscribed', 'chat_id': chat_id})
+
+    async def chat_unsubscribe(self, event):
+        chat_id = event['chat_id']
+        if chat_id not in self.chat_ids:
+            return
+        self.chat_ids.discard(chat_id)
+        self.chat_access.pop(chat_id, None)
+        await self.typing.stop(chat_id)
+        await self.channel_layer.group_discard(chat_group_name(chat_id), self.channel_name)
+        await self.send_frame({'type': 'unsubscribed', 'chat_id': chat_id})
+
+    # Online/offline of the user's private chat peers, from whats_app.presence
+    async def presence_update(self, event):
+        phone_number = self.peers.get(event['user_pk'])
+        if phone_number is None:
+            return
+        await self.send_frame({
+            'type': 'presence',
+            'user': phone_number,
+            'is_online': event['is_online'],
+            'last_seen': event['last_seen'],
+        }, key=('presence', phone_number))
+
+    @database_sync_to_async
+    def get_peers(self):
+        """{user_pk: phone_number} of everyone the user has a private chat with"""
+        return dict(
+            InboxEntry.objects.filter(user=self.user, peer__isnull=False)
+            .values_list('peer_id', 'peer__phone_number')
+        )
+
+    @database_sync_to_async
+    def get_chat_ids(self):
+        return [
+            str(chat_id) for chat_id in
+            ChatParticipant.objects.filter(user=self.user).values_list('chat__chat_id', flat=True)
+        ]
 
 
 class AIConsumer(AsyncWebsocketConsumer):
-    """WebSocket consumer for AI chat"""
+    """
+    WebSocket consumer for AI chat
+
+    Replies stream to the socket as ai_delta frames while the backend
+    generates them, then arrive whole as an ai_message frame. One reply
+    runs at a time; an ai_cancel frame or closing the socket stops it, and
+    the part already sent is kept in the conversation. After each reply
+    the conversation's summary is refreshed in the background
+    (whats_app.ai_context).
+    """
     
     async def connect(self):
         self.conversation_id = self.scope['url_route']['kwargs']['conversation_id']
         self.room_group_name = f'ai_{self.conversation_id}'
         self.user = self.scope['user']
+        self.generation = None
+        self.summarizing = None
+
+        self.conversation = await self.get_conversation()
+        if self.conversation is None:
+            await self.close()
+            return
 
         await self.channel_layer.group_add(
             self.room_group_name,
@@ -350,6 +636,9 @@ class AIConsumer(AsyncWebsocketConsumer):
         await self.accept()
 
     async def disconnect(self, close_code):
+        if self.conversation is None:
+            return
+        await self.cancel_generation()
         await self.channel_layer.group_discard(
             self.room_group_name,
             self.channel_name
@@ -360,43 +649,87 @@ class AIConsumer(AsyncWebsocketConsumer):
         message_type = data.get('type')
 
         if message_type == 'ai_message':
-            content = data['content']
+            if self.generation is not None and not self.generation.done():
+                await self.send(text_data=json.dumps({
+                    'type': 'error',
+                    'error': 'Still answering your previous message'
+                }))
+                return
             
             # Save user message
-            await self.save_ai_message(content, True)
+            system, messages = await self.save_user_message(data['content'])
             
-            # Generate AI response
-            ai_response = await self.generate_ai_response(content)
-            
-            # Save AI message
-            await self.save_ai_message(ai_response, False)
-            
-            # Send to user
+            # Stream the reply from the event loop, so this socket keeps
+            # receiving frames (ai_cancel) while it is generated
+            self.generation = asyncio.ensure_future(self.stream_response(system, messages))
+        elif message_type == 'ai_cancel':
+            await self.cancel_generation()
+
+    async def stream_response(self, system, messages):
+        chunks = []
+        try:
+            async for text in ai_service.stream_reply(messages, system, self.user.pk):
+                chunks.append(text)
+                await self.send(text_data=json.dumps({'type': 'ai_delta', 'content': text}))
+        except ai_service.Overloaded as error:
+            # Refused before anything was generated; the client may resend
             await self.send(text_data=json.dumps({
-                'type': 'ai_message',
-                'content': ai_response,
-                'timestamp': timezone.now().isoformat()
+                'type': 'error',
+                'error': 'The assistant is busy, please try again shortly',
+                'retry_after': error.retry_after
             }))
+            return
+        except asyncio.CancelledError:
+            # Keep what the user already saw
+            if chunks:
+                await self.save_ai_message(''.join(chunks))
+            raise
+        except Exception:
+            logger.exception("AI backend failed")
+            chunks = [ai_service.FALLBACK_RESPONSE]
+        
+        ai_message = await self.save_ai_message(''.join(chunks))
+        
+        # Send to user
+        await self.send(text_data=json.dumps({
+            'type': 'ai_message',
+            'content': ai_message.content,
+            'timestamp': ai_message.created_at.isoformat()
+        }))
+
+        # Not awaited, and left running if the socket closes
+        self.summarizing = asyncio.ensure_future(ai_context.refresh_summary(self.conversation.pk))
+
+    async def cancel_generation(self):
+        if self.generation is None or self.generation.done():
+            return
+        self.generation.cancel()
+        try:
+            await self.generation
+        except asyncio.CancelledError:
+            pass
 
     @database_sync_to_async
-    def save_ai_message(self, content, is_user):
-        conversation = AIConversation.objects.get(conversation_id=self.conversation_id)
+    def get_conversation(self):
+        if not self.user.is_authenticated:
+            return None
+        return AIConversation.objects.filter(conversation_id=self.conversation_id, user=self.user).first()
+
+    @database_sync_to_async
+    def save_user_message(self, content):
+        """Store the user's message; returns the (system, messages) prompt answering it"""
         AIMessage.objects.create(
-            conversation=conversation,
-            is_user=is_user,
+            conversation=self.conversation,
+            is_user=True,
             content=content
         )
+        self.conversation.refresh_from_db(fields=['summary', 'summary_through'])
+        return ai_context.build_prompt(self.conversation)
 
     @database_sync_to_async
-    def generate_ai_response(self, user_message):
-        """Generate AI response - integrate with Claude API"""
-        # This would call Anthropic's API
-        # For demo purposes:
-        responses = [
-            "That's interesting! Tell me more.",
-            "I understand. How does that make you feel?",
-            "I'm here to chat! What else is on your mind?",
-            "That's a great question! Let me think about that...",
-        ]
-        import random
-        return random.choice(responses)
\ No newline at end of file
+    def save_ai_message(self, content):
+        return AIMessage.objects.create(
+            conversation=self.conversation,
+            is_user=False,
+            content=content
+        )
@@ -0,0 +1,139 @@
+# db_executor.py - The thread pool consumer database work runs on
+#
+# channels' database_sync_to_async is thread sensitive by default, so every
+# socket's queries in a process share one thread. database_sync_to_async
+# from this module runs them on a pool of DB_EXECUTOR_WORKERS threads
+# instead. Each thread keeps its own persistent connection for
+# DB_EXECUTOR_CONN_MAX_AGE seconds (the project-wide CONN_MAX_AGE stays 0, so
+# views still close theirs), so the pool size is also the number of
+# connections a process holds and the number of queries it has in flight;
+# work beyond that waits in the executor's queue.
+#
+# CONN_HEALTH_CHECKS would test a reused connection before every call. The
+# pool threads skip that: a connection idle for DB_HEALTH_CHECK_IDLE seconds
+# or more is tested with is_usable() and replaced if broken, and one that
+# raised an error is tested by close_old_connections() as usual.
+#
+# stats() reports the queue depth and how long calls waited for a thread.
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+DB_EXECUTOR_WORKERS = getattr(settings, 'DB_EXECUTOR_WORKERS', 1)
+DB_EXECUTOR_CONN_MAX_AGE = getattr(settings, 'DB_EXECUTOR_CONN_MAX_AGE', 300)
+DB_HEALTH_CHECK_IDLE = getattr(settings, 'DB_HEALTH_CHECK_IDLE', 30)
+
+
+class MeteredExecutor(ThreadPoolExecutor):
+    """A ThreadPoolExecutor that tracks its queue depth and queue wait times"""
+
+    def __init__(self, max_workers):
+        super().__init__(max_workers, thread_name_prefix='db')
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.calls = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.recent_waits = collections.deque(maxlen=1000)
+
+    def submit(self, fn, /, *args, **kwargs):
+        with self._lock:
+            self.queued += 1
+        return super().submit(self._run, time.monotonic(), fn, args, kwargs)
+
+    def _run(self, submitted, fn, args, kwargs):
+        wait = time.monotonic() - submitted
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.calls += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.recent_waits.append(wait)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                self.running -= 1
+
+    def stats(self):
+        """Queue depth, busy threads and queue wait in ms (percentiles over the last 1000 calls)"""
+        with self._lock:
+            waits = sorted(self.recent_waits)
+            snapshot = {
+                'workers': self._max_workers,
+                'queued': self.queued,
+                'running': self.running,
+                'calls': self.calls,
+                'wait_mean_ms': self.wait_total / self.calls * 1000 if self.calls else 0,
+                'wait_max_ms': self.wait_max * 1000,
+            }
+        for name, fraction in (('wait_p50_ms', 0.5), ('wait_p99_ms', 0.99)):
+            snapshot[name] = waits[int(fraction * (len(waits) - 1))] * 1000 if waits else 0
+        return snapshot
+
+
+executor = MeteredExecutor(DB_EXECUTOR_WORKERS)
+
+_local = threading.local()  # per thread: {alias: when its connection was last used}
+
+
+def _configure_connections():
+    """Give this thread's connections the pool's lifetime instead of CONN_MAX_AGE"""
+    for conn in connections.all():
+        # A copy: the settings dict is shared with every other thread's connection
+        conn.settings_dict = {
+            **conn.settings_dict,
+            'CONN_MAX_AGE': DB_EXECUTOR_CONN_MAX_AGE,
+            'CONN_HEALTH_CHECKS': False,
+        }
+    _local.configured = True
+
+
+def _prepare_connections():
+    if not getattr(_local, 'configured', False):
+        _configure_connections()
+    # Drops connections past their age or left broken by the last call
+    close_old_connections()
+    now = time.monotonic()
+    last_used = getattr(_local, 'last_used', {})
+    for conn in connections.all(initialized_only=True):
+        if (conn.connection is not None and now - last_used.get(conn.alias, 0) >= DB_HEALTH_CHECK_IDLE
+                and not conn.is_usable()):
+            conn.close()
+
+
+def _release_connections():
+    close_old_connections()
+    now = time.monotonic()
+    _local.last_used = {
+        conn.alias: now for conn in connections.all(initialized_only=True)
+        if conn.connection is not None
+    }
+
+
+class PooledDatabaseSyncToAsync(DatabaseSyncToAsync):
+    """database_sync_to_async on the DB executor's threads"""
+
+    def __init__(self, func, executor=executor):
+        super().__init__(func, thread_sensitive=False, executor=executor)
+
+    def thread_handler(self, loop, *args, **kwargs):
+        _prepare_connections()
+        try:
+            # Skip DatabaseSyncToAsync's own close_old_connections() on entry
+            return super(DatabaseSyncToAsync, self).thread_handler(loop, *args, **kwargs)
+        finally:
+            _release_connections()
+
+
+database_sync_to_async = PooledDatabaseSyncToAsync
+
+
+def stats():
+    return executor.stats()
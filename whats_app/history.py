@@ -0,0 +1,117 @@
+# history.py - Keyset pagination over a chat's message history
+#
+# Pages are addressed by a message cursor instead of an OFFSET, so loading
+# any page is a bounded range scan on the (chat, created_at, id) index no
+# matter how long the chat is.
+from django.db.models import Q
+from .models import Message
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+SYNC_BATCH_SIZE = 200
+
+
+def clamp_page_size(value):
+    """Parse a client supplied page size, falling back to the default"""
+    try:
+        limit = int(value)
+    except (TypeError, ValueError):
+        return DEFAULT_PAGE_SIZE
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+
+def resolve_cursor(chat, message_id):
+    """Return the (created_at, id) key of a message in this chat, or None"""
+    return Message.objects.filter(
+        chat=chat, message_id=message_id
+    ).values('created_at', 'id').first()
+
+
+def fetch_page(chat, before=None, after=None, limit=DEFAULT_PAGE_SIZE):
+    """
+    Return (messages, has_more) for one page of history, oldest first.
+
+    `before`/`after` are cursors from resolve_cursor(). With neither, the
+    newest page is returned.
+    """
+    queryset = Message.objects.filter(chat=chat).select_related('sender', 'reply_to')
+
+    if after:
+        queryset = queryset.filter(
+            Q(created_at__gt=after['created_at']) |
+            Q(created_at=after['created_at'], id__gt=after['id'])
+        ).order_by('created_at', 'id')
+    else:
+        if before:
+            queryset = queryset.filter(
+                Q(created_at__lt=before['created_at']) |
+                Q(created_at=before['created_at'], id__lt=before['id'])
+            )
+        queryset = queryset.order_by('-created_at', '-id')
+
+    messages = list(queryset[:limit + 1])
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+
+    if not after:
+        messages.reverse()
+
+    return messages, has_more
+
+
+def fetch_after_seq(chat_pk, seq, limit=SYNC_BATCH_SIZE):
+    """
+    Return (messages, has_more) for messages with seq greater than `seq`,
+    in seq order. Used to gap-fill a reconnecting client.
+    """
+    messages = list(
+        Message.objects.filter(chat_id=chat_pk, seq__gt=seq)
+        .select_related('sender', 'reply_to')
+        .order_by('seq')[:limit + 1]
+    )
+    return messages[:limit], len(messages) > limit
+
+
+def serialize_sync_batch(messages):
+    """
+    Compact replay batch: sender profile data is listed once per batch
+    instead of being repeated in every message.
+    """
+    senders = {}
+    items = []
+    for message in messages:
+        sender = message.sender
+        if sender.phone_number not in senders:
+            senders[sender.phone_number] = {
+                'name': sender.username,
+                'photo': sender.profile_picture.url if sender.profile_picture else None,
+            }
+        items.append({
+            'id': str(message.message_id),
+            'seq': message.seq,
+            'sender': sender.phone_number,
+            'content': message.content,
+            'message_type': message.message_type,
+            'timestamp': message.created_at.isoformat(),
+            'is_edited': message.is_edited,
+            'is_deleted': message.is_deleted,
+            'reply_to': str(message.reply_to.message_id) if message.reply_to else None,
+        })
+    return {'senders': senders, 'messages': items}
+
+
+def serialize_message(message):
+    """JSON-ready representation used by the history API"""
+    return {
+        'id': str(message.message_id),
+        'seq': message.seq,
+        'sender': message.sender.phone_number,
+        'sender_name': message.sender.username,
+        'sender_photo': message.sender.profile_picture.url if message.sender.profile_picture else None,
+        'content': message.content,
+        'message_type': message.message_type,
+        'timestamp': message.created_at.isoformat(),
+        'is_edited': message.is_edited,
+        'is_deleted': message.is_deleted,
+        'reply_to': str(message.reply_to.message_id) if message.reply_to else None,
+    }
@@ -0,0 +1,254 @@
+# inbox.py - Denormalized per-user chat list
+#
+# Every (user, chat) pair has one InboxEntry row holding what the chat list
+# needs to render. Rows are updated incrementally from signals so chat_home
+# reads the whole list with a single indexed query.
+#
+# Unread state is counted, never recomputed from history on the hot path:
+# InboxEntry.unread_count per chat, and User.unread_messages/unread_chats as
+# totals over the user's rows. Ingest increments them, reads reset them, and
+# every change to a row's count moves the user's totals by the same delta.
+# Writers lock the inbox row before the user row. Anything that bypasses
+# these paths (cascading deletes, hard-deleted messages) leaves drift that
+# reconcile_unread repairs (manage.py repair_unread_counts).
+from django.db import transaction
+from django.db.models import Case, Count, Exists, F, OuterRef, Subquery, When
+from django.db.models.functions import Coalesce, Greatest
+from .models import ChatParticipant, Contact, Group, InboxEntry, Message, User
+from . import receipts
+
+PREVIEW_LENGTH = 255
+
+
+def message_preview(message):
+    """Short text shown under the chat name"""
+    if message.content:
+        return message.content[:PREVIEW_LENGTH]
+    return message.get_message_type_display()
+
+
+def resolve_display(chat, user):
+    """Return (peer, name, photo) for how `user` sees `chat`"""
+    if chat.chat_type == 'private':
+        other = chat.participants.exclude(user=user).select_related('user').first()
+        if not other:
+            return None, '', ''
+
+        peer = other.user
+        contact = Contact.objects.filter(user=user, contact_user=peer).only('name').first()
+        name = contact.name if contact else peer.phone_number
+        photo = peer.profile_picture.url if peer.profile_picture else ''
+        return peer, name, photo
+
+    group = Group.objects.filter(chat=chat).first()
+    if not group:
+        return None, '', ''
+    return None, group.name, group.icon.url if group.icon else ''
+
+
+def create_entry(participant):
+    """Build the inbox row for a newly added participant"""
+    chat = participant.chat
+    peer, name, photo = resolve_display(chat, participant.user)
+    last_message = Message.objects.filter(chat=chat).order_by('-created_at').first()
+
+    defaults = {
+        'peer': peer,
+        'name': name,
+        'photo': photo,
+        'is_pinned': participant.is_pinned,
+        'is_archived': participant.is_archived,
+        'is_muted': participant.is_muted,
+        'last_activity_at': chat.created_at,
+    }
+    if last_message:
+        defaults.update(_last_message_fields(last_message))
+
+    InboxEntry.objects.update_or_create(user=participant.user, chat=chat, defaults=defaults)
+
+    # In a private chat the first participant's row has no peer until the
+    # second one joins, so refresh the other side as well.
+    if chat.chat_type == 'private':
+        for other in chat.participants.exclude(pk=participant.pk).select_related('user'):
+            refresh_display(chat, other.user)
+
+
+def refresh_display(chat, user):
+    """Re-resolve the name/photo of one inbox row"""
+    peer, name, photo = resolve_display(chat, user)
+    InboxEntry.objects.filter(user=user, chat=chat).update(peer=peer, name=name, photo=photo)
+
+
+def sync_flags(participant):
+    """Mirror pinned/archived/muted flags from a ChatParticipant"""
+    InboxEntry.objects.filter(user_id=participant.user_id, chat_id=participant.chat_id).update(
+        is_pinned=participant.is_pinned,
+        is_archived=participant.is_archived,
+        is_muted=participant.is_muted,
+    )
+
+
+def remove_entry(participant):
+    with transaction.atomic():
+        unread = _lock_unread(participant.user_id, participant.chat_id)
+        if unread:
+            _adjust_totals(participant.user_id, -unread, -1)
+        InboxEntry.objects.filter(user_id=participant.user_id, chat_id=participant.chat_id).delete()
+
+
+def _last_message_fields(message):
+    return {
+        'last_message': message,
+        'last_message_sender_id': message.sender_id,
+        'last_message_preview': message_preview(message),
+        'last_message_at': message.created_at,
+        'last_message_status': 'sent',
+        'last_activity_at': message.created_at,
+    }
+
+
+def message_created(message):
+    """New message: move the chat to the top and bump unread for recipients"""
+    fields = _last_message_fields(message)
+    entries = InboxEntry.objects.filter(chat_id=message.chat_id)
+    recipients = entries.exclude(user_id=message.sender_id)
+
+    recipients.update(unread_count=F('unread_count') + 1, **fields)
+    # A row now at 1 was read before this message: one more unread chat
+    User.objects.filter(pk__in=recipients.values('user_id')).update(
+        unread_messages=F('unread_messages') + 1,
+        unread_chats=F('unread_chats') + Case(
+            When(Exists(recipients.filter(user_id=OuterRef('pk'), unread_count=1)), then=1),
+            default=0,
+        ),
+    )
+
+    # Sending moves the sender's read watermark to this message; the sender
+    # has usually read the chat already, so try the no-op case first
+    sender_entry = entries.filter(user_id=message.sender_id)
+    if not sender_entry.filter(unread_count=0).update(**fields):
+        sender_entry.update(**fields)
+        set_unread(message.sender_id, message.chat_id, 0)
+
+
+def message_changed(message):
+    """Edited or deleted message: refresh the preview if it is the latest one"""
+    InboxEntry.objects.filter(last_message=message).update(
+        last_message_preview=message_preview(message)
+    )
+
+
+def mark_read(user_pk, chat_pk, read_seq):
+    """User's read watermark moved: update unread and the sender's tick"""
+    with transaction.atomic():
+        previous = _lock_unread(user_pk, chat_pk)
+        if previous:
+            # Only messages after the watermark are counted, so reading to
+            # the end is an empty range probe however long the history is
+            unread = Message.objects.filter(
+                chat_id=chat_pk, seq__gt=read_seq
+            ).exclude(sender_id=user_pk).count()
+            _store_unread(user_pk, chat_pk, previous, unread)
+    refresh_receipt(chat_pk)
+
+
+def set_unread(user_pk, chat_pk, unread):
+    """Set one row's unread count, moving the user's totals with it"""
+    with transaction.atomic():
+        previous = _lock_unread(user_pk, chat_pk)
+        if previous is not None:
+            _store_unread(user_pk, chat_pk, previous, unread)
+
+
+def _lock_unread(user_pk, chat_pk):
+    """Lock a user's inbox row and return its unread count (None if there is no row)"""
+    return InboxEntry.objects.select_for_update().filter(
+        user_id=user_pk, chat_id=chat_pk
+    ).values_list('unread_count', flat=True).first()
+
+
+def _store_unread(user_pk, chat_pk, previous, unread):
+    if unread == previous:
+        return
+    InboxEntry.objects.filter(user_id=user_pk, chat_id=chat_pk).update(unread_count=unread)
+    _adjust_totals(user_pk, unread - previous, (unread > 0) - (previous > 0))
+
+
+def _adjust_totals(user_pk, messages, chats):
+    # Clamped so that drift can never push a total below zero
+    User.objects.filter(pk=user_pk).update(
+        unread_messages=Greatest(F('unread_messages') + messages, 0),
+        unread_chats=Greatest(F('unread_chats') + chats, 0),
+    )
+
+
+def reconcile_unread(user_pk):
+    """
+    Recount one user's unread counters from the read watermarks and fix any
+    drift. Returns (inbox rows corrected, whether the totals were corrected).
+    """
+    unread = Message.objects.filter(
+        chat_id=OuterRef('chat_id'), seq__gt=OuterRef('read_seq')
+    ).exclude(sender_id=user_pk).order_by().values('chat_id').annotate(count=Count('pk')).values('count')
+
+    with transaction.atomic():
+        counts = dict(InboxEntry.objects.select_for_update().filter(
+            user_id=user_pk
+        ).values_list('chat_id', 'unread_count'))
+        actual = dict(ChatParticipant.objects.filter(
+            user_id=user_pk, chat_id__in=list(counts)
+        ).annotate(unread=Coalesce(Subquery(unread), 0)).values_list('chat_id', 'unread'))
+
+        rows = 0
+        for chat_pk, count in counts.items():
+            expected = actual.get(chat_pk, 0)
+            if count != expected:
+                InboxEntry.objects.filter(user_id=user_pk, chat_id=chat_pk).update(unread_count=expected)
+                counts[chat_pk] = expected
+                rows += 1
+
+        totals = {
+            'unread_messages': sum(counts.values()),
+            'unread_chats': sum(1 for count in counts.values() if count),
+        }
+        totals_fixed = User.objects.filter(pk=user_pk).exclude(**totals).update(**totals) > 0
+    return rows, totals_fixed
+
+
+def refresh_receipt(chat_pk):
+    """Recompute the tick shown to the sender of the chat's last message"""
+    entry = InboxEntry.objects.filter(chat_id=chat_pk, last_message__isnull=False).values(
+        'last_message_id', 'last_message_sender_id', 'last_message__seq'
+    ).first()
+    if not entry:
+        return
+
+    status = receipts.status_for_seq(chat_pk, entry['last_message_sender_id'], entry['last_message__seq'])
+
+    InboxEntry.objects.filter(
+        chat_id=chat_pk,
+        user_id=entry['last_message_sender_id'],
+        last_message_id=entry['last_message_id'],
+    ).update(last_message_status=status)
+
+
+def contact_changed(contact, deleted=False):
+    """Contact renamed or removed: update the owner's private chat rows"""
+    name = contact.contact_user.phone_number if deleted else contact.name
+    InboxEntry.objects.filter(
+        user_id=contact.user_id,
+        peer_id=contact.contact_user_id,
+    ).update(name=name)
+
+
+def group_changed(group):
+    InboxEntry.objects.filter(chat_id=group.chat_id).update(
+        name=group.name,
+        photo=group.icon.url if group.icon else '',
+    )
+
+
+def profile_picture_changed(user):
+    InboxEntry.objects.filter(peer=user).update(
+        photo=user.profile_picture.url if user.profile_picture else ''
+    )
@@ -0,0 +1,86 @@
+# Management command to load the AI admission controller with the fake backend
+# management/commands/bench_ai_admission.py
+import asyncio
+import collections
+import random
+import time
+from django.core.management.base import BaseCommand
+from whats_app import ai_admission
+from whats_app.ai_service import FakeBackend
+
+
+class Command(BaseCommand):
+    help = ('Offline load test of whats_app.ai_admission: simulated users send AI prompts '
+            'to FakeBackend with injected transient failures; reports refusals, retries and latency')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=200)
+        parser.add_argument('--rate', type=float, default=20, help='Prompts per second across all users')
+        parser.add_argument('--seconds', type=float, default=10, help='Length of the run')
+        parser.add_argument('--first-token-delay', type=float, default=0.8)
+        parser.add_argument('--token-delay', type=float, default=0.03)
+        parser.add_argument('--failure-rate', type=float, default=0.1,
+                            help='Share of backend requests failing transiently before the first token')
+        parser.add_argument('--limit', type=int, default=ai_admission.AI_MAX_CONCURRENT)
+        parser.add_argument('--per-user', type=int, default=ai_admission.AI_MAX_CONCURRENT_PER_USER)
+        parser.add_argument('--queue-limit', type=int, default=ai_admission.AI_QUEUE_LIMIT)
+        parser.add_argument('--queue-timeout', type=float, default=ai_admission.AI_QUEUE_TIMEOUT)
+
+    def handle(self, *args, **options):
+        controller = ai_admission.AdmissionController(
+            options['limit'], options['per_user'], options['queue_limit'], options['queue_timeout']
+        )
+        backend = FakeBackend(options['first_token_delay'], options['token_delay'], seed=25,
+                              failure_rate=options['failure_rate'])
+        outcomes, first_token, total, elapsed = asyncio.run(self.run(controller, backend, options))
+
+        self.stdout.write(f"{sum(outcomes.values())} prompts in {elapsed:.1f}s, "
+                          f"limit {options['limit']}, per user {options['per_user']}, "
+                          f"queue {options['queue_limit']}")
+        for outcome, count in sorted(outcomes.items()):
+            self.stdout.write(f'  {outcome:>20} {count:>6}')
+        for name, latencies in (('first token', first_token), ('whole reply', total)):
+            if not latencies:
+                continue
+            latencies.sort()
+
+            def pct(fraction):
+                return latencies[int(fraction * (len(latencies) - 1))] * 1000
+
+            self.stdout.write(f'  {name:>12} ms: p50 {pct(0.5):.0f}  p95 {pct(0.95):.0f}  '
+                              f'p99 {pct(0.99):.0f}  max {latencies[-1] * 1000:.0f}')
+        stats = controller.stats()
+        self.stdout.write(f"  retries {stats['retries']}, slowest admission wait {stats['wait_max_seconds']:.2f}s")
+
+    async def run(self, controller, backend, options):
+        """Open-loop run: prompts arrive at --rate whether or not earlier ones finished"""
+        rng = random.Random(25)
+        outcomes = collections.Counter()
+        first_token, total = [], []
+
+        async def prompt(user_pk, arrived):
+            guarded = ai_admission.GuardedBackend(backend, user_pk, controller=controller)
+            started = False
+            try:
+                async for _ in guarded.stream([{'role': 'user', 'content': 'hi'}], ''):
+                    if not started:
+                        started = True
+                        first_token.append(time.perf_counter() - arrived)
+                outcomes['answered'] += 1
+                total.append(time.perf_counter() - arrived)
+            except ai_admission.Overloaded as error:
+                outcomes[f'refused: {error.reason}'] += 1
+            except Exception as error:
+                outcomes[f'failed: {type(error).__name__}'] += 1
+
+        tasks = []
+        start = time.perf_counter()
+        arrival = start
+        while arrival - start < options['seconds']:
+            arrival += rng.expovariate(options['rate'])
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.ensure_future(prompt(rng.randrange(options['users']), arrival)))
+        await asyncio.gather(*tasks)
+        return outcomes, first_token, total, time.perf_counter() - start
@@ -0,0 +1,168 @@
+# Management command to compare how consumers reach the database under load
+# management/commands/bench_consumer_db.py
+import asyncio
+import random
+import time
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async as thread_sensitive
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from whats_app import db_executor, inbox, messaging
+from whats_app.access import load_chat_access
+from whats_app.models import Chat, ChatParticipant, Group, InboxEntry, OutboxEvent, User
+from whats_app.realtime import chat_group_name
+
+STRATEGIES = {
+    'thread-hop': 'channels database_sync_to_async: one shared thread, send and delivered as two calls',
+    'async-orm': 'Django async ORM (aupdate) where one statement will do, thread hop for transactions',
+    'pooled': 'whats_app.db_executor: one call per frame on the DB thread pool (what consumers use)',
+}
+
+
+class Command(BaseCommand):
+    help = ('Latency percentiles of the consumer message-send and read-receipt database paths '
+            'with many connected sockets, for each way of reaching the database')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--connections', type=int, default=5000, help='Connected sockets (one bench user each)')
+        parser.add_argument('--chat-size', type=int, default=10, help='Members per bench group chat')
+        parser.add_argument('--rate', type=int, default=40, help='Frames per second across all sockets')
+        parser.add_argument('--seconds', type=float, default=10, help='Length of each run')
+        parser.add_argument('--message-share', type=float, default=0.3,
+                            help='Fraction of frames that are messages; the rest are read receipts')
+        parser.add_argument('--workers', type=int, default=db_executor.DB_EXECUTOR_WORKERS,
+                            help='Threads for the pooled strategy')
+        parser.add_argument('--strategies', default=','.join(STRATEGIES))
+
+    def handle(self, *args, **options):
+        self.executor = db_executor.MeteredExecutor(options['workers'])
+        strategies = options['strategies'].split(',')
+        chats = self.setup(options['connections'], options['chat_size'])
+        try:
+            for name in strategies:
+                self.stdout.write(f'\n{name}: {STRATEGIES[name]}')
+                results, elapsed = asyncio.run(self.run(name, chats, options))
+                self.report(results, elapsed)
+                if name == 'pooled':
+                    stats = self.executor.stats()
+                    self.stdout.write(
+                        f"  executor: {stats['workers']} workers, queue wait "
+                        f"p50 {stats['wait_p50_ms']:.1f} ms, p99 {stats['wait_p99_ms']:.1f} ms"
+                    )
+        finally:
+            self.teardown(chats)
+            self.executor.shutdown()
+
+    def setup(self, connections, chat_size):
+        """Bench users in group chats; returns [(access, [users])]"""
+        self.stdout.write(f'Creating {connections} users in chats of {chat_size}...')
+        stamp = int(time.time())
+        users = User.objects.bulk_create([
+            User(username=f'bench_db_{stamp}_{i}', phone_number=f'+998{stamp % 100000:05d}{i:06d}')
+            for i in range(connections)
+        ])
+        now = timezone.now()
+        chats = []
+        for start in range(0, connections, chat_size):
+            members = users[start:start + chat_size]
+            chat = Chat.objects.create(chat_type='group')
+            Group.objects.create(chat=chat, name=f'Bench {start}', created_by=members[0])
+            ChatParticipant.objects.bulk_create([ChatParticipant(chat=chat, user=user) for user in members])
+            InboxEntry.objects.bulk_create([
+                InboxEntry(chat=chat, user=user, name=f'Bench {start}', last_activity_at=now)
+                for user in members
+            ])
+            chats.append((load_chat_access(chat.chat_id), members))
+        return chats
+
+    def teardown(self, chats):
+        chat_pks = [access.chat_pk for access, _ in chats]
+        OutboxEvent.objects.filter(group__in=[chat_group_name(access.chat_id) for access, _ in chats]).delete()
+        Chat.objects.filter(pk__in=chat_pks).delete()
+        User.objects.filter(pk__in=[user.pk for _, members in chats for user in members]).delete()
+
+    def paths(self, name):
+        """(send, read) coroutine functions for a strategy"""
+        if name == 'thread-hop':
+            async def send(access, user, text):
+                message, _ = await thread_sensitive(messaging.send_message)(access, user, text)
+                await thread_sensitive(messaging.mark_delivered)(message)
+                return message.seq
+
+            read = thread_sensitive(messaging.mark_read)
+
+        elif name == 'async-orm':
+            async def send(access, user, text):
+                # send_message needs a transaction, which the async ORM cannot open
+                message, _ = await sync_to_async(messaging.send_message)(access, user, text)
+                moved = await ChatParticipant.objects.filter(
+                    chat_id=message.chat_id, delivered_seq__lt=message.seq
+                ).exclude(user_id=user.pk).aupdate(delivered_seq=message.seq)
+                if moved:
+                    await sync_to_async(inbox.refresh_receipt)(message.chat_id)
+                return message.seq
+
+            read = sync_to_async(messaging.mark_read)
+
+        else:
+            def send_and_deliver(access, user, text):
+                message, _ = messaging.send_message(access, user, text)
+                messaging.mark_delivered(message)
+                return message.seq
+
+            pooled = db_executor.PooledDatabaseSyncToAsync(send_and_deliver, executor=self.executor)
+
+            async def send(access, user, text):
+                return await pooled(access, user, text)
+
+            read = db_executor.PooledDatabaseSyncToAsync(messaging.mark_read, executor=self.executor)
+        return send, read
+
+    async def run(self, name, chats, options):
+        """Open-loop run: frames arrive at --rate whether or not earlier ones finished"""
+        send, read = self.paths(name)
+        rng = random.Random(21)
+        latest = {}  # chat_pk -> newest seq sent in this run
+        results = {'message': [], 'receipt': []}
+
+        async def frame(kind, access, user, scheduled):
+            if kind == 'message':
+                seq = await send(access, user, f'bench {name}')
+                latest[access.chat_pk] = max(latest.get(access.chat_pk, 0), seq)
+            else:
+                await read(access.chat_pk, access.chat_id, user, latest[access.chat_pk])
+            # From when the frame arrived, so time spent queued counts
+            results[kind].append(time.perf_counter() - scheduled)
+
+        tasks = []
+        start = time.perf_counter()
+        arrival = start
+        while arrival - start < options['seconds']:
+            arrival += rng.expovariate(options['rate'])
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            access, members = rng.choice(chats)
+            kind = 'message'
+            if access.chat_pk in latest and rng.random() >= options['message_share']:
+                kind = 'receipt'
+            tasks.append(asyncio.ensure_future(frame(kind, access, rng.choice(members), arrival)))
+        await asyncio.gather(*tasks)
+        return results, time.perf_counter() - start
+
+    def report(self, results, elapsed):
+        self.stdout.write(f"  {'frame':>8} {'count':>7} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+        for kind, latencies in results.items():
+            if not latencies:
+                continue
+            latencies.sort()
+
+            def pct(fraction):
+                return latencies[int(fraction * (len(latencies) - 1))] * 1000
+
+            self.stdout.write(
+                f'  {kind:>8} {len(latencies):>7} {pct(0.5):>8.1f} {pct(0.95):>8.1f} '
+                f'{pct(0.99):>8.1f} {latencies[-1] * 1000:>8.1f}'
+            )
+        frames = sum(len(latencies) for latencies in results.values())
+        self.stdout.write(f'  {frames / elapsed:.0f} frames/s completed')
@@ -0,0 +1,72 @@
+# Management command to benchmark the message ingest path
+# management/commands/bench_ingest.py
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection
+from whats_app.models import User, Chat, ChatParticipant, Group, OutboxEvent
+from whats_app import messaging
+from whats_app.access import load_chat_access
+from whats_app.realtime import chat_group_name
+
+
+class Command(BaseCommand):
+    help = 'Benchmark messaging.send_message throughput for different chat sizes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='2,50,1000', help='Comma separated member counts')
+        parser.add_argument('--messages', type=int, default=200, help='Messages sent per chat')
+
+    def handle(self, *args, **options):
+        sizes = [int(size) for size in options['sizes'].split(',')]
+
+        self.stdout.write(f"{'members':>8} {'msgs/s':>10} {'ms/msg':>8} {'queries/msg':>12}")
+        for size in sizes:
+            # Each send commits and drains the outbox as in production, so
+            # the bench chat and users are deleted afterwards instead
+            chat, users = self.setup(size)
+            try:
+                self.bench(chat, users, options['messages'])
+            finally:
+                self.teardown(chat, users)
+
+    def setup(self, size):
+        stamp = int(time.time()) % 100000
+        users = User.objects.bulk_create([
+            User(username=f'bench_{stamp}_{size}_{i}', phone_number=f'+999{stamp:05d}{size:05d}{i:05d}')
+            for i in range(size)
+        ])
+        chat_type = 'private' if size == 2 else 'group'
+        chat = Chat.objects.create(chat_type=chat_type)
+        if chat_type == 'group':
+            Group.objects.create(chat=chat, name=f'Bench {size}', created_by=users[0])
+        for user in users:
+            ChatParticipant.objects.create(chat=chat, user=user)
+        return chat, users
+
+    def teardown(self, chat, users):
+        OutboxEvent.objects.filter(group=chat_group_name(chat.chat_id)).delete()
+        chat.delete()
+        User.objects.filter(pk__in=[user.pk for user in users]).delete()
+
+    def bench(self, chat, users, count):
+        size = len(users)
+        sender = users[0]
+        access = load_chat_access(chat.chat_id)
+
+        queries = 0
+
+        def count_queries(execute, sql, params, many, context):
+            nonlocal queries
+            queries += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(count_queries):
+            start = time.perf_counter()
+            for i in range(count):
+                messaging.send_message(access, sender, f'bench message {i}', client_id=f'bench-{size}-{i}')
+            elapsed = time.perf_counter() - start
+
+        self.stdout.write(
+            f'{size:>8} {count / elapsed:>10.1f} {elapsed / count * 1000:>8.2f} '
+            f'{queries / count:>12.1f}'
+        )
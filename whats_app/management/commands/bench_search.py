@@ -0,0 +1,94 @@
+# Management command to benchmark full-text message search
+# management/commands/bench_search.py
+import itertools
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+from whats_app.models import User, Chat, ChatParticipant, InboxEntry, Message
+from whats_app import search
+
+BATCH_SIZE = 10000
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = 'Load synthetic messages and measure search.search_messages latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=1000000, help='Synthetic messages to load')
+        parser.add_argument('--chats', type=int, default=1000, help='Chats the messages are spread over')
+        parser.add_argument('--user-chats', type=int, default=50, help='Chats the searching user is in')
+        parser.add_argument('--queries', type=int, default=200, help='Queries per term class')
+        parser.add_argument('--vocabulary', type=int, default=50000, help='Distinct words')
+
+    def handle(self, *args, **options):
+        try:
+            # The synthetic data is rolled back at the end
+            with transaction.atomic():
+                self.bench(options)
+                raise Rollback
+        except Rollback:
+            pass
+
+    def bench(self, options):
+        rng = random.Random(42)
+        vocabulary = [f'w{i}' for i in range(options['vocabulary'])]
+        # Zipf-like word frequencies, as in real chat text
+        cum_weights = list(itertools.accumulate(1 / (rank + 1) for rank in range(len(vocabulary))))
+
+        owner = User.objects.create(username='bench_search_owner', phone_number='+99900000000')
+        other = User.objects.create(username='bench_search_other', phone_number='+99900000001')
+        chats = Chat.objects.bulk_create([Chat(chat_type='private') for _ in range(options['chats'])])
+        user_chats = chats[:options['user_chats']]
+        ChatParticipant.objects.bulk_create(
+            [ChatParticipant(chat=chat, user=owner) for chat in user_chats]
+            + [ChatParticipant(chat=chat, user=other) for chat in chats]
+        )
+        InboxEntry.objects.bulk_create([
+            InboxEntry(user=owner, chat=chat, peer=other, name=other.username, last_activity_at=timezone.now())
+            for chat in user_chats
+        ])
+
+        self.stdout.write(f"Loading {options['messages']} messages...")
+        start = time.perf_counter()
+        seqs = {chat.pk: 0 for chat in chats}
+        loaded = 0
+        while loaded < options['messages']:
+            batch = []
+            for _ in range(min(BATCH_SIZE, options['messages'] - loaded)):
+                chat = rng.choice(chats)
+                seqs[chat.pk] += 1
+                words = rng.choices(vocabulary, cum_weights=cum_weights, k=rng.randint(3, 15))
+                batch.append(Message(chat=chat, sender=other, seq=seqs[chat.pk], content=' '.join(words)))
+            Message.objects.bulk_create(batch)
+            loaded += len(batch)
+        self.stdout.write(f'Loaded in {time.perf_counter() - start:.1f}s (index built by triggers)')
+
+        term_classes = {
+            'common word': vocabulary[:10],
+            'mid word': vocabulary[100:1000],
+            'rare word': vocabulary[-1000:],
+            'two words': [f'{a} {b}' for a, b in zip(vocabulary[:50], vocabulary[50:100])],
+            'prefix': [word[:3] for word in vocabulary[10:100]],
+        }
+
+        self.stdout.write(f"{'query':>12} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8} {'hits':>6}")
+        for name, terms in term_classes.items():
+            timings, hits = [], 0
+            for _ in range(options['queries']):
+                query = rng.choice(terms)
+                start = time.perf_counter()
+                hits += len(search.search_messages(owner, query))
+                timings.append((time.perf_counter() - start) * 1000)
+            timings.sort()
+            self.stdout.write(
+                f'{name:>12} {statistics.median(timings):>8.2f} '
+                f'{timings[int(len(timings) * 0.95) - 1]:>8.2f} {timings[-1]:>8.2f} '
+                f'{hits / len(timings):>6.1f}'
+            )
@@ -0,0 +1,125 @@
+# Management command to compare WebSocket frame encodings
+# management/commands/bench_wire.py
+import random
+import time
+import uuid
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from whats_app import wire
+
+WORDS = ['hey', 'sawa', 'meeting', 'tomorrow', 'ok', 'thanks', 'see', 'you', 'at', 'the',
+         'office', 'habari', 'yako', 'nzuri', 'sana', 'lunch', '😂', 'call', 'me', 'later']
+
+
+class Command(BaseCommand):
+    help = ('Bytes per message and encode/decode CPU for each wire codec on a synthetic chat stream, '
+            'and CPU per group broadcast fan-out')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=20000, help='Message frames in the stream')
+        parser.add_argument('--senders', type=int, default=20, help='Distinct senders in the stream')
+        parser.add_argument('--rate', type=int, default=10000, help='Messages per second to report CPU share at')
+        parser.add_argument('--fanout', type=int, default=1000, help='Sockets receiving each broadcast')
+        parser.add_argument('--broadcasts', type=int, default=200, help='Broadcasts in the fan-out run')
+
+    def handle(self, *args, **options):
+        frames = self.stream(options['messages'], options['senders'])
+        codecs = [wire.JSONCodec] + list(wire.CODECS.values())
+
+        self.stdout.write(
+            f"{'codec':>26} {'bytes/msg':>10} {'encode us':>10} {'decode us':>10} "
+            f"{'CPU @ ' + str(options['rate']) + '/s':>14}"
+        )
+        for codec_class in codecs:
+            # Fresh codec per run: the sender cache is per connection
+            codec = codec_class()
+            start = time.perf_counter()
+            encoded = []
+            for chat_id, message in frames:
+                for frame in codec.sender_frames(sender_of(message)):
+                    encoded.append(codec.encode(frame))
+                encoded.append(codec.encode(codec.message_frame(chat_id, message)))
+            encode_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            for kwargs in encoded:
+                codec.decode(**kwargs)
+            decode_time = time.perf_counter() - start
+
+            size = sum(len(kwargs.get('bytes_data') or kwargs['text_data'].encode()) for kwargs in encoded)
+            per_message = 1e6 / len(frames)
+            cpu_share = encode_time / len(frames) * options['rate'] * 100
+            self.stdout.write(
+                f"{codec_class.protocol or 'json (default)':>26} {size / len(frames):>10.1f} "
+                f'{encode_time * per_message:>10.2f} {decode_time * per_message:>10.2f} '
+                f'{cpu_share:>13.1f}%'
+            )
+        self.stdout.write('CPU is the share of one core spent encoding; sender frames are included in bytes')
+        self.fanout(frames[:options['broadcasts']], options['fanout'])
+
+    def fanout(self, events, sockets):
+        """
+        CPU to deliver each broadcast to `sockets` consumers with a mix of codecs:
+        every consumer encoding the message itself vs forwarding the frames
+        pre-encoded by wire.broadcast_event
+        """
+        codec_classes = [wire.JSONCodec] + list(wire.CODECS.values())
+
+        def connections():
+            return [codec_classes[index % len(codec_classes)]() for index in range(sockets)]
+
+        per_recipient = connections()
+        start = time.perf_counter()
+        for chat_id, message in events:
+            for codec in per_recipient:
+                for frame in codec.sender_frames(sender_of(message)):
+                    codec.encode(frame)
+                codec.encode(codec.message_frame(chat_id, message))
+        per_recipient_time = (time.perf_counter() - start) / len(events)
+
+        forwarding = connections()
+        start = time.perf_counter()
+        for chat_id, message in events:
+            event = wire.broadcast_event(chat_id, message)
+            for codec in forwarding:
+                for frame in codec.sender_frames(event['sender']):
+                    codec.encode(frame)
+                event['frames'][codec.key]
+        forwarding_time = (time.perf_counter() - start) / len(events)
+
+        self.stdout.write(f'\nFan-out to {sockets} sockets (codecs mixed evenly), per broadcast:')
+        self.stdout.write(f'  encode per recipient   {per_recipient_time * 1000:>8.3f} ms')
+        self.stdout.write(f'  encode once, forward   {forwarding_time * 1000:>8.3f} ms '
+                          f'({per_recipient_time / forwarding_time:.0f}x less CPU)')
+
+    def stream(self, count, sender_count):
+        """(chat_id, message) events shaped like history.serialize_message output"""
+        rng = random.Random(7)
+        senders = [
+            (f'+2547{index:08d}', f'user{index}', f'/media/profiles/user{index}.jpg')
+            for index in range(sender_count)
+        ]
+        chats = [str(uuid.uuid4()) for _ in range(max(sender_count // 4, 1))]
+        now = timezone.now()
+
+        events = []
+        for seq in range(1, count + 1):
+            phone_number, name, photo = rng.choice(senders)
+            events.append((rng.choice(chats), {
+                'id': str(uuid.uuid4()),
+                'seq': seq,
+                'sender': phone_number,
+                'sender_name': name,
+                'sender_photo': photo,
+                'content': ' '.join(rng.choices(WORDS, k=rng.randint(2, 12))),
+                'message_type': 'text',
+                'timestamp': now.isoformat(),
+                'is_edited': False,
+                'is_deleted': False,
+                'reply_to': None,
+            }))
+        return events
+
+
+def sender_of(message):
+    return {'user': message['sender'], 'name': message['sender_name'], 'photo': message['sender_photo']}
@@ -0,0 +1,62 @@
+# Management command to verify hot queries use their intended indexes
+# management/commands/check_query_plans.py
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+from whats_app.models import AIMessage, ChatParticipant, InboxEntry, Message, Status
+
+
+def hot_queries():
+    """(description, queryset, index name the plan should use) for each hot path"""
+    now = timezone.now()
+    return [
+        ('chat list (chat_home)',
+         InboxEntry.objects.filter(user_id=1).order_by('-last_activity_at'),
+         'inbox_user_activity_idx'),
+        ('history page (history.fetch_page)',
+         Message.objects.filter(chat_id=1).order_by('-created_at', '-id')[:50],
+         'message_chat_created_idx'),
+        ('gap-fill sync (history.fetch_after_seq)',
+         Message.objects.filter(chat_id=1, seq__gt=10).order_by('seq')[:200],
+         'message_chat_seq_unique'),
+        ('unread recount (inbox.mark_read, reconcile_unread)',
+         Message.objects.filter(chat_id=1, seq__gt=10).exclude(sender_id=1).values('pk'),
+         'message_chat_seq_unique'),
+        ("user's chats (UserConsumer.get_chat_ids)",
+         ChatParticipant.objects.filter(user_id=1).values('chat_id'),
+         'participant_user_chat_idx'),
+        ('contact statuses (status_view)',
+         Status.objects.filter(user_id__in=[1, 2, 3], expires_at__gt=now),
+         'status_user_expiry_idx'),
+        ('AI transcript (ai_chat)',
+         AIMessage.objects.filter(conversation_id=1).order_by('created_at'),
+         'aimessage_conv_created_idx'),
+        ('AI context window (ai_context.build_prompt)',
+         AIMessage.objects.filter(conversation_id=1, pk__gt=0).only('pk', 'is_user', 'content').order_by('-pk')[:100],
+         'aimessage_conv_id_idx'),
+    ]
+
+
+class Command(BaseCommand):
+    help = 'EXPLAIN the hot queries and fail if any does not use its intended index'
+
+    def handle(self, *args, **options):
+        failures = []
+
+        with transaction.atomic():
+            if connection.vendor == 'postgresql':
+                # Small development tables make sequential scans look cheaper
+                with connection.cursor() as cursor:
+                    cursor.execute('SET LOCAL enable_seqscan = off')
+
+            for description, queryset, index in hot_queries():
+                plan = queryset.explain()
+                if index in plan:
+                    self.stdout.write(self.style.SUCCESS(f'OK    {description}: {index}'))
+                else:
+                    failures.append(description)
+                    self.stdout.write(self.style.ERROR(f'FAIL  {description}: expected {index}'))
+                    self.stdout.write(f'      {plan}')
+
+        if failures:
+            raise CommandError(f'{len(failures)} queries do not use their intended index')
@@ -0,0 +1,38 @@
+# Management command to relay outbox events to the channel layer
+# management/commands/outbox_relay.py
+import logging
+import time
+from django.core.management.base import BaseCommand
+from whats_app import outbox
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = ('Deliver stored broadcast events (whats_app.outbox) to the channel layer in batches. '
+            'Run one relay alongside the ASGI servers')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Drain the outbox once and exit')
+        parser.add_argument('--batch-size', type=int, default=outbox.BATCH_SIZE)
+        parser.add_argument('--interval', type=float, default=outbox.POLL_INTERVAL,
+                            help='Seconds to wait when the outbox is empty')
+
+    def handle(self, *args, **options):
+        while True:
+            try:
+                sent = outbox.relay_batch(options['batch_size'])
+            except Exception:
+                # Channel layer or database unavailable: the batch stays
+                # in the outbox and is retried
+                logger.exception("Outbox relay batch failed")
+                sent = 0
+                if options['once']:
+                    raise
+
+            if sent:
+                logger.debug("Relayed %d outbox events", sent)
+            if sent < options['batch_size']:
+                if options['once']:
+                    return
+                time.sleep(options['interval'])
@@ -0,0 +1,33 @@
+# Management command to reconcile unread counters with the read watermarks
+# management/commands/repair_unread_counts.py
+from django.core.management.base import BaseCommand
+from whats_app.models import User
+from whats_app import inbox
+
+
+class Command(BaseCommand):
+    help = ('Recount per-chat unread counts and per-user unread totals from the read '
+            'watermarks and correct any drift. Safe to run periodically (e.g. from cron)')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--user', type=int, action='append', dest='users',
+                            help='Only reconcile this user id (repeatable)')
+
+    def handle(self, *args, **options):
+        # Every user, so totals left behind by cascaded inbox rows are found too
+        users = options['users'] or User.objects.values_list('pk', flat=True).order_by('pk').iterator()
+
+        checked = drifted = rows = totals = 0
+        for user_pk in users:
+            fixed_rows, fixed_totals = inbox.reconcile_unread(user_pk)
+            checked += 1
+            rows += fixed_rows
+            totals += fixed_totals
+            if fixed_rows or fixed_totals:
+                drifted += 1
+                self.stdout.write(f'user {user_pk}: {fixed_rows} chat counts, '
+                                  f'totals {"corrected" if fixed_totals else "ok"}')
+
+        summary = (f'Checked {checked} users: {drifted} had drift '
+                   f'({rows} chat counts and {totals} user totals corrected)')
+        self.stdout.write(self.style.WARNING(summary) if drifted else self.style.SUCCESS(summary))
@@ -7,9 +7,10 @@ import uuid
 
 from whats_app.models import (
     User, Contact, Chat, ChatParticipant, Group, GroupAdmin,
-    Message, MessageStatus, Status, StatusView, Channel, 
+    Message, Status, StatusView, Channel, 
     ChannelFollower, ChannelPost, AIAssistant, AIConversation, AIMessage
 )
+from whats_app import inbox, receipts
 
 # Kenyan phone numbers
 KENYAN_PHONES = [
@@ -332,6 +333,19 @@ class Command(BaseCommand):
             # Add a conversation
             if random.random() > 0.3:
                 self.add_conversation(chat, user1, user2)
+                self.add_receipts(chat, [user1, user2])
+
+    def add_receipts(self, chat, members):
+        """Move each member's delivered/read watermark to a random point"""
+        chat.refresh_from_db(fields=['last_seq'])
+        for member in members:
+            seq = random.randint(0, chat.last_seq)
+            if random.choice([True, False]):
+                if receipts.mark_read(chat.pk, member.pk, seq):
+                    inbox.mark_read(member.pk, chat.pk, seq)
+            else:
+                receipts.mark_delivered(chat.pk, member.pk, seq)
+        inbox.refresh_receipt(chat.pk)
 
     def add_conversation(self, chat, user1, user2):
         """Add a realistic conversation to a chat"""
@@ -352,14 +366,6 @@ class Command(BaseCommand):
                     content=msg_text,
                     created_at=timezone.now() - timedelta(hours=random.randint(1, 48))
                 )
-                
-                # Create message status only for receiver (not sender)
-                # Use get_or_create to avoid duplicates
-                MessageStatus.objects.get_or_create(
-                    message=msg,
-                    user=receiver,
-                    defaults={'status': random.choice(['delivered', 'read'])}
-                )
         else:
             # Random messages
             num_messages = random.randint(3, 10)
@@ -376,14 +382,6 @@ class Command(BaseCommand):
                     content=random.choice(message_pool),
                     created_at=timezone.now() - timedelta(hours=random.randint(1, 72))
                 )
-                
-                # Create message status only for receiver
-                # Use get_or_create to avoid duplicates
-                MessageStatus.objects.get_or_create(
-                    message=msg,
-                    user=receiver,
-                    defaults={'status': random.choice(['sent', 'delivered', 'read'])}
-                )
 
     def create_groups(self, users):
         """Create WhatsApp groups"""
@@ -436,16 +434,8 @@ class Command(BaseCommand):
                     content=random.choice(GROUP_MESSAGES + CASUAL_MESSAGES),
                     created_at=timezone.now() - timedelta(hours=random.randint(1, 168))
                 )
-                
-                # Create message status for all members except sender
-                # Use get_or_create to avoid duplicates
-                for member in members:
-                    if member != sender:
-                        MessageStatus.objects.get_or_create(
-                            message=msg,
-                            user=member,
-                            defaults={'status': random.choice(['sent', 'delivered', 'read'])}
-                        )
+            
+            self.add_receipts(chat, members)
 
     def create_statuses(self, users):
         """Create WhatsApp statuses"""
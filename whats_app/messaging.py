@@ -0,0 +1,172 @@
+# messaging.py - The write paths for chat messages and read receipts
+#
+# Views and the WebSocket consumers both go through these functions.
+# Authorization is answered from a cached ChatAccess, and a message costs the
+# same handful of statements whatever the chat size: receipts are
+# per-participant watermarks and the inbox is updated with one UPDATE per
+# side, so nothing is inserted per recipient. Each write and its broadcast
+# are stored in one transaction and delivered through whats_app.outbox; a
+# message broadcast is encoded once for all recipients.
+#
+# A send may carry a client_id so that retries are idempotent: the first
+# send with a given (sender, client_id) is stored, later ones to the same
+# chat return that message without another insert or broadcast, and ones to
+# a different chat are rejected. Recent ids are answered from the cache;
+# older ones are caught by the unique constraint. Either way the sender must
+# still be allowed to post.
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+from .models import DeletedMessage, Message
+from . import history, inbox, outbox, receipts, realtime, wire
+
+
+CLIENT_MESSAGE_ID_TTL = getattr(settings, 'CLIENT_MESSAGE_ID_TTL', 600)
+CLIENT_ID_MAX_LENGTH = Message._meta.get_field('client_id').max_length
+
+
+class MessageRejected(Exception):
+    """The sender may not post this message; str() is safe to show the user"""
+
+
+def send_message(access, sender, content, message_type='text', reply_to_id=None, client_id=None):
+    """
+    Validate, store and broadcast a new message in the chat described by
+    `access` (a whats_app.access.ChatAccess). Returns (message, created);
+    created is False when `client_id` matches an earlier send by `sender`, and
+    message is then that original. Raises MessageRejected.
+    """
+    # Retries are authorized like first sends: a sender who lost access gets no answer
+    error = access.send_error(sender.pk)
+    if error:
+        raise MessageRejected(error)
+
+    if client_id is not None:
+        if not isinstance(client_id, str) or not 0 < len(client_id) <= CLIENT_ID_MAX_LENGTH:
+            raise MessageRejected('Invalid client_id')
+        original = cache.get(_client_id_key(sender.pk, client_id))
+        if original is not None:
+            return _duplicate(access, original), False
+
+    reply_to = None
+    if reply_to_id:
+        try:
+            reply_to = Message.objects.filter(chat_id=access.chat_pk, message_id=reply_to_id).first()
+        except ValidationError:
+            reply_to = None
+        if reply_to is None:
+            raise MessageRejected('Replied-to message not found in this chat')
+
+    try:
+        with transaction.atomic():
+            # Signals advance the sender's watermark and update the inbox
+            # inside this transaction
+            message = Message.objects.create(
+                chat_id=access.chat_pk,
+                sender=sender,
+                content=content,
+                message_type=message_type,
+                reply_to=reply_to,
+                client_id=client_id
+            )
+            # Encoded once here rather than by every receiving socket
+            outbox.enqueue(
+                realtime.chat_group_name(access.chat_id),
+                wire.broadcast_event(access.chat_id, history.serialize_message(message)),
+            )
+    except IntegrityError:
+        # A retry that missed the cache: the constraint rejected the insert
+        original = client_id and Message.objects.filter(sender=sender, client_id=client_id).first()
+        if not original:
+            raise
+        _remember(original)
+        return _duplicate(access, original), False
+
+    if client_id is not None:
+        transaction.on_commit(lambda: _remember(message))
+    return message, True
+
+
+def mark_delivered(message):
+    """Advance the recipients' delivered watermark to a message that has been broadcast"""
+    if receipts.mark_delivered_to_chat(message.chat_id, message.sender_id, message.seq):
+        inbox.refresh_receipt(message.chat_id)
+
+
+def _duplicate(access, original):
+    """`original` if it is this chat's, as a retry would be; otherwise the id was reused"""
+    if original.chat_id != access.chat_pk:
+        raise MessageRejected('client_id was already used for a message in another chat')
+    return original
+
+
+def _client_id_key(sender_pk, client_id):
+    return f'client_message:{sender_pk}:{client_id}'
+
+
+def _remember(message):
+    """Cache what a retried send needs to answer without the database"""
+    cache.set(_client_id_key(message.sender_id, message.client_id), Message(
+        pk=message.pk,
+        message_id=message.message_id,
+        chat_id=message.chat_id,
+        sender_id=message.sender_id,
+        seq=message.seq,
+        client_id=message.client_id,
+        created_at=message.created_at,
+    ), CLIENT_MESSAGE_ID_TTL)
+
+
+def edit_message(message, content):
+    """Replace a message's text and tell the chat"""
+    with transaction.atomic():
+        message.content = content
+        message.is_edited = True
+        message.edited_at = timezone.now()
+        message.save()
+        _broadcast_update(message)
+
+
+def delete_message(message, user, for_everyone=False):
+    """Mark a message deleted, keeping the original text in DeletedMessage"""
+    with transaction.atomic():
+        DeletedMessage.objects.create(
+            message=message,
+            deleted_by=user,
+            deleted_for_everyone=for_everyone,
+            original_content=message.content
+        )
+        message.is_deleted = True
+        message.deleted_at = timezone.now()
+        if for_everyone:
+            message.content = "This message was deleted"
+        message.save()
+        _broadcast_update(message)
+
+
+def _broadcast_update(message):
+    chat_id = str(message.chat.chat_id)
+    outbox.enqueue(
+        realtime.chat_group_name(chat_id),
+        wire.broadcast_event(chat_id, history.serialize_message(message), 'message_updated'),
+    )
+
+
+def mark_read(chat_pk, chat_id, user, seq):
+    """
+    Move `user`'s read watermark to `seq`, update their unread count and
+    tell the chat. Returns True if the watermark moved.
+    """
+    with transaction.atomic():
+        if not receipts.mark_read(chat_pk, user.pk, seq):
+            return False
+        inbox.mark_read(user.pk, chat_pk, seq)
+        outbox.enqueue(realtime.chat_group_name(chat_id), {
+            'type': 'read_receipt',
+            'chat_id': str(chat_id),
+            'read_up_to': seq,
+            'user': user.phone_number,
+        })
+    return True
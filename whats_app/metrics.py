@@ -0,0 +1,104 @@
+# metrics.py - Per-connection database query counts for the consumers
+#
+# Every database connection gets an execute wrapper that charges each query
+# to the ConnectionMetrics of the socket whose task ran it. The metrics object
+# travels in a context variable: a consumer sets it once at connect, and
+# database_sync_to_async and tasks spawned by the consumer inherit it.
+#
+# Frames a socket did not get to handle or receive (rate limited, or
+# dropped and coalesced by its send queue) are counted too, per socket for
+# its closing log line and for the process in stats().
+import collections
+import contextvars
+import logging
+import threading
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+_current = contextvars.ContextVar('whats_app_connection_metrics', default=None)
+
+_drops_lock = threading.Lock()
+_drops = collections.Counter()  # (reason, frame type) -> count, across the process's sockets
+
+
+class ConnectionMetrics:
+    """Frames handled and queries run by one socket, in total and per frame type"""
+
+    def __init__(self, label):
+        self.label = label
+        self.frames = 0
+        self.queries = 0
+        self.by_type = {}  # frame type -> [frames, queries]
+        self.drops = {}  # (reason, frame type) -> count
+
+    def activate(self):
+        """Charge queries run from the current task (and its children) to this socket"""
+        _current.set(self)
+
+    def frame(self, frame_type):
+        return _FrameScope(self, frame_type)
+
+    def drop(self, reason, frame_type):
+        """Count a frame that was rate_limited, dropped, coalesced or lost to an overflow"""
+        key = (reason, frame_type)
+        self.drops[key] = self.drops.get(key, 0) + 1
+        with _drops_lock:
+            _drops[key] += 1
+
+    def log_summary(self):
+        per_frame = self.queries / self.frames if self.frames else 0
+        breakdown = ', '.join(
+            f'{frame_type}: {queries}/{frames}'
+            for frame_type, (frames, queries) in sorted(self.by_type.items())
+        )
+        drops = ', '.join(
+            f'{reason} {frame_type}: {count}'
+            for (reason, frame_type), count in sorted(self.drops.items())
+        )
+        logger.info(
+            "%s closed: %d frames, %d queries (%.2f per frame) [%s] drops [%s]",
+            self.label, self.frames, self.queries, per_frame, breakdown, drops
+        )
+
+
+def stats():
+    """Frames rate limited, dropped, coalesced and lost to overflows by this process's sockets"""
+    with _drops_lock:
+        drops = dict(_drops)
+    snapshot = {reason: 0 for reason in ('rate_limited', 'dropped', 'coalesced', 'overflow')}
+    by_type = {}
+    for (reason, frame_type), count in sorted(drops.items()):
+        snapshot[reason] = snapshot.get(reason, 0) + count
+        by_type.setdefault(reason, {})[frame_type] = count
+    snapshot['by_type'] = by_type
+    return snapshot
+
+
+class _FrameScope:
+    def __init__(self, metrics, frame_type):
+        self.metrics = metrics
+        self.frame_type = frame_type
+
+    def __enter__(self):
+        self.start = self.metrics.queries
+
+    def __exit__(self, *exc_info):
+        counts = self.metrics.by_type.setdefault(self.frame_type, [0, 0])
+        counts[0] += 1
+        counts[1] += self.metrics.queries - self.start
+        self.metrics.frames += 1
+
+
+def _count_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.queries += 1
+    return execute(sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_counter(sender, connection, **kwargs):
+    if _count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_count_query)
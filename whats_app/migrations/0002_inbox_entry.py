@@ -0,0 +1,105 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:07
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_inbox(apps, schema_editor):
+    """Build one InboxEntry per existing ChatParticipant"""
+    ChatParticipant = apps.get_model('whats_app', 'ChatParticipant')
+    Contact = apps.get_model('whats_app', 'Contact')
+    Group = apps.get_model('whats_app', 'Group')
+    InboxEntry = apps.get_model('whats_app', 'InboxEntry')
+    Message = apps.get_model('whats_app', 'Message')
+    MessageStatus = apps.get_model('whats_app', 'MessageStatus')
+
+    entries = []
+    for participant in ChatParticipant.objects.select_related('chat', 'user').iterator():
+        chat = participant.chat
+        peer, name, photo = None, '', ''
+
+        if chat.chat_type == 'private':
+            other = ChatParticipant.objects.filter(chat=chat).exclude(user=participant.user).select_related('user').first()
+            if other:
+                peer = other.user
+                contact = Contact.objects.filter(user=participant.user, contact_user=peer).first()
+                name = contact.name if contact else peer.phone_number
+                photo = peer.profile_picture.url if peer.profile_picture else ''
+        else:
+            group = Group.objects.filter(chat=chat).first()
+            if group:
+                name = group.name
+                photo = group.icon.url if group.icon else ''
+
+        entry = InboxEntry(
+            user=participant.user,
+            chat=chat,
+            peer=peer,
+            name=name,
+            photo=photo,
+            is_pinned=participant.is_pinned,
+            is_archived=participant.is_archived,
+            is_muted=participant.is_muted,
+            last_activity_at=chat.created_at,
+        )
+
+        last_message = Message.objects.filter(chat=chat).order_by('-created_at').first()
+        if last_message:
+            entry.last_message = last_message
+            entry.last_message_sender_id = last_message.sender_id
+            entry.last_message_preview = (last_message.content or last_message.message_type)[:255]
+            entry.last_message_at = last_message.created_at
+            entry.last_activity_at = last_message.created_at
+            entry.unread_count = Message.objects.filter(chat=chat).exclude(
+                sender=participant.user
+            ).exclude(
+                statuses__user=participant.user,
+                statuses__status='read'
+            ).count()
+
+            statuses = set(MessageStatus.objects.filter(message=last_message).values_list('status', flat=True))
+            if statuses == {'read'}:
+                entry.last_message_status = 'read'
+            elif statuses and 'sent' not in statuses:
+                entry.last_message_status = 'delivered'
+
+        entries.append(entry)
+
+    InboxEntry.objects.bulk_create(entries, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whats_app', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(blank=True, max_length=100)),
+                ('photo', models.CharField(blank=True, max_length=255)),
+                ('last_message_preview', models.CharField(blank=True, max_length=255)),
+                ('last_message_at', models.DateTimeField(blank=True, null=True)),
+                ('last_message_status', models.CharField(choices=[('sent', 'Sent'), ('delivered', 'Delivered'), ('read', 'Read')], default='sent', max_length=20)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('is_pinned', models.BooleanField(default=False)),
+                ('is_archived', models.BooleanField(default=False)),
+                ('is_muted', models.BooleanField(default=False)),
+                ('last_activity_at', models.DateTimeField()),
+                ('chat', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='whats_app.chat')),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='whats_app.message')),
+                ('last_message_sender', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('peer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user', '-last_activity_at'], name='inbox_user_activity_idx')],
+                'unique_together': {('user', 'chat')},
+            },
+        ),
+        migrations.RunPython(backfill_inbox, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,78 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:10
+
+from django.db import migrations, models
+
+
+def backfill_seq_and_watermarks(apps, schema_editor):
+    """Number existing messages per chat and fold MessageStatus rows into watermarks"""
+    Chat = apps.get_model('whats_app', 'Chat')
+    ChatParticipant = apps.get_model('whats_app', 'ChatParticipant')
+    Message = apps.get_model('whats_app', 'Message')
+    MessageStatus = apps.get_model('whats_app', 'MessageStatus')
+
+    for chat in Chat.objects.iterator():
+        seq = 0
+        seq_by_message = {}
+        batch = []
+        for message in Message.objects.filter(chat=chat).order_by('created_at', 'id').only('id').iterator():
+            seq += 1
+            message.seq = seq
+            seq_by_message[message.id] = seq
+            batch.append(message)
+        Message.objects.bulk_update(batch, ['seq'], batch_size=500)
+        chat.last_seq = seq
+        chat.save(update_fields=['last_seq'])
+
+        for participant in ChatParticipant.objects.filter(chat=chat):
+            # Own messages count as read by their sender
+            own = [seq_by_message[pk] for pk in Message.objects.filter(
+                chat=chat, sender_id=participant.user_id
+            ).values_list('id', flat=True)]
+            read = [seq_by_message[pk] for pk in MessageStatus.objects.filter(
+                message__chat=chat, user_id=participant.user_id, status='read'
+            ).values_list('message_id', flat=True)]
+            delivered = [seq_by_message[pk] for pk in MessageStatus.objects.filter(
+                message__chat=chat, user_id=participant.user_id, status__in=['delivered', 'read']
+            ).values_list('message_id', flat=True)]
+
+            participant.read_seq = max(own + read, default=0)
+            participant.delivered_seq = max(own + delivered, default=0)
+            participant.save(update_fields=['read_seq', 'delivered_seq'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whats_app', '0003_message_history_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chat',
+            name='last_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='delivered_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='chatparticipant',
+            name='read_seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='seq',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_seq_and_watermarks, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(fields=('chat', 'seq'), name='message_chat_seq_unique'),
+        ),
+        migrations.DeleteModel(
+            name='MessageStatus',
+        ),
+    ]
@@ -0,0 +1,16 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:18
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whats_app', '0005_user_last_seen_default'),
+    ]
+
+    operations = [
+        migrations.DeleteModel(
+            name='TypingStatus',
+        ),
+    ]
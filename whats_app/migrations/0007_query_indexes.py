@@ -0,0 +1,29 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whats_app', '0006_remove_typing_status'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='aimessage',
+            index=models.Index(fields=['conversation', 'created_at'], name='aimessage_conv_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='chatparticipant',
+            index=models.Index(fields=['user', 'chat'], name='participant_user_chat_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='inboxentry',
+            index=models.Index(condition=models.Q(('unread_count__gt', 0)), fields=['user'], name='inbox_user_unread_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='status',
+            index=models.Index(fields=['user', 'expires_at'], name='status_user_expiry_idx'),
+        ),
+    ]
@@ -0,0 +1,74 @@
+from django.db import migrations
+
+SQLITE_FORWARD = [
+    """
+    CREATE VIRTUAL TABLE whats_app_message_fts USING fts5(
+        content, chat_id,
+        content='whats_app_message', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER whats_app_message_fts_insert AFTER INSERT ON whats_app_message BEGIN
+        INSERT INTO whats_app_message_fts(rowid, content, chat_id)
+        VALUES (new.id, new.content, new.chat_id);
+    END
+    """,
+    """
+    CREATE TRIGGER whats_app_message_fts_delete AFTER DELETE ON whats_app_message BEGIN
+        INSERT INTO whats_app_message_fts(whats_app_message_fts, rowid, content, chat_id)
+        VALUES ('delete', old.id, old.content, old.chat_id);
+    END
+    """,
+    """
+    CREATE TRIGGER whats_app_message_fts_update AFTER UPDATE OF content, chat_id ON whats_app_message BEGIN
+        INSERT INTO whats_app_message_fts(whats_app_message_fts, rowid, content, chat_id)
+        VALUES ('delete', old.id, old.content, old.chat_id);
+        INSERT INTO whats_app_message_fts(rowid, content, chat_id)
+        VALUES (new.id, new.content, new.chat_id);
+    END
+    """,
+    "INSERT INTO whats_app_message_fts(whats_app_message_fts) VALUES ('rebuild')",
+]
+
+SQLITE_BACKWARD = [
+    "DROP TRIGGER IF EXISTS whats_app_message_fts_update",
+    "DROP TRIGGER IF EXISTS whats_app_message_fts_delete",
+    "DROP TRIGGER IF EXISTS whats_app_message_fts_insert",
+    "DROP TABLE IF EXISTS whats_app_message_fts",
+]
+
+POSTGRES_FORWARD = [
+    """
+    ALTER TABLE whats_app_message ADD COLUMN search_vector tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', coalesce(content, ''))) STORED
+    """,
+    "CREATE INDEX message_search_idx ON whats_app_message USING GIN (search_vector)",
+]
+
+POSTGRES_BACKWARD = [
+    "DROP INDEX IF EXISTS message_search_idx",
+    "ALTER TABLE whats_app_message DROP COLUMN IF EXISTS search_vector",
+]
+
+
+def run_for_vendor(statements):
+    def run(apps, schema_editor):
+        for statement in statements.get(schema_editor.connection.vendor, []):
+            schema_editor.execute(statement)
+    return run
+
+
+class Migration(migrations.Migration):
+    """Full-text index over message content, maintained by the database (see whats_app.search)"""
+
+    dependencies = [
+        ('whats_app', '0007_query_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            run_for_vendor({'sqlite': SQLITE_FORWARD, 'postgresql': POSTGRES_FORWARD}),
+            run_for_vendor({'sqlite': SQLITE_BACKWARD, 'postgresql': POSTGRES_BACKWARD}),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 4.2.7 on 2026-10-18 16:54
+
+from django.db import migrations, models
+from django.db.models import Count, Q, Sum
+
+
+def backfill_totals(apps, schema_editor):
+    """Sum the existing per-chat unread counts into the new user totals"""
+    InboxEntry = apps.get_model('whats_app', 'InboxEntry')
+    User = apps.get_model('whats_app', 'User')
+
+    totals = InboxEntry.objects.filter(unread_count__gt=0).values('user_id').annotate(
+        messages=Sum('unread_count'), chats=Count('pk', filter=Q(unread_count__gt=0))
+    )
+    for row in totals.iterator():
+        User.objects.filter(pk=row['user_id']).update(
+            unread_messages=row['messages'], unread_chats=row['chats']
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whats_app', '0008_message_search_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='user',
+            name='unread_chats',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='user',
+            name='unread_messages',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whats_app', '0011_message_client_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='aiconversation',
+            name='summary',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='aiconversation',
+            name='summary_through',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
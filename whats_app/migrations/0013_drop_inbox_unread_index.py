@@ -0,0 +1,17 @@
+# Generated by Django 4.2.7 on 2026-10-18 17:52
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whats_app', '0012_ai_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='inboxentry',
+            name='inbox_user_unread_idx',
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 4.2.7 on 2026-10-18 18:11
+
+from importlib import import_module
+from django.db import migrations, models
+import django.db.models.deletion
+
+search_index = import_module('whats_app.migrations.0008_message_search_index')
+
+
+def restore_search_triggers(apps, schema_editor):
+    # SQLite rebuilds whats_app_message for these changes, and dropping the
+    # old table drops the full-text triggers from 0008 with it
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    for statement in search_index.SQLITE_BACKWARD[:3] + search_index.SQLITE_FORWARD[1:]:
+        schema_editor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('whats_app', '0013_drop_inbox_unread_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, restore_search_triggers),
+        migrations.RemoveConstraint(
+            model_name='message',
+            name='message_chat_seq_unique',
+        ),
+        migrations.AlterField(
+            model_name='aimessage',
+            name='conversation',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='whats_app.aiconversation'),
+        ),
+        migrations.AddIndex(
+            model_name='aimessage',
+            index=models.Index(fields=['conversation', 'id'], name='aimessage_conv_id_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='message',
+            constraint=models.UniqueConstraint(models.F('chat'), models.F('seq'), name='message_chat_seq_unique'),
+        ),
+        migrations.RunPython(restore_search_triggers, migrations.RunPython.noop),
+    ]
@@ -1,4 +1,4 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import AbstractUser
 from django.utils import timezone
 import uuid
@@ -8,7 +8,11 @@ class User(AbstractUser):
     profile_picture = models.ImageField(upload_to='profiles/', null=True, blank=True)
     about = models.CharField(max_length=139, default="Hey there! I'm using WhatsApp")
     is_online = models.BooleanField(default=False)
-    last_seen = models.DateTimeField(auto_now=True)
+    last_seen = models.DateTimeField(default=timezone.now)  # written in batches by whats_app.presence
+    
+    # Totals over the user's inbox rows, maintained by whats_app.inbox
+    unread_messages = models.PositiveIntegerField(default=0)
+    unread_chats = models.PositiveIntegerField(default=0)
     qr_code = models.CharField(max_length=255, unique=True, null=True, blank=True)
     
     # Privacy Settings
@@ -65,9 +69,16 @@ class Chat(models.Model):
     
     chat_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     chat_type = models.CharField(max_length=10, choices=CHAT_TYPES)
+    last_seq = models.PositiveBigIntegerField(default=0)  # seq of the newest message
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    @classmethod
+    def allocate_seq(cls, chat_pk):
+        """Reserve the next message sequence number. Call inside a transaction"""
+        cls.objects.filter(pk=chat_pk).update(last_seq=models.F('last_seq') + 1)
+        return cls.objects.values_list('last_seq', flat=True).get(pk=chat_pk)
+
     def __str__(self):
         return f"{self.chat_type} - {self.chat_id}"
 
@@ -80,12 +91,20 @@ class ChatParticipant(models.Model):
     is_muted = models.BooleanField(default=False)
     joined_at = models.DateTimeField(auto_now_add=True)
     
+    # Receipt watermarks: every message with seq <= these has been delivered/read
+    delivered_seq = models.PositiveBigIntegerField(default=0)
+    read_seq = models.PositiveBigIntegerField(default=0)
+    
     # Custom settings per chat
     custom_wallpaper = models.ImageField(upload_to='chat_wallpapers/', null=True, blank=True)
     custom_theme = models.CharField(max_length=20, null=True, blank=True)
 
     class Meta:
         unique_together = ('chat', 'user')
+        indexes = [
+            # A user's chats (socket subscriptions, existing private chat lookup)
+            models.Index(fields=['user', 'chat'], name='participant_user_chat_idx'),
+        ]
 
     def __str__(self):
         return f"{self.user.phone_number} in {self.chat.chat_id}"
@@ -132,10 +151,12 @@ class Message(models.Model):
 
     message_id = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='messages')
+    seq = models.PositiveBigIntegerField(default=0)  # dense, per chat, assigned on insert
     sender = models.ForeignKey(User, on_delete=models.CASCADE)
     
     message_type = models.CharField(max_length=20, choices=MESSAGE_TYPES)
     content = models.TextField(blank=True)
+    client_id = models.CharField(max_length=64, null=True, blank=True)  # sender's dedupe key for retried sends
     
     # Media files
     media_file = models.FileField(upload_to='media/', null=True, blank=True)
@@ -151,25 +172,33 @@ class Message(models.Model):
     edited_at = models.DateTimeField(null=True, blank=True)
     
     created_at = models.DateTimeField(auto_now_add=True)
-    
-    def __str__(self):
-        return f"{self.sender.phone_number}: {self.content[:50]}"
 
+    class Meta:
+        indexes = [
+            # Keyset pagination over a chat's history (see whats_app.history)
+            models.Index(fields=['chat', 'created_at', 'id'], name='message_chat_created_idx'),
+        ]
+        constraints = [
+            # Written as expressions so that SQLite creates a real index under
+            # this name instead of an inline UNIQUE with an automatic one
+            models.UniqueConstraint(models.F('chat'), models.F('seq'), name='message_chat_seq_unique'),
+            models.UniqueConstraint(
+                fields=['sender', 'client_id'], name='message_sender_client_id_unique',
+                condition=models.Q(client_id__isnull=False),
+            ),
+        ]
 
-class MessageStatus(models.Model):
-    STATUS_CHOICES = [
-        ('sent', 'Sent'),
-        ('delivered', 'Delivered'),
-        ('read', 'Read'),
-    ]
+    def save(self, *args, **kwargs):
+        if not self.seq:
+            # Hold the chat row lock from allocation until the insert lands
+            with transaction.atomic():
+                self.seq = Chat.allocate_seq(self.chat_id)
+                super().save(*args, **kwargs)
+            return
+        super().save(*args, **kwargs)
     
-    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name='statuses')
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='sent')
-    timestamp = models.DateTimeField(auto_now=True)
-
-    class Meta:
-        unique_together = ('message', 'user')
+    def __str__(self):
+        return f"{self.sender.phone_number}: {self.content[:50]}"
 
 
 class DeletedMessage(models.Model):
@@ -181,14 +210,61 @@ class DeletedMessage(models.Model):
     deleted_at = models.DateTimeField(auto_now_add=True)
 
 
-class TypingStatus(models.Model):
-    chat = models.ForeignKey(Chat, on_delete=models.CASCADE)
-    user = models.ForeignKey(User, on_delete=models.CASCADE)
-    is_typing = models.BooleanField(default=False)
-    updated_at = models.DateTimeField(auto_now=True)
+class InboxEntry(models.Model):
+    """Denormalized chat list row, one per (user, chat). Maintained by whats_app.inbox"""
+    RECEIPT_STATUSES = [
+        ('sent', 'Sent'),
+        ('delivered', 'Delivered'),
+        ('read', 'Read'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='inbox_entries')
+    chat = models.ForeignKey(Chat, on_delete=models.CASCADE, related_name='inbox_entries')
+
+    # Resolved display info (contact name / group name, photo URL)
+    peer = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    name = models.CharField(max_length=100, blank=True)
+    photo = models.CharField(max_length=255, blank=True)
+
+    # Last message preview
+    last_message = models.ForeignKey(Message, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_sender = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='+')
+    last_message_preview = models.CharField(max_length=255, blank=True)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    last_message_status = models.CharField(max_length=20, choices=RECEIPT_STATUSES, default='sent')
+
+    unread_count = models.PositiveIntegerField(default=0)
+
+    # Mirrored from ChatParticipant
+    is_pinned = models.BooleanField(default=False)
+    is_archived = models.BooleanField(default=False)
+    is_muted = models.BooleanField(default=False)
+
+    # Sort key for the chat list: last message time, or chat creation time
+    last_activity_at = models.DateTimeField()
 
     class Meta:
-        unique_together = ('chat', 'user')
+        unique_together = ('user', 'chat')
+        indexes = [
+            models.Index(fields=['user', '-last_activity_at'], name='inbox_user_activity_idx'),
+        ]
+
+    @property
+    def is_online(self):
+        return self.peer.is_online if self.peer_id else False
+
+    def __str__(self):
+        return f"{self.user.phone_number} - {self.name}"
+
+
+class OutboxEvent(models.Model):
+    """A channel layer event written in the same transaction as the change it announces (whats_app.outbox)"""
+    group = models.CharField(max_length=100)
+    payload = models.BinaryField()  # msgpack-encoded event
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.group} #{self.pk}"
 
 
 class Call(models.Model):
@@ -249,6 +325,12 @@ class Status(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField()  # 24 hours from creation
 
+    class Meta:
+        indexes = [
+            # Unexpired statuses of a set of contacts
+            models.Index(fields=['user', 'expires_at'], name='status_user_expiry_idx'),
+        ]
+
     def save(self, *args, **kwargs):
         if not self.expires_at:
             self.expires_at = timezone.now() + timezone.timedelta(hours=24)
@@ -358,6 +440,10 @@ class AIConversation(models.Model):
     assistant = models.ForeignKey(AIAssistant, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
+    # Rolling summary of the messages up to and including summary_through
+    # (an AIMessage pk); the model sees it in place of those messages
+    summary = models.TextField(blank=True, default='')
+    summary_through = models.BigIntegerField(default=0)
 
     def __str__(self):
         return f"{self.user.phone_number} - AI Chat"
@@ -369,13 +455,23 @@ class AIMessage(models.Model):
         ('voice', 'Voice'),
     ]
     
-    conversation = models.ForeignKey(AIConversation, on_delete=models.CASCADE, related_name='messages')
+    # Indexed by aimessage_conv_id_idx below
+    conversation = models.ForeignKey(AIConversation, on_delete=models.CASCADE, related_name='messages',
+                                     db_index=False)
     is_user = models.BooleanField(default=True)  # True if from user, False if from AI
     message_type = models.CharField(max_length=10, choices=MESSAGE_TYPES, default='text')
     content = models.TextField()
     audio_file = models.FileField(upload_to='ai_audio/', null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # Conversation transcript (ai_chat)
+            models.Index(fields=['conversation', 'created_at'], name='aimessage_conv_created_idx'),
+            # Context window (ai_context), which reads by pk
+            models.Index(fields=['conversation', 'id'], name='aimessage_conv_id_idx'),
+        ]
+
     def __str__(self):
         sender = "User" if self.is_user else "AI"
         return f"{sender}: {self.content[:50]}"
\ No newline at end of file
@@ -0,0 +1,119 @@
+# outbox.py - Transactional outbox for channel layer broadcasts
+#
+# A write that other sockets must hear about (a new, edited or deleted
+# message, a read receipt, a membership or permission change) stores its
+# event as an OutboxEvent in the same transaction as the change, so an event
+# exists if and only if the write committed. Events are relayed to the
+# channel layer in id order and deleted once sent:
+#   - right after commit by the process that wrote them (OUTBOX_DRAIN_ON_COMMIT)
+#   - by `manage.py outbox_relay`, which also delivers anything a crashed
+#     process left behind
+# Delivery is at least once: a failure between sending and deleting a batch
+# sends it again, and clients ignore messages and receipts they already have.
+# A drain locks its batch, so concurrent drains take turns rather than
+# interleaving, and each chat's events go out in the order they were written.
+# Within a process only one thread drains at a time; a commit while it runs
+# makes it go round again instead of starting a second drain.
+# Consecutive events for the same group travel as one outbox.batch event.
+import logging
+import threading
+import msgpack
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import connection, transaction
+from .models import OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+DRAIN_ON_COMMIT = getattr(settings, 'OUTBOX_DRAIN_ON_COMMIT', True)
+BATCH_SIZE = getattr(settings, 'OUTBOX_BATCH_SIZE', 200)
+POLL_INTERVAL = getattr(settings, 'OUTBOX_POLL_INTERVAL', 0.5)
+
+_drain_lock = threading.Lock()
+_drain_requested = threading.Event()
+
+
+def enqueue(group, event):
+    """Store `event` for `group`; it is sent only if the surrounding transaction commits"""
+    OutboxEvent.objects.create(group=group, payload=msgpack.packb(event))
+    if DRAIN_ON_COMMIT and not _drain_scheduled():
+        transaction.on_commit(drain)
+
+
+def _drain_scheduled():
+    # One drain after commit covers every event the transaction wrote
+    return any(callback[1] is drain for callback in connection.run_on_commit)
+
+
+def drain(batch_size=BATCH_SIZE):
+    """Relay batches until the outbox is empty. Returns the number of events sent"""
+    sent = 0
+    _drain_requested.set()
+    # Set by a commit that found another thread draining; that thread
+    # checks again after it lets go of the lock
+    while _drain_requested.is_set():
+        if not _drain_lock.acquire(blocking=False):
+            return sent
+        try:
+            _drain_requested.clear()
+            while True:
+                count = relay_batch(batch_size)
+                sent += count
+                if count < batch_size:
+                    break
+        except Exception:
+            # Runs after the write committed and must not fail it; the rows
+            # stay in the outbox for the next drain or the relay
+            logger.exception("Outbox drain failed after %d events", sent)
+            return sent
+        finally:
+            _drain_lock.release()
+    return sent
+
+
+def relay_batch(batch_size=BATCH_SIZE):
+    """Send the oldest events and delete them. Returns the number sent"""
+    channel_layer = get_channel_layer()
+    if channel_layer is None:
+        return 0
+
+    with transaction.atomic():
+        if connection.vendor == 'sqlite':
+            # SQLite can't upgrade this transaction's read lock while another
+            # connection is writing, and select_for_update() is a no-op
+            # there; a write that matches nothing takes the write lock first
+            OutboxEvent.objects.filter(pk__lt=0).delete()
+        rows = list(
+            OutboxEvent.objects.select_for_update().order_by('pk')
+            .values_list('pk', 'group', 'payload')[:batch_size]
+        )
+        if not rows:
+            return 0
+
+        sends = coalesce((group, msgpack.unpackb(bytes(payload))) for _, group, payload in rows)
+        async_to_sync(_send_all)(channel_layer, sends)
+        # Deleted only after every send went out; a crash before this
+        # commit leaves the batch to be sent again
+        OutboxEvent.objects.filter(pk__in=[pk for pk, _, _ in rows]).delete()
+    return len(rows)
+
+
+def coalesce(events):
+    """Merge runs of consecutive events for one group into a single outbox.batch event"""
+    sends = []
+    for group, event in events:
+        if sends and sends[-1][0] == group:
+            previous = sends[-1][1]
+            if previous['type'] != 'outbox.batch':
+                previous = {'type': 'outbox.batch', 'events': [previous]}
+                sends[-1] = (group, previous)
+            previous['events'].append(event)
+        else:
+            sends.append((group, event))
+    return sends
+
+
+async def _send_all(channel_layer, sends):
+    for group, event in sends:
+        await channel_layer.group_send(group, event)
@@ -0,0 +1,228 @@
+# presence.py - Online/last-seen tracking without per-connect User writes
+#
+# Every socket registers a connection with the presence backend and keeps it
+# alive with heartbeats. A user is online while at least one connection is
+# live, across sockets, tabs and devices. Online/offline transitions are
+# pushed to the user's presence group (which only their contacts' sockets
+# join) and written to User.is_online/last_seen in coalesced batches.
+import asyncio
+import heapq
+import logging
+import time
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+from .db_executor import database_sync_to_async
+from .models import User
+
+logger = logging.getLogger(__name__)
+
+
+def presence_group_name(user_pk):
+    return f'presence_{user_pk}'
+
+
+class LocalPresenceBackend:
+    """In-process backend for development, single-process deployments and tests"""
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._connections = {}  # user_pk -> {conn_id: expires_at}
+        # (expires_at, user_pk, conn_id) for every expiry ever set, soonest
+        # first, like the Redis backend's ALL_CONNECTIONS. Entries superseded
+        # by a heartbeat or a disconnect are skipped when they come up.
+        self._expiries = []
+
+    def _touch(self, user_pk, conn_id, connections):
+        expires_at = time.monotonic() + self.ttl
+        connections[conn_id] = expires_at
+        heapq.heappush(self._expiries, (expires_at, user_pk, conn_id))
+
+    async def connect(self, user_pk, conn_id):
+        """Register a connection. Returns True if the user just came online"""
+        connections = self._connections.setdefault(user_pk, {})
+        was_online = bool(connections)
+        self._touch(user_pk, conn_id, connections)
+        return not was_online
+
+    async def heartbeat(self, user_pk, conn_id):
+        connections = self._connections.get(user_pk)
+        if connections is not None and conn_id in connections:
+            self._touch(user_pk, conn_id, connections)
+
+    async def disconnect(self, user_pk, conn_id):
+        """Drop a connection. Returns True if the user just went offline"""
+        connections = self._connections.get(user_pk)
+        if not connections or conn_id not in connections:
+            return False
+        del connections[conn_id]
+        if connections:
+            return False
+        del self._connections[user_pk]
+        return True
+
+    async def online_users(self, user_pks):
+        return {pk for pk in user_pks if self._connections.get(pk)}
+
+    async def expire(self):
+        """Drop connections that missed their heartbeats. Returns users that went offline"""
+        now = time.monotonic()
+        offline = []
+        # Only due entries are looked at, however many connections are live
+        while self._expiries and self._expiries[0][0] <= now:
+            expires_at, user_pk, conn_id = heapq.heappop(self._expiries)
+            connections = self._connections.get(user_pk)
+            if not connections or connections.get(conn_id) != expires_at:
+                continue
+            del connections[conn_id]
+            if not connections:
+                del self._connections[user_pk]
+                offline.append(user_pk)
+        return offline
+
+
+class RedisPresenceBackend:
+    """
+    Shared backend for multi-process deployments.
+
+    presence:<user_pk> is a sorted set of that user's connections scored by
+    expiry time, and presence:connections indexes all of them so any process
+    can sweep connections left behind by a process that died.
+    """
+
+    ALL_CONNECTIONS = 'presence:connections'
+
+    def __init__(self, ttl, url):
+        import redis.asyncio as redis
+
+        self.ttl = ttl
+        self.redis = redis.from_url(url)
+
+    def _key(self, user_pk):
+        return f'presence:{user_pk}'
+
+    async def connect(self, user_pk, conn_id):
+        expires_at = time.time() + self.ttl
+        async with self.redis.pipeline() as pipe:
+            pipe.zremrangebyscore(self._key(user_pk), 0, time.time())
+            pipe.zcard(self._key(user_pk))
+            pipe.zadd(self._key(user_pk), {conn_id: expires_at})
+            pipe.zadd(self.ALL_CONNECTIONS, {f'{user_pk}:{conn_id}': expires_at})
+            pipe.expire(self._key(user_pk), self.ttl * 2)
+            _, existing, *_ = await pipe.execute()
+        return existing == 0
+
+    async def heartbeat(self, user_pk, conn_id):
+        expires_at = time.time() + self.ttl
+        async with self.redis.pipeline() as pipe:
+            pipe.zadd(self._key(user_pk), {conn_id: expires_at}, xx=True)
+            pipe.zadd(self.ALL_CONNECTIONS, {f'{user_pk}:{conn_id}': expires_at}, xx=True)
+            pipe.expire(self._key(user_pk), self.ttl * 2)
+            await pipe.execute()
+
+    async def disconnect(self, user_pk, conn_id):
+        async with self.redis.pipeline() as pipe:
+            pipe.zrem(self._key(user_pk), conn_id)
+            pipe.zrem(self.ALL_CONNECTIONS, f'{user_pk}:{conn_id}')
+            pipe.zcount(self._key(user_pk), time.time(), '+inf')
+            removed, _, remaining = await pipe.execute()
+        return bool(removed) and remaining == 0
+
+    async def online_users(self, user_pks):
+        user_pks = list(user_pks)
+        now = time.time()
+        async with self.redis.pipeline() as pipe:
+            for user_pk in user_pks:
+                pipe.zcount(self._key(user_pk), now, '+inf')
+            counts = await pipe.execute()
+        return {pk for pk, count in zip(user_pks, counts) if count}
+
+    async def expire(self):
+        now = time.time()
+        stale = await self.redis.zrangebyscore(self.ALL_CONNECTIONS, 0, now)
+        offline = []
+        for member in stale:
+            # Only the process that removes the entry reports the transition
+            if not await self.redis.zrem(self.ALL_CONNECTIONS, member):
+                continue
+            user_pk, conn_id = member.decode().split(':', 1)
+            if await self.disconnect(int(user_pk), conn_id):
+                offline.append(int(user_pk))
+        return offline
+
+
+class PresenceService:
+    """Presence transitions, contact notifications and batched last_seen writes"""
+
+    def __init__(self, backend, flush_interval):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self._pending = {}  # user_pk -> (is_online, last_seen)
+        self._flush_task = None
+
+    async def connect(self, user_pk, conn_id):
+        if await self.backend.connect(user_pk, conn_id):
+            await self._transition(user_pk, True)
+
+    async def heartbeat(self, user_pk, conn_id):
+        await self.backend.heartbeat(user_pk, conn_id)
+        for offline_pk in await self.backend.expire():
+            await self._transition(offline_pk, False)
+
+    async def disconnect(self, user_pk, conn_id):
+        if await self.backend.disconnect(user_pk, conn_id):
+            await self._transition(user_pk, False)
+
+    async def online_users(self, user_pks):
+        return await self.backend.online_users(user_pks)
+
+    async def _transition(self, user_pk, is_online):
+        now = timezone.now()
+        self._pending[user_pk] = (is_online, now)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.ensure_future(self._flush_later())
+
+        channel_layer = get_channel_layer()
+        if channel_layer is not None:
+            await channel_layer.group_send(presence_group_name(user_pk), {
+                'type': 'presence.update',
+                'user_pk': user_pk,
+                'is_online': is_online,
+                'last_seen': now.isoformat(),
+            })
+
+    async def _flush_later(self):
+        # Transitions within one interval are coalesced into a single write
+        await asyncio.sleep(self.flush_interval)
+        await self.flush()
+
+    async def flush(self):
+        """Persist pending transitions as one bulk UPDATE"""
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        try:
+            await database_sync_to_async(self._write)(pending)
+        except Exception:
+            logger.exception("Failed to persist presence for %d users", len(pending))
+
+    @staticmethod
+    def _write(pending):
+        users = [
+            User(pk=user_pk, is_online=is_online, last_seen=last_seen)
+            for user_pk, (is_online, last_seen) in pending.items()
+        ]
+        User.objects.bulk_update(users, ['is_online', 'last_seen'])
+
+
+def build_presence_service():
+    ttl = getattr(settings, 'PRESENCE_TTL', 60)
+    if getattr(settings, 'PRESENCE_BACKEND', 'local') == 'redis':
+        backend = RedisPresenceBackend(ttl, settings.PRESENCE_REDIS_URL)
+    else:
+        backend = LocalPresenceBackend(ttl)
+    return PresenceService(backend, getattr(settings, 'PRESENCE_FLUSH_INTERVAL', 10))
+
+
+presence = build_presence_service()
@@ -0,0 +1,106 @@
+# rate_limits.py - Token-bucket limits on the frames a socket may send
+#
+# Frames are grouped into classes (messages, typing, receipts, call
+# signaling, sync) with a bucket each. A frame needs a token from its
+# socket's bucket and from the bucket its user shares with their other
+# sockets, so neither one flooding socket nor many sockets of one user can
+# tie up the database thread pool. User buckets live in the process and are
+# dropped with the user's last socket in it; a user connected to several
+# processes gets each process's allowance.
+import time
+from django.conf import settings
+
+# frame class -> (tokens per second, burst)
+RATE_LIMITS = getattr(settings, 'WS_RATE_LIMITS', {
+    'message': (5, 20),
+    'typing': (10, 20),
+    'receipt': (10, 30),
+    'call': (1, 5),
+    'sync': (2, 10),
+    'other': (10, 20),
+})
+USER_RATE_LIMITS = getattr(settings, 'WS_USER_RATE_LIMITS', {
+    'message': (10, 40),
+    'typing': (20, 40),
+    'receipt': (20, 60),
+    'call': (2, 10),
+    'sync': (4, 20),
+    'other': (20, 40),
+})
+
+FRAME_CLASSES = {
+    'chat_message': 'message',
+    'typing': 'typing',
+    'read_receipt': 'receipt',
+    'voice_call': 'call',
+    'video_call': 'call',
+    'sync': 'sync',
+}
+
+_user_buckets = {}  # user_pk -> [sockets, {frame class: TokenBucket}]
+
+
+def frame_class(frame_type):
+    return FRAME_CLASSES.get(frame_type, 'other')
+
+
+class TokenBucket:
+    """`rate` tokens per second, holding at most `burst`"""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self):
+        """Seconds until a token is available, after refill()"""
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+def _buckets(limits):
+    return {name: TokenBucket(rate, burst) for name, (rate, burst) in limits.items()}
+
+
+class RateLimiter:
+    """The buckets one socket draws from; close() when the socket goes away"""
+
+    def __init__(self, user_pk, limits=None, user_limits=None):
+        self.user_pk = user_pk
+        self.buckets = _buckets(limits or RATE_LIMITS)
+        shared = _user_buckets.get(user_pk)
+        if shared is None:
+            shared = _user_buckets[user_pk] = [0, _buckets(user_limits or USER_RATE_LIMITS)]
+        shared[0] += 1
+        self.user_buckets = shared[1]
+
+    def check(self, name):
+        """
+        Take a token for frame class `name` from both the socket's and the
+        user's bucket. Returns 0 if the frame may proceed, otherwise the
+        seconds until it could; nothing is taken from either bucket then.
+        """
+        now = time.monotonic()
+        buckets = [bucket for bucket in (self.buckets.get(name), self.user_buckets.get(name)) if bucket]
+        wait = 0
+        for bucket in buckets:
+            bucket.refill(now)
+            wait = max(wait, bucket.wait())
+        if wait:
+            return wait
+        for bucket in buckets:
+            bucket.tokens -= 1
+        return 0
+
+    def close(self):
+        shared = _user_buckets.get(self.user_pk)
+        if shared is None:
+            return
+        shared[0] -= 1
+        if shared[0] <= 0:
+            del _user_buckets[self.user_pk]
@@ -0,0 +1,12 @@
+# realtime.py - Channel layer group names
+#
+# Events are sent to these groups through whats_app.outbox (writes) or
+# directly by the consumers and the presence service (ephemeral state).
+
+
+def chat_group_name(chat_id):
+    return f'chat_{chat_id}'
+
+
+def user_group_name(user_pk):
+    return f'user_{user_pk}'
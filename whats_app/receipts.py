@@ -0,0 +1,126 @@
+# receipts.py - Delivery/read state as per-participant watermarks
+#
+# Instead of one MessageStatus row per (message, recipient), each
+# ChatParticipant stores the highest message seq it has been delivered and
+# has read. Watermarks only move forward, so a receipt for any number of
+# messages is a single conditional UPDATE, and per-message state is derived
+# by comparing a message's seq against the watermarks.
+import asyncio
+import logging
+from django.conf import settings
+from django.db.models import Min
+from .models import ChatParticipant
+
+logger = logging.getLogger(__name__)
+
+READ_RECEIPT_BATCH_WINDOW = getattr(settings, 'READ_RECEIPT_BATCH_WINDOW', 0.5)
+
+
+def mark_delivered(chat_pk, user_pk, seq):
+    """Advance one participant's delivered watermark. Returns True if it moved"""
+    return ChatParticipant.objects.filter(
+        chat_id=chat_pk, user_id=user_pk, delivered_seq__lt=seq
+    ).update(delivered_seq=seq) > 0
+
+
+def mark_delivered_to_chat(chat_pk, sender_pk, seq):
+    """Advance the delivered watermark of every recipient in a chat"""
+    return ChatParticipant.objects.filter(
+        chat_id=chat_pk, delivered_seq__lt=seq
+    ).exclude(user_id=sender_pk).update(delivered_seq=seq)
+
+
+def mark_read(chat_pk, user_pk, seq):
+    """
+    Advance one participant's read watermark (and delivered with it).
+    Returns True if it moved.
+    """
+    updated = ChatParticipant.objects.filter(
+        chat_id=chat_pk, user_id=user_pk, read_seq__lt=seq
+    ).update(read_seq=seq)
+    if updated:
+        mark_delivered(chat_pk, user_pk, seq)
+    return updated > 0
+
+
+def message_sent(message):
+    """The sender has trivially seen their own message"""
+    mark_read(message.chat_id, message.sender_id, message.seq)
+
+
+def status_for_seq(chat_pk, sender_pk, seq):
+    """Aggregate tick for the sender: 'read' once every recipient has read it"""
+    watermarks = ChatParticipant.objects.filter(chat_id=chat_pk).exclude(
+        user_id=sender_pk
+    ).aggregate(read=Min('read_seq'), delivered=Min('delivered_seq'))
+
+    if watermarks['read'] is None:
+        return 'sent'
+    if watermarks['read'] >= seq:
+        return 'read'
+    if watermarks['delivered'] >= seq:
+        return 'delivered'
+    return 'sent'
+
+
+def receipts_for(message):
+    """Per-recipient receipt lists for one message, derived from watermarks"""
+    participants = ChatParticipant.objects.filter(chat_id=message.chat_id).exclude(
+        user_id=message.sender_id
+    ).select_related('user')
+
+    receipts = {'read': [], 'delivered': [], 'sent': []}
+    for participant in participants:
+        if participant.read_seq >= message.seq:
+            receipts['read'].append(participant.user)
+        elif participant.delivered_seq >= message.seq:
+            receipts['delivered'].append(participant.user)
+        else:
+            receipts['sent'].append(participant.user)
+    return receipts
+
+
+class ReadReceiptBatcher:
+    """
+    Coalesces one connection's read receipts over a short window.
+
+    Receipts are watermarks, so a burst for many messages in a chat reduces
+    to the highest one. flush(pending) is awaited once per window with
+    {chat_id: [max read_up_to seq, {legacy message_ids}]}.
+    """
+
+    def __init__(self, flush, window=READ_RECEIPT_BATCH_WINDOW):
+        self._flush = flush
+        self.window = window
+        self._pending = {}
+        self._task = None
+
+    def add(self, chat_id, seq=None, message_id=None):
+        pending = self._pending.setdefault(chat_id, [0, set()])
+        if seq is not None:
+            pending[0] = max(pending[0], seq)
+        if message_id is not None:
+            pending[1].add(message_id)
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        await self.flush()
+
+    async def flush(self):
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        try:
+            await self._flush(pending)
+        except Exception:
+            logger.exception("Failed to apply read receipts for %d chats", len(pending))
+
+    async def close(self):
+        """Flush what is pending now instead of waiting out the window"""
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
+        await self.flush()
+
@@ -5,5 +5,6 @@ from . import consumers
 
 websocket_urlpatterns = [
     re_path(r'ws/chat/(?P<chat_id>[0-9a-f-]+)/$', consumers.ChatConsumer.as_asgi()),
+    re_path(r'ws/user/$', consumers.UserConsumer.as_asgi()),
     re_path(r'ws/ai/(?P<conversation_id>[0-9a-f-]+)/$', consumers.AIConsumer.as_asgi()),
 ]
\ No newline at end of file
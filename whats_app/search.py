@@ -0,0 +1,176 @@
+# search.py - Full-text message search across a user's chats
+#
+# The index is maintained by the database itself so every write path,
+# including bulk_create and raw updates, keeps it current:
+#   SQLite   - an external-content FTS5 table fed by triggers on insert,
+#              update and delete (migration 0008)
+#   Postgres - a generated tsvector column with a GIN index
+# SQLite narrows matches to the user's chats inside the FTS index (chat_id
+# is an indexed column); Postgres filters the GIN matches by chat. Both rank
+# by relevance and return a highlighted snippet.
+#
+# On SQLite, a migration that remakes whats_app_message drops its triggers,
+# so such a migration must recreate them.
+import re
+from django.db import connection
+from django.utils.html import escape
+from .models import ChatParticipant, InboxEntry, Message
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 50
+SNIPPET_TOKENS = 12
+# A one-letter prefix matches most of the index and has no prefix index of
+# its own; it is ignored until the user types a second letter
+MIN_PREFIX_LENGTH = 2
+
+# Relevance ranking covers the newest RANK_WINDOW matches. This bounds the
+# work for very common words, and chat search favours recent messages anyway.
+RANK_WINDOW = 500
+
+# Private-use markers survive both engines' snippet functions; the snippet is
+# HTML-escaped before they are swapped for <mark> tags
+HIGHLIGHT_START = '\ue000'
+HIGHLIGHT_END = '\ue001'
+
+FTS_TABLE = 'whats_app_message_fts'
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def search_terms(query):
+    """Words of a user query; the last one is matched as a prefix"""
+    terms = _TOKEN_RE.findall(query.lower())[:10]
+    if terms and len(terms[-1]) < MIN_PREFIX_LENGTH:
+        terms.pop()
+    return terms
+
+
+class SQLiteSearchBackend:
+    """FTS5 with bm25 ranking"""
+
+    def content_expression(self, terms):
+        phrases = [f'"{term}"' for term in terms]
+        phrases[-1] += '*'
+        return f'content: ({" ".join(phrases)})'
+
+    def match_expression(self, terms, chat_pks):
+        chats = ' OR '.join(f'"{pk}"' for pk in chat_pks)
+        return f'{self.content_expression(terms)} AND chat_id: ({chats})'
+
+    def search(self, terms, chat_pks, limit):
+        match = self.match_expression(terms, chat_pks)
+        with connection.cursor() as cursor:
+            # FTS5 walks the doclists newest-first and stops after the window
+            cursor.execute(f'''
+                SELECT {FTS_TABLE}.rowid, bm25({FTS_TABLE}, 1.0, 0.0)
+                FROM {FTS_TABLE}
+                JOIN whats_app_message m ON m.id = {FTS_TABLE}.rowid
+                WHERE {FTS_TABLE} MATCH %s AND m.is_deleted = 0
+                ORDER BY {FTS_TABLE}.rowid DESC
+                LIMIT %s
+            ''', [match, RANK_WINDOW])
+            # bm25 scores are negative; lower is more relevant
+            ranked = [pk for pk, _ in sorted(cursor.fetchall(), key=lambda row: row[1])[:limit]]
+            if not ranked:
+                return []
+
+            # Snippets only for the page being returned. FTS5 does not use
+            # rowid IN (...) to skip ahead, so the chat filter (already
+            # applied above) is dropped and the scan is bounded by rowid range.
+            cursor.execute(f'''
+                SELECT rowid, snippet({FTS_TABLE}, 0, %s, %s, '…', %s)
+                FROM {FTS_TABLE}
+                WHERE {FTS_TABLE} MATCH %s AND rowid BETWEEN %s AND %s
+                  AND rowid IN ({', '.join(['%s'] * len(ranked))})
+            ''', [HIGHLIGHT_START, HIGHLIGHT_END, SNIPPET_TOKENS,
+                  self.content_expression(terms), min(ranked), max(ranked), *ranked])
+            snippets = dict(cursor.fetchall())
+
+        return [(pk, snippets[pk]) for pk in ranked if pk in snippets]
+
+
+class PostgresSearchBackend:
+    """tsvector/GIN with ts_rank_cd; headlines only for the returned page"""
+
+    def tsquery(self, terms):
+        return ' & '.join(terms[:-1] + [terms[-1] + ':*'])
+
+    def search(self, terms, chat_pks, limit):
+        sql = '''
+            WITH recent AS (
+                SELECT m.id, m.content, m.search_vector
+                FROM whats_app_message m
+                WHERE m.search_vector @@ to_tsquery('simple', %s)
+                  AND m.chat_id = ANY(%s) AND NOT m.is_deleted
+                ORDER BY m.id DESC
+                LIMIT %s
+            ), ranked AS (
+                SELECT id, content, ts_rank_cd(search_vector, q) AS rank, q
+                FROM recent, to_tsquery('simple', %s) q
+                ORDER BY rank DESC
+                LIMIT %s
+            )
+            SELECT id, ts_headline('simple', content, q, %s)
+            FROM ranked
+            ORDER BY rank DESC
+        '''
+        tsquery = self.tsquery(terms)
+        options = (f'StartSel={HIGHLIGHT_START}, StopSel={HIGHLIGHT_END}, '
+                   f'MaxWords={SNIPPET_TOKENS}, MinWords=3')
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [tsquery, list(chat_pks), RANK_WINDOW, tsquery, limit, options])
+            return cursor.fetchall()
+
+
+def get_backend():
+    if connection.vendor == 'postgresql':
+        return PostgresSearchBackend()
+    if connection.vendor == 'sqlite':
+        return SQLiteSearchBackend()
+    raise NotImplementedError(f'No message search backend for {connection.vendor}')
+
+
+def search_messages(user, query, limit=DEFAULT_LIMIT):
+    """Ranked matches for `query` in the chats `user` participates in"""
+    terms = search_terms(query)
+    if not terms:
+        return []
+
+    chat_pks = list(ChatParticipant.objects.filter(user=user).values_list('chat_id', flat=True))
+    if not chat_pks:
+        return []
+
+    # [(message pk, snippet)] in rank order
+    rows = get_backend().search(terms, chat_pks, min(max(limit, 1), MAX_LIMIT))
+    if not rows:
+        return []
+
+    messages = Message.objects.in_bulk([pk for pk, _ in rows])
+    # How each chat appears in this user's chat list
+    chats = {
+        entry['chat_id']: entry for entry in InboxEntry.objects.filter(
+            user=user, chat_id__in={message.chat_id for message in messages.values()}
+        ).values('chat_id', 'chat__chat_id', 'name', 'photo')
+    }
+
+    results = []
+    for pk, snippet in rows:
+        message = messages.get(pk)
+        chat = chats.get(message.chat_id) if message else None
+        if chat is None:
+            continue
+        results.append({
+            'message_id': str(message.message_id),
+            'chat_id': str(chat['chat__chat_id']),
+            'chat_name': chat['name'],
+            'chat_photo': chat['photo'],
+            'is_mine': message.sender_id == user.pk,
+            'snippet': highlight(snippet),
+            'timestamp': message.created_at.isoformat(),
+        })
+    return results
+
+
+def highlight(snippet):
+    """HTML-safe snippet with matches wrapped in <mark>"""
+    return escape(snippet).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>')
@@ -0,0 +1,103 @@
+# send_queue.py - Bounded outgoing frame queue for one socket
+#
+# Group events are handled one at a time per consumer, so a consumer awaiting
+# a slow client's socket stops reading its channel, and the channel layer
+# starts dropping that channel's messages without telling anyone. Handlers
+# instead queue encoded frames here and return; one writer task sends them
+# in order.
+#
+# The queue is bounded. Typing and presence frames are low priority: a newer
+# frame replaces a queued one with the same key (the same user typing in the
+# same chat, the same contact's presence), and once SEND_QUEUE_PRESSURE
+# frames are waiting new ones are dropped. Other frames are never dropped;
+# a socket that lets SEND_QUEUE_LIMIT of them pile up is closed instead and
+# catches up with a sync when the client reconnects.
+import asyncio
+import collections
+import logging
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+SEND_QUEUE_LIMIT = getattr(settings, 'WS_SEND_QUEUE_LIMIT', 500)
+SEND_QUEUE_PRESSURE = getattr(settings, 'WS_SEND_QUEUE_PRESSURE', 50)
+
+
+class SendQueue:
+    """
+    send(**kwargs) is awaited for each frame, in order. overflow() is
+    awaited once if the queue fills with frames that may not be dropped.
+    Drops are counted on `metrics` (a whats_app.metrics.ConnectionMetrics).
+    """
+
+    def __init__(self, send, overflow, metrics, limit=SEND_QUEUE_LIMIT, pressure=SEND_QUEUE_PRESSURE):
+        self._send = send
+        self._overflow = overflow
+        self.metrics = metrics
+        self.limit = limit
+        self.pressure = pressure
+        self._frames = collections.deque()  # [key, kwargs]
+        self._keyed = {}  # key -> its queued entry
+        self._task = None
+        self.closed = False
+
+    def __len__(self):
+        return len(self._frames)
+
+    def put(self, kwargs, key=None):
+        """
+        Queue one encoded frame (keyword arguments for send). A `key`
+        marks it low priority: it replaces a queued frame with the same key
+        and is dropped under pressure. key[0] names the frame in metrics.
+        """
+        if self.closed:
+            return
+
+        if key is not None:
+            entry = self._keyed.get(key)
+            if entry is not None:
+                entry[1] = kwargs
+                self.metrics.drop('coalesced', key[0])
+                return
+            if len(self._frames) >= self.pressure:
+                self.metrics.drop('dropped', key[0])
+                return
+        elif len(self._frames) >= self.limit:
+            self.close()
+            self.metrics.drop('overflow', 'queue')
+            logger.warning("%s: send queue full, closing", self.metrics.label)
+            asyncio.ensure_future(self._overflow())
+            return
+
+        entry = [key, kwargs]
+        self._frames.append(entry)
+        if key is not None:
+            self._keyed[key] = entry
+
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._write())
+
+    async def _write(self):
+        try:
+            while self._frames:
+                key, kwargs = self._frames.popleft()
+                if key is not None:
+                    del self._keyed[key]
+                await self._send(**kwargs)
+        except Exception:
+            logger.exception("%s: send failed", self.metrics.label)
+            self.close()
+
+    async def join(self):
+        """Wait until the frames queued so far have been sent"""
+        if self._task is not None and not self._task.done():
+            # wait() rather than await: a cancelled writer must not cancel the caller
+            await asyncio.wait({self._task})
+
+    def close(self):
+        """Discard what is queued; the socket is gone"""
+        self.closed = True
+        self._frames.clear()
+        self._keyed.clear()
+        if self._task is not None and self._task is not asyncio.current_task():
+            self._task.cancel()
@@ -1,15 +1,97 @@
-from django.db.models.signals import post_save
+from django.db.models.signals import post_save, post_delete
 from django.dispatch import receiver
-from .models import Message, MessageStatus, Chat
+from .models import Message, Chat, ChatParticipant, Contact, Group, GroupAdmin, User
+from . import inbox, outbox, receipts
+from .access import invalidate_chat_access
+from .realtime import user_group_name
 
 @receiver(post_save, sender=Message)
-def create_message_status(sender, instance, created, **kwargs):
-    """Create message status for all chat participants except sender"""
-    if created:
-        participants = instance.chat.participants.exclude(user=instance.sender)
-        for participant in participants:
-            MessageStatus.objects.create(
-                message=instance,
-                user=participant.user,
-                status='sent'
-            )
\ No newline at end of file
+def advance_sender_watermark(sender, instance, created, **kwargs):
+    """A sender has read everything up to their own message"""
+    if created:
+        receipts.message_sent(instance)
+
+
+@receiver(post_save, sender=Message)
+def update_inbox_for_message(sender, instance, created, **kwargs):
+    """Keep the denormalized chat list in step with new/edited/deleted messages"""
+    if created:
+        inbox.message_created(instance)
+    else:
+        inbox.message_changed(instance)
+
+
+@receiver(post_save, sender=ChatParticipant)
+def update_inbox_for_participant(sender, instance, created, **kwargs):
+    if created:
+        inbox.create_entry(instance)
+    else:
+        inbox.sync_flags(instance)
+
+
+@receiver(post_delete, sender=ChatParticipant)
+def remove_inbox_entry(sender, instance, **kwargs):
+    inbox.remove_entry(instance)
+
+
+@receiver(post_delete, sender=ChatParticipant)
+@receiver(post_save, sender=ChatParticipant)
+def invalidate_access_for_participant(sender, instance, created=True, **kwargs):
+    """Membership changed; flag updates (pin/mute/archive) do not matter"""
+    if created:
+        invalidate_chat_access(instance.chat.chat_id)
+
+
+@receiver(post_delete, sender=GroupAdmin)
+@receiver(post_save, sender=GroupAdmin)
+def invalidate_access_for_admin(sender, instance, **kwargs):
+    invalidate_chat_access(instance.group.chat.chat_id)
+
+
+@receiver(post_save, sender=ChatParticipant)
+def subscribe_user_socket(sender, instance, created, **kwargs):
+    """Tell the user's multiplexed socket to start listening to a new chat"""
+    if created:
+        outbox.enqueue(user_group_name(instance.user_id), {
+            'type': 'chat.subscribe',
+            'chat_id': str(instance.chat.chat_id),
+        })
+
+
+@receiver(post_delete, sender=ChatParticipant)
+def unsubscribe_user_socket(sender, instance, **kwargs):
+    outbox.enqueue(user_group_name(instance.user_id), {
+        'type': 'chat.unsubscribe',
+        'chat_id': str(instance.chat.chat_id),
+    })
+
+
+@receiver(post_save, sender=Contact)
+def update_inbox_for_contact(sender, instance, **kwargs):
+    inbox.contact_changed(instance)
+
+
+@receiver(post_delete, sender=Contact)
+def reset_inbox_for_contact(sender, instance, **kwargs):
+    inbox.contact_changed(instance, deleted=True)
+
+
+@receiver(post_save, sender=Group)
+def update_inbox_for_group(sender, instance, **kwargs):
+    inbox.group_changed(instance)
+
+
+@receiver(post_save, sender=Group)
+def invalidate_access_for_group(sender, instance, **kwargs):
+    """only_admins_can_send may have changed"""
+    invalidate_chat_access(instance.chat.chat_id)
+
+
+@receiver(post_save, sender=User)
+def update_inbox_for_user(sender, instance, created, update_fields=None, **kwargs):
+    """Propagate profile picture changes to everyone who has this user in their chat list"""
+    if created:
+        return
+    if update_fields is not None and 'profile_picture' not in update_fields:
+        return
+    inbox.profile_picture_changed(instance)
@@ -0,0 +1,78 @@
+# typing_indicators.py - Ephemeral, throttled typing state for one socket
+#
+# Typing state never touches the database. Clients send typing=true on every
+# input event; only the first one, and then at most one per throttle window
+# while the user keeps typing, is broadcast to the chat. If no typing=true
+# arrives for the timeout, a typing=false is broadcast on the user's behalf,
+# and receivers also expire the indicator themselves after the same timeout
+# in case the stop never arrives (e.g. the sending process died).
+import asyncio
+import time
+from django.conf import settings
+
+TYPING_THROTTLE = getattr(settings, 'TYPING_THROTTLE', 3)
+TYPING_TIMEOUT = getattr(settings, 'TYPING_TIMEOUT', 6)
+
+
+class TypingTracker:
+    """
+    Per-connection typing state. broadcast(chat_id, is_typing) is awaited
+    for every transition and throttled refresh that should reach the chat.
+    """
+
+    def __init__(self, broadcast, throttle=TYPING_THROTTLE, timeout=TYPING_TIMEOUT):
+        self.broadcast = broadcast
+        self.throttle = throttle
+        self.timeout = timeout
+        self._chats = {}  # chat_id -> [last_broadcast_at, expires_at, expiry task]
+
+    async def typing(self, chat_id, is_typing):
+        if is_typing:
+            await self.start(chat_id)
+        else:
+            await self.stop(chat_id)
+
+    async def start(self, chat_id):
+        now = time.monotonic()
+        state = self._chats.get(chat_id)
+
+        if state is None:
+            task = asyncio.ensure_future(self._expire(chat_id))
+            self._chats[chat_id] = [now, now + self.timeout, task]
+            await self.broadcast(chat_id, True)
+            return
+
+        state[1] = now + self.timeout
+        if now - state[0] >= self.throttle:
+            # Still typing: refresh receivers before their own timeout fires
+            state[0] = now
+            await self.broadcast(chat_id, True)
+
+    async def stop(self, chat_id):
+        if self.clear(chat_id):
+            await self.broadcast(chat_id, False)
+
+    def clear(self, chat_id):
+        """Forget typing state without broadcasting. Returns True if it was set"""
+        state = self._chats.pop(chat_id, None)
+        if state is None:
+            return False
+        if state[2] is not asyncio.current_task():
+            state[2].cancel()
+        return True
+
+    async def stop_all(self):
+        for chat_id in list(self._chats):
+            await self.stop(chat_id)
+
+    async def _expire(self, chat_id):
+        # One task per typing burst, re-armed by moving expires_at forward
+        while True:
+            state = self._chats.get(chat_id)
+            if state is None:
+                return
+            remaining = state[1] - time.monotonic()
+            if remaining <= 0:
+                await self.stop(chat_id)
+                return
+            await asyncio.sleep(remaining)
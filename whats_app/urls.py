@@ -13,11 +13,20 @@ urlpatterns = [
     path('chat/', views.chat_home, name='chat_home'),
     path('chat/<uuid:chat_id>/', views.chat_view, name='chat_view'),
     path('new-chat/', views.new_chat, name='new_chat'),
+    path('api/chat/<uuid:chat_id>/messages/', views.message_history, name='message_history'),
     
     # Message actions
     path('api/send-message/', views.send_message, name='send_message'),
     path('api/delete-message/', views.delete_message, name='delete_message'),
     path('api/edit-message/', views.edit_message, name='edit_message'),
+    path('api/message-receipts/<uuid:message_id>/', views.message_receipts, name='message_receipts'),
+    path('api/search/messages/', views.search_messages, name='search_messages'),
+    
+    # Operations
+    path('api/metrics/db-executor/', views.db_executor_stats, name='db_executor_stats'),
+    path('api/metrics/flow-control/', views.flow_control_stats, name='flow_control_stats'),
+    path('api/metrics/ai-cache/', views.ai_cache_stats, name='ai_cache_stats'),
+    path('api/metrics/ai-admission/', views.ai_admission_stats, name='ai_admission_stats'),
     
     # Group management
     path('create-group/', views.create_group, name='create_group'),
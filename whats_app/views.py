@@ -1,8 +1,10 @@
 from django.shortcuts import render, redirect, get_object_or_404
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth import login, logout, authenticate
-from django.http import JsonResponse
+from django.http import Http404, JsonResponse
 from django.views.decorators.http import require_http_methods
+from django.db import transaction
 from django.db.models import Q, Max
 from django.utils import timezone
 from django.core.files.storage import default_storage
@@ -12,6 +14,8 @@ from io import BytesIO
 import base64
 import json
 from .models import *
+from . import ai_admission, ai_cache, ai_context, db_executor, history, messaging, metrics, receipts, search, wire
+from .access import get_chat_access
 
 
 def generate_qr_code(user):
@@ -41,8 +45,6 @@ def login_page(request):
         user = authenticate(request, username=phone_number, password=password)
         if user:
             login(request, user)
-            user.is_online = True
-            user.save()
             return redirect('chat_home')
         else:
             return render(request, 'login.html', {'error': 'Invalid credentials'})
@@ -80,9 +82,8 @@ def qr_login(request):
         try:
             user = User.objects.get(phone_number=phone_number, qr_code=qr_code)
             login(request, user)
-            user.is_online = True
             user.qr_code = None  # Invalidate QR after use
-            user.save()
+            user.save(update_fields=['qr_code'])
             return JsonResponse({'success': True})
         except User.DoesNotExist:
             return JsonResponse({'success': False, 'error': 'Invalid QR code'})
@@ -95,59 +96,17 @@ def qr_login(request):
 @login_required
 def chat_home(request):
     """Main chat interface"""
-    # Get all chats for the user
-    chat_participants = ChatParticipant.objects.filter(
+    # The chat list is a single range scan over the user's inbox rows
+    chats = InboxEntry.objects.filter(
         user=request.user
-    ).select_related('chat').order_by('-chat__updated_at')
-    
-    chats_data = []
-    for participant in chat_participants:
-        chat = participant.chat
-        
-        # Get last message
-        last_message = Message.objects.filter(
-            chat=chat
-        ).order_by('-created_at').first()
-        
-        # Get unread count
-        unread_count = Message.objects.filter(
-            ~Q(sender=request.user),
-            chat=chat
-        ).exclude(
-            statuses__user=request.user,
-            statuses__status='read'
-        ).count()
-        
-        # Get chat name and photo
-        if chat.chat_type == 'private':
-            other_participant = chat.participants.exclude(user=request.user).first()
-            if other_participant:
-                contact = Contact.objects.filter(
-                    user=request.user,
-                    contact_user=other_participant.user
-                ).first()
-                
-                chat_name = contact.name if contact else other_participant.user.phone_number
-                chat_photo = other_participant.user.profile_picture.url if other_participant.user.profile_picture else None
-                is_online = other_participant.user.is_online
-        else:
-            group = chat.group
-            chat_name = group.name
-            chat_photo = group.icon.url if group.icon else None
-            is_online = False
-        
-        chats_data.append({
-            'chat': chat,
-            'participant': participant,
-            'last_message': last_message,
-            'unread_count': unread_count,
-            'name': chat_name,
-            'photo': chat_photo,
-            'is_online': is_online,
-        })
+    ).select_related('chat', 'peer').order_by('-last_activity_at')
     
+    # Unread totals are counters on the user row (see whats_app.inbox)
     context = {
-        'chats': chats_data,
+        'chats': chats,
+        'unread_chats': request.user.unread_chats,
+        'unread_messages': request.user.unread_messages,
+        'wire_fields': wire.FIELDS,
         'user': request.user,
     }
     
@@ -162,14 +121,11 @@ def chat_view(request, chat_id):
     # Verify user is participant
     participant = get_object_or_404(ChatParticipant, chat=chat, user=request.user)
     
-    # Get messages
-    messages = Message.objects.filter(chat=chat).order_by('created_at')
+    # Only the newest page is rendered, older pages load on scroll
+    messages, has_more_messages = history.fetch_page(chat)
     
-    # Mark messages as read
-    MessageStatus.objects.filter(
-        message__chat=chat,
-        user=request.user
-    ).update(status='read', timestamp=timezone.now())
+    # Mark messages as read: one watermark UPDATE regardless of history size
+    messaging.mark_read(chat.pk, chat.chat_id, request.user, chat.last_seq)
     
     # Get chat info
     if chat.chat_type == 'private':
@@ -193,6 +149,7 @@ def chat_view(request, chat_id):
     context = {
         'chat': chat,
         'messages': messages,
+        'has_more_messages': has_more_messages,
         'chat_name': chat_name,
         'chat_photo': chat_photo,
         'is_online': is_online,
@@ -203,6 +160,97 @@ def chat_view(request, chat_id):
     return render(request, 'chat_view.html', context)
 
 
+@login_required
+@require_http_methods(["GET"])
+def message_history(request, chat_id):
+    """Cursor-paginated message history via AJAX"""
+    chat = get_object_or_404(Chat, chat_id=chat_id)
+    get_object_or_404(ChatParticipant, chat=chat, user=request.user)
+    
+    limit = history.clamp_page_size(request.GET.get('limit'))
+    before = after = None
+    
+    try:
+        if request.GET.get('before'):
+            before = history.resolve_cursor(chat, uuid.UUID(request.GET['before']))
+            if not before:
+                return JsonResponse({'success': False, 'error': 'Unknown cursor'}, status=400)
+        elif request.GET.get('after'):
+            after = history.resolve_cursor(chat, uuid.UUID(request.GET['after']))
+            if not after:
+                return JsonResponse({'success': False, 'error': 'Unknown cursor'}, status=400)
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Invalid cursor'}, status=400)
+    
+    messages, has_more = history.fetch_page(chat, before=before, after=after, limit=limit)
+    
+    return JsonResponse({
+        'success': True,
+        'messages': [history.serialize_message(message) for message in messages],
+        'has_more': has_more,
+    })
+
+
+@login_required
+@require_http_methods(["GET"])
+def search_messages(request):
+    """Full-text search over the messages of every chat the user is in"""
+    query = request.GET.get('q', '').strip()
+    try:
+        limit = int(request.GET.get('limit', search.DEFAULT_LIMIT))
+    except ValueError:
+        return JsonResponse({'success': False, 'error': 'Invalid limit'}, status=400)
+    
+    return JsonResponse({
+        'success': True,
+        'results': search.search_messages(request.user, query, limit),
+    })
+
+
+@login_required
+@require_http_methods(["GET"])
+def message_receipts(request, message_id):
+    """Who has received/read one of your messages"""
+    message = get_object_or_404(Message, message_id=message_id, sender=request.user)
+    message_receipts = receipts.receipts_for(message)
+    
+    return JsonResponse({
+        'success': True,
+        'receipts': {
+            status: [user.phone_number for user in users]
+            for status, users in message_receipts.items()
+        },
+    })
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def db_executor_stats(request):
+    """Queue depth and wait times of this process's consumer database executor"""
+    return JsonResponse(db_executor.stats())
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def flow_control_stats(request):
+    """Frames this process's sockets rate limited, dropped or coalesced"""
+    return JsonResponse(metrics.stats())
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def ai_cache_stats(request):
+    """Hit rate and time saved by this process's AI response cache"""
+    return JsonResponse(ai_cache.stats())
+
+
+@staff_member_required
+@require_http_methods(["GET"])
+def ai_admission_stats(request):
+    """Concurrency, queue depth and refusals of this process's AI admission controller"""
+    return JsonResponse(ai_admission.stats())
+
+
 @login_required
 def new_chat(request):
     """Start a new chat with phone number"""
@@ -252,43 +300,24 @@ def send_message(request):
     content = data.get('content')
     message_type = data.get('message_type', 'text')
     reply_to_id = data.get('reply_to')
+    client_id = data.get('client_id')  # optional; makes retries idempotent
     
-    chat = get_object_or_404(Chat, chat_id=chat_id)
-    
-    # Check if user can send (group permissions)
-    if chat.chat_type == 'group':
-        group = chat.group
-        if group.only_admins_can_send:
-            is_admin = GroupAdmin.objects.filter(group=group, user=request.user).exists()
-            if not is_admin:
-                return JsonResponse({'success': False, 'error': 'Only admins can send messages'})
-    
-    reply_to = None
-    if reply_to_id:
-        reply_to = Message.objects.get(message_id=reply_to_id)
-    
-    message = Message.objects.create(
-        chat=chat,
-        sender=request.user,
-        message_type=message_type,
-        content=content,
-        reply_to=reply_to
-    )
+    chat_access = get_chat_access(chat_id)
+    if chat_access is None:
+        raise Http404("Chat not found")
     
-    # Create status for all participants
-    participants = chat.participants.all()
-    for participant in participants:
-        if participant.user != request.user:
-            MessageStatus.objects.create(
-                message=message,
-                user=participant.user,
-                status='sent'
-            )
+    try:
+        message, created = messaging.send_message(
+            chat_access, request.user, content, message_type, reply_to_id, client_id
+        )
+    except messaging.MessageRejected as e:
+        return JsonResponse({'success': False, 'error': str(e)})
     
     return JsonResponse({
         'success': True,
         'message_id': str(message.message_id),
-        'timestamp': message.created_at.isoformat()
+        'timestamp': message.created_at.isoformat(),
+        'duplicate': not created
     })
 
 
@@ -300,21 +329,13 @@ def delete_message(request):
     message_id = data.get('message_id')
     delete_for_everyone = data.get('delete_for_everyone', False)
     
-    message = get_object_or_404(Message, message_id=message_id, sender=request.user)
-    
-    # Save original content for "This message was deleted"
-    DeletedMessage.objects.create(
-        message=message,
-        deleted_by=request.user,
-        deleted_for_everyone=delete_for_everyone,
-        original_content=message.content
+    message = get_object_or_404(
+        Message.objects.select_related('chat', 'sender', 'reply_to'),
+        message_id=message_id, sender=request.user
     )
     
-    message.is_deleted = True
-    message.deleted_at = timezone.now()
-    if delete_for_everyone:
-        message.content = "This message was deleted"
-    message.save()
+    # Original content is kept for "This message was deleted"
+    messaging.delete_message(message, request.user, delete_for_everyone)
     
     return JsonResponse({'success': True})
 
@@ -327,11 +348,11 @@ def edit_message(request):
     message_id = data.get('message_id')
     new_content = data.get('content')
     
-    message = get_object_or_404(Message, message_id=message_id, sender=request.user)
-    message.content = new_content
-    message.is_edited = True
-    message.edited_at = timezone.now()
-    message.save()
+    message = get_object_or_404(
+        Message.objects.select_related('chat', 'sender', 'reply_to'),
+        message_id=message_id, sender=request.user
+    )
+    messaging.edit_message(message, new_content)
     
     return JsonResponse({'success': True})
 
@@ -553,14 +574,13 @@ def generate_ai_response(user_message):
 @login_required
 def logout_view(request):
     """Logout user"""
-    request.user.is_online = False
-    request.user.save()
     logout(request)
     return redirect('login')
 
 
 
 # Updated views.py for AI integration
+from .ai_admission import Overloaded
 from .ai_service import ClaudeAIService
 
 ai_service = ClaudeAIService()
@@ -588,14 +608,26 @@ def send_ai_message(request):
         message_type=message_type
     )
     
-    # Get conversation history (last 10 messages for context)
-    history = AIMessage.objects.filter(
-        conversation=conversation
-    ).order_by('-created_at')[:10][::-1]
+    # Summary plus the recent messages that fit the context budget
+    system, messages = ai_context.build_prompt(conversation)
     
     # Generate AI response
+    try:
+        if message_type == 'voice':
+            response_data = ai_service.generate_voice_response(messages, system, request.user.pk)
+        else:
+            ai_response = ai_service.generate_reply(messages, system, request.user.pk)
+    except Overloaded as error:
+        # Fail fast rather than hold this worker in the queue
+        response = JsonResponse({
+            'success': False,
+            'error': 'The assistant is busy, please try again shortly',
+            'retry_after': error.retry_after
+        }, status=503)
+        response['Retry-After'] = str(error.retry_after)
+        return response
+    
     if message_type == 'voice':
-        response_data = ai_service.generate_voice_response(content, history)
         ai_response = response_data['text']
         audio_url = response_data['audio_url']
         
@@ -607,8 +639,6 @@ def send_ai_message(request):
             audio_file=audio_url
         )
     else:
-        ai_response = ai_service.generate_text_response(content, history)
-        
         ai_message = AIMessage.objects.create(
             conversation=conversation,
             is_user=False,
@@ -616,6 +646,10 @@ def send_ai_message(request):
             message_type='text'
         )
     
+    # Usually a no-op; every few turns folds old messages into the summary,
+    # in the background once the reply is committed
+    transaction.on_commit(lambda: ai_context.refresh_summary_later(conversation.pk))
+    
     return JsonResponse({
         'success': True,
         'ai_response': ai_response,
@@ -0,0 +1,197 @@
+# wire.py - WebSocket frame encodings, negotiated per connection
+#
+# A client picks an encoding with the WebSocket subprotocol header:
+#   (none)                     JSON with full field names (the original format)
+#   whatsapp.compact.json      JSON text with short field names
+#   whatsapp.compact.msgpack   MessagePack binary with short field names
+# The compact encodings also stop repeating sender profile data: a message
+# frame carries only the sender's phone number, and a 'sender' frame with the
+# name and photo goes out the first time a sender appears on the connection
+# (or when their profile changes). Clients cache those profiles.
+#
+# A codec instance belongs to one connection because it remembers which
+# sender profiles that connection has been sent.
+#
+# Chat messages fan out to every member's socket, so the message frame is
+# encoded once per broadcast, in every encoding, by broadcast_event(). The
+# encoded frames travel through the channel layer and each consumer forwards
+# the one for its codec as-is; only the small per-connection sender frame is
+# encoded by the receiving consumer.
+import json
+import msgpack
+
+# Full field name -> wire name, for frames in both directions
+FIELDS = {
+    'type': 't',
+    'chat_id': 'c',
+    'error': 'err',
+    'message': 'm',
+    'messages': 'ms',
+    'message_id': 'mi',
+    'id': 'i',
+    'seq': 'q',
+    'sender': 's',
+    'sender_name': 'sn',
+    'sender_photo': 'sp',
+    'senders': 'ss',
+    'content': 'b',
+    'message_type': 'k',
+    'timestamp': 'ts',
+    'is_edited': 'e',
+    'is_deleted': 'd',
+    'reply_to': 'r',
+    'user': 'u',
+    'name': 'n',
+    'photo': 'p',
+    'is_typing': 'ty',
+    'expires_in': 'x',
+    'read_up_to': 'ru',
+    'action': 'a',
+    'call_id': 'ci',
+    'caller': 'cr',
+    'last_seq': 'ls',
+    'has_more': 'hm',
+    'is_online': 'o',
+    'last_seen': 'lsn',
+    'client_id': 'cid',
+    'duplicate': 'dup',
+    'retry_after': 'ra',
+}
+SHORT_FIELDS = {short: name for name, short in FIELDS.items()}
+
+SENDER_PROFILE_FIELDS = ('sender_name', 'sender_photo')
+
+
+def _rename(value, names):
+    """Rename dict keys found in `names`, recursively; other keys and all values are left alone"""
+    # Frames are mostly scalars, so only containers pay for a call
+    if type(value) is dict:
+        return {
+            names.get(key, key): _rename(item, names) if type(item) in _CONTAINERS else item
+            for key, item in value.items()
+        }
+    return [_rename(item, names) if type(item) in _CONTAINERS else item for item in value]
+
+
+_CONTAINERS = (dict, list)
+
+
+def shorten(frame):
+    return _rename(frame, FIELDS) if type(frame) in _CONTAINERS else frame
+
+
+def expand(frame):
+    return _rename(frame, SHORT_FIELDS) if type(frame) in _CONTAINERS else frame
+
+
+class JSONCodec:
+    """Full field names, every message frame self-contained"""
+    protocol = None
+    key = 'json'  # names this encoding in broadcast events
+    compact = False
+
+    def encode(self, frame):
+        """Keyword arguments for AsyncWebsocketConsumer.send"""
+        return {'text_data': json.dumps(frame, separators=(',', ':'))}
+
+    def decode(self, text_data=None, bytes_data=None):
+        return json.loads(text_data if text_data is not None else bytes_data)
+
+    def message_frame(self, chat_id, message, frame_type='chat_message'):
+        """The frame for one serialized message (history.serialize_message)"""
+        return {'type': frame_type, 'chat_id': chat_id, 'message': message}
+
+    def sender_frames(self, sender):
+        """Frames this connection needs before a message from `sender` ({user, name, photo})"""
+        return []
+
+    def unseen_senders(self, senders):
+        """The part of a sync batch's {phone: profile} map to send"""
+        return senders
+
+
+class CompactCodec(JSONCodec):
+    """Short field names and sender profiles sent once per connection"""
+    compact = True
+
+    def __init__(self):
+        self.senders = {}  # phone number -> (name, photo) already sent
+
+    def message_frame(self, chat_id, message, frame_type='chat_message'):
+        message = {key: value for key, value in message.items() if key not in SENDER_PROFILE_FIELDS}
+        return super().message_frame(chat_id, message, frame_type)
+
+    def sender_frames(self, sender):
+        profile = (sender['name'], sender['photo'])
+        if self.senders.get(sender['user']) == profile:
+            return []
+        self.senders[sender['user']] = profile
+        return [{'type': 'sender', **sender}]
+
+    def unseen_senders(self, senders):
+        unseen = {}
+        for phone_number, profile in senders.items():
+            key = (profile['name'], profile['photo'])
+            if self.senders.get(phone_number) != key:
+                self.senders[phone_number] = key
+                unseen[phone_number] = profile
+        return unseen
+
+
+class CompactJSONCodec(CompactCodec):
+    protocol = key = 'whatsapp.compact.json'
+
+    def encode(self, frame):
+        return {'text_data': json.dumps(shorten(frame), separators=(',', ':'), ensure_ascii=False)}
+
+    def decode(self, text_data=None, bytes_data=None):
+        return expand(super().decode(text_data, bytes_data))
+
+
+class MsgpackCodec(CompactCodec):
+    protocol = key = 'whatsapp.compact.msgpack'
+
+    def encode(self, frame):
+        return {'bytes_data': msgpack.packb(shorten(frame))}
+
+    def decode(self, text_data=None, bytes_data=None):
+        if bytes_data is None:
+            # Tolerate a text frame from a client that negotiated msgpack
+            return expand(super().decode(text_data))
+        return expand(msgpack.unpackb(bytes_data))
+
+
+CODECS = {codec.protocol: codec for codec in (MsgpackCodec, CompactJSONCodec)}
+
+# Stateless instances used to pre-encode broadcasts
+_ENCODERS = [JSONCodec(), CompactJSONCodec(), MsgpackCodec()]
+
+
+def negotiate(subprotocols):
+    """A codec for the first subprotocol we support, in client preference order"""
+    for protocol in subprotocols or ():
+        if protocol in CODECS:
+            return CODECS[protocol]()
+    return JSONCodec()
+
+
+def broadcast_event(chat_id, message, frame_type='chat_message'):
+    """
+    Channel layer event delivering a serialized message to a chat group,
+    with the message frame already encoded for every codec. `frame_type` is
+    'chat_message' for a new message and 'message_updated' for an edit or
+    delete.
+    """
+    return {
+        'type': 'chat_message',
+        'chat_id': chat_id,
+        'sender': {
+            'user': message['sender'],
+            'name': message.get('sender_name'),
+            'photo': message.get('sender_photo'),
+        },
+        'frames': {
+            encoder.key: encoder.encode(encoder.message_frame(chat_id, message, frame_type))
+            for encoder in _ENCODERS
+        },
+    }
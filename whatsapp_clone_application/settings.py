@@ -76,8 +76,20 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Requests close their connection when done: under ASGI, sync views
+        # run on threads that must not hold one. The consumer database
+        # threads keep theirs (DB_EXECUTOR_CONN_MAX_AGE below)
+        'CONN_MAX_AGE': 0,
     }
 }
+
+# Threads (and so database connections) per process for consumer database
+# work (whats_app.db_executor); keep processes x workers under the server's
+# connection limit. SQLite takes one writer at a time, so more threads only
+# add lock contention; use 16 or so with PostgreSQL.
+DB_EXECUTOR_WORKERS = int(os.getenv('DB_EXECUTOR_WORKERS', 1))
+DB_EXECUTOR_CONN_MAX_AGE = int(os.getenv('DB_EXECUTOR_CONN_MAX_AGE', 300))  # seconds a thread keeps its connection
+DB_HEALTH_CHECK_IDLE = 30  # seconds idle before a reused connection is tested
 AUTH_USER_MODEL = 'whats_app.User'
 
 # Password validation
@@ -141,8 +153,91 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Shared cache; whats_app.access keeps chat membership snapshots here, so every
+# process must see the same invalidations
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+        'LOCATION': os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/0'),
+    }
+}
+CHAT_ACCESS_TTL = 300  # seconds; signals invalidate earlier on membership changes
+
+# Presence (whats_app.presence)
+# 'redis' shares presence across ASGI processes, 'local' keeps it in-process
+PRESENCE_BACKEND = os.getenv('PRESENCE_BACKEND', 'redis')
+PRESENCE_REDIS_URL = os.getenv('REDIS_URL', 'redis://127.0.0.1:6379/0')
+PRESENCE_TTL = 60  # seconds without a heartbeat before a connection is dropped
+PRESENCE_FLUSH_INTERVAL = 10  # seconds between batched last_seen writes
+
+# Typing indicators (whats_app.typing_indicators)
+TYPING_THROTTLE = 3  # at most one typing=true broadcast per user and chat per window
+TYPING_TIMEOUT = 6  # seconds without typing=true before the indicator auto-stops
+
+# Read receipts from one socket within this many seconds are applied as one batch
+READ_RECEIPT_BATCH_WINDOW = 0.5
+
+# WebSocket flow control (whats_app.rate_limits, whats_app.send_queue)
+# Frame class -> (frames per second, burst), per socket and per user
+WS_RATE_LIMITS = {
+    'message': (5, 20),
+    'typing': (10, 20),
+    'receipt': (10, 30),
+    'call': (1, 5),
+    'sync': (2, 10),
+    'other': (10, 20),
+}
+WS_USER_RATE_LIMITS = {
+    'message': (10, 40),
+    'typing': (20, 40),
+    'receipt': (20, 60),
+    'call': (2, 10),
+    'sync': (4, 20),
+    'other': (20, 40),
+}
+WS_SEND_QUEUE_LIMIT = 500  # frames waiting for a slow client before its socket is closed
+WS_SEND_QUEUE_PRESSURE = 50  # beyond this many waiting frames, typing and presence are dropped
+
+# Seconds a client_id is remembered in the cache; older retries fall back
+# to the (sender, client_id) unique constraint
+CLIENT_MESSAGE_ID_TTL = 600
+
+# Broadcast outbox (whats_app.outbox)
+# With drain-on-commit the writing process delivers its own events right
+# after commit; turn it off to leave delivery (and batching) to
+# `manage.py outbox_relay`, which should run in either case to recover
+# events left behind by a crashed process.
+OUTBOX_DRAIN_ON_COMMIT = os.getenv('OUTBOX_DRAIN_ON_COMMIT', 'True') == 'True'
+OUTBOX_BATCH_SIZE = 200
+OUTBOX_POLL_INTERVAL = 0.5  # seconds the relay waits when the outbox is empty
+
 # Anthropic API
 ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
+# 'anthropic' streams from the Claude API and needs ANTHROPIC_API_KEY;
+# 'fake' streams canned replies with simulated latency, for development and
+# tests (whats_app.ai_service)
+AI_BACKEND = os.getenv('AI_BACKEND', 'anthropic')
+
+# AI conversation context (whats_app.ai_context), in estimated tokens
+AI_CONTEXT_TOKENS = 2000  # recent messages sent verbatim each turn
+AI_CONTEXT_MESSAGE_TOKENS = 500  # longest an earlier message is sent
+AI_SUMMARY_TOKENS = 300  # longest the rolling summary grows
+
+# AI response cache (whats_app.ai_cache), per process
+AI_CACHE_SIZE = 1000  # replies kept, least recently used evicted first
+AI_CACHE_TTL = 600  # seconds a reply is reused
+AI_CACHE_MAX_PROMPT = 200  # characters; longer prompts are not cached
+
+# AI admission control (whats_app.ai_admission), per process
+AI_MAX_CONCURRENT = 8  # backend requests in flight
+AI_MAX_CONCURRENT_PER_USER = 2  # one user's requests running or queued
+AI_QUEUE_LIMIT = 32  # requests waiting for a slot before new ones are refused
+AI_QUEUE_TIMEOUT = 10  # seconds a request waits for a slot
+AI_REQUEST_TIMEOUT = 60  # seconds from arrival to the end of the reply
+AI_FIRST_TOKEN_TIMEOUT = 20  # seconds to wait for a reply to start
+AI_RETRIES = 2  # retries of transient failures before the reply starts
+AI_RETRY_BASE_DELAY = 0.5  # seconds; backoff doubles per retry, with full jitter
+AI_RETRY_MAX_DELAY = 4
 
 
 